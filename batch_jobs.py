@@ -0,0 +1,241 @@
+"""
+背景批次工作（Alex / Aria 共用）
+
+daily-nudge 原本在 request 裡逐一處理每個使用者（LINE push 等待回應），使用者一多 cron 呼叫端就逾時。改為：
+
+- endpoint 立即回傳 job_id，工作在背景 thread 執行
+- 每個項目交給有上限的 worker pool 並行處理（max_workers）
+- TokenBucket 限制對外呼叫速率（例如 LINE push 每秒上限），worker 在呼叫前取得 token
+- status(job_id) 提供進度：總數、已處理、各結果計數、各結果的處理延遲（avg / p95 / max）、每秒處理數、錯誤
+- 同名工作執行中時不重複啟動，回傳執行中的 job_id
+- chunk_size 模式：每次交給 worker 一批項目（例如 LINE multicast 一次最多 500 人），
+  process_item 回傳 {結果: [項目 id, ...]}，進度與計數仍以單一項目為單位
+- load_items 可以是 generator（例如分頁讀取 Sheets）：邊讀邊交給 worker，
+  未處理的項目最多保留 max_workers × 2 個（或批），記憶體與名單大小無關；total 在讀完後才確定
+"""
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)                   # 每秒補充的 token 數
+        self.capacity = float(capacity or rate)   # 最多可累積（瞬間突發）的 token 數
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """取得 token；不足時等待補充。回傳等待的秒數"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class BatchJob:
+    def __init__(self, name, keep_ids=()):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.keep_ids = set(keep_ids)  # 這些結果額外保留 item id（例如 pushed_ids）
+        self.status = 'pending'
+        self.total = None
+        self.loaded = 0  # 已讀入的項目數（讀完後等於 total）
+        self.processed = 0
+        self.counts = {}
+        self.ids = {}
+        self.latencies = {}  # 結果 → 各項目處理時間（ms）
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.summary = {}
+        self._lock = threading.Lock()
+
+    def record(self, outcome, item_id=None, latency_ms=None):
+        with self._lock:
+            self.processed += 1
+            if outcome is None:
+                return
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            if latency_ms is not None:
+                self.latencies.setdefault(outcome, []).append(latency_ms)
+            if outcome in self.keep_ids and item_id is not None:
+                self.ids.setdefault(outcome, []).append(item_id)
+
+    def record_chunk(self, results, size, latency_ms=None):
+        """
+        一批項目的結果：results = {結果: [項目 id, ...] 或次數}；沒列在 results 裡的項目只計入 processed。
+        次數（int）用於不對應單一項目的計數，例如該批送出的請求數
+        """
+        with self._lock:
+            self.processed += size
+            for outcome, ids in results.items():
+                if isinstance(ids, int):
+                    self.counts[outcome] = self.counts.get(outcome, 0) + ids
+                    continue
+                self.counts[outcome] = self.counts.get(outcome, 0) + len(ids)
+                if outcome in self.keep_ids:
+                    self.ids.setdefault(outcome, []).extend(ids)
+            if latency_ms is not None:
+                self.latencies.setdefault('chunk', []).append(latency_ms)
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0
+            data = {
+                'job_id': self.job_id,
+                'name': self.name,
+                'status': self.status,
+                'total': self.total,
+                'loaded': self.loaded,
+                'processed': self.processed,
+                'counts': dict(self.counts),
+                'latency_ms': {outcome: _summary(values) for outcome, values in self.latencies.items()},
+                'elapsed_s': round(elapsed, 2),
+                'items_per_s': round(self.processed / elapsed, 2) if elapsed else None,
+                'error': self.error,
+            }
+            data.update(self.summary)
+            for outcome, ids in self.ids.items():
+                data[f'{outcome}_ids'] = list(ids)
+            return data
+
+
+def _summary(values):
+    ordered = sorted(values)
+    return {
+        'avg': int(sum(ordered) / len(ordered)),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+    }
+
+
+def _chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BatchJobRunner:
+    def __init__(self, max_workers=8, history=20, label='JOBS'):
+        self.max_workers = max_workers
+        self.history = history  # 保留最近幾個工作的狀態
+        self.label = label
+        self._jobs = OrderedDict()
+        self._running = {}  # 工作名稱 → 執行中的 BatchJob
+        self._lock = threading.Lock()
+
+    def start(self, name, load_items, process_item, item_id=None, keep_ids=(), summary=None, finalize=None, chunk_size=None):
+        """
+        啟動背景工作，回傳 (BatchJob, 是否新啟動)。
+        load_items()：在背景 thread 取得項目清單或 iterator（例如分頁呼叫 Sheets）
+        process_item(item)：處理單一項目，回傳結果名稱（計入 counts；None 表示不計）
+        item_id(item)：取得項目 id（keep_ids 列出的結果會保留 id）
+        summary：附加到狀態的固定欄位（例如日期）
+        finalize()：工作結束時呼叫，回傳的 dict 併入狀態（例如 checkpoint 統計）
+        chunk_size：設定時 process_item 收到的是最多 chunk_size 個項目的 list，回傳 {結果: [項目 id, ...]}
+        """
+        with self._lock:
+            running = self._running.get(name)
+            if running:
+                return running, False
+            job = BatchJob(name, keep_ids)
+            job.summary = dict(summary or {})
+            self._running[name] = job
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        threading.Thread(
+            target=self._run, args=(job, load_items, process_item, item_id, finalize, chunk_size),
+            name=f'job-{name}', daemon=True
+        ).start()
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': [job.job_id for job in self._running.values()],
+                'recent': [job.to_dict() for job in list(self._jobs.values())[-5:]],
+            }
+
+    def _run(self, job, load_items, process_item, item_id, finalize, chunk_size):
+        job.started_at = time.time()
+        job.status = 'running'
+        try:
+            print(f'[{self.label}] {job.name} {job.job_id}: started, {self.max_workers} worker(s)')
+            # 限制已送出但未處理完的數量，讀取端不會把整份名單堆在 pool 的佇列裡
+            slots = threading.Semaphore(self.max_workers * 2)
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'job-{job.name}') as pool:
+                try:
+                    if chunk_size:
+                        for chunk in _chunked(load_items(), chunk_size):
+                            slots.acquire()
+                            job.loaded += len(chunk)
+                            future = pool.submit(self._process_chunk, job, process_item, chunk, item_id)
+                            future.add_done_callback(lambda _: slots.release())
+                    else:
+                        for item in load_items():
+                            slots.acquire()
+                            job.loaded += 1
+                            future = pool.submit(self._process, job, process_item, item, item_id)
+                            future.add_done_callback(lambda _: slots.release())
+                finally:
+                    job.total = job.loaded
+            print(f'[{self.label}] {job.name} {job.job_id}: {job.total} item(s) loaded')
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f'[{self.label}] {job.name} {job.job_id} failed: {str(e)}')
+            traceback.print_exc()
+        finally:
+            if finalize:
+                try:
+                    job.summary.update(finalize() or {})
+                except Exception as e:
+                    print(f'[{self.label}] {job.name} finalize failed: {str(e)}')
+            job.finished_at = time.time()
+            with self._lock:
+                self._running.pop(job.name, None)
+            print(f'[{self.label}] {job.name} {job.job_id} {job.status}: {job.to_dict()["counts"]}')
+
+    def _process(self, job, process_item, item, item_id):
+        start = time.time()
+        try:
+            outcome = process_item(item)
+        except Exception as e:
+            print(f'[{self.label}] {job.name} item error: {str(e)}')
+            outcome = 'error'
+        job.record(outcome, item_id(item) if item_id else None, int((time.time() - start) * 1000))
+
+    def _process_chunk(self, job, process_item, chunk, item_id):
+        start = time.time()
+        try:
+            results = process_item(chunk) or {}
+        except Exception as e:
+            print(f'[{self.label}] {job.name} chunk error: {str(e)}')
+            results = {'error': [item_id(item) if item_id else None for item in chunk]}
+        job.record_chunk(results, len(chunk), int((time.time() - start) * 1000))
@@ -0,0 +1,151 @@
+"""
+關鍵字 fallback micro-benchmark：
+舊做法（每次重建 list、每個分類各跑一次 `any(word in message ...)`）vs keyword_matcher.KeywordMatcher
+
+server.py / server-aria.py 需要 Flask 等套件，這裡不 import 整個模組，
+而是用 ast 取出關鍵字字典與四個 fallback 函數（_detect_response_type_fallback / detect_emotion_fallback /
+is_greeting / has_emotional_content）單獨執行，確保檢查的是 server 裡實際的程式碼。
+
+訊息以所有關鍵字隨機組合（含重疊、互為子字串、大小寫、標點）產生，只量測時間；
+新舊做法的等價檢查在 tests/test_keyword_matcher.py。
+
+用法：
+    python benchmarks/bench_keyword_matcher.py [訊息數]
+"""
+import ast
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from keyword_matcher import KeywordMatcher  # noqa: E402
+
+SERVERS = (('alex', 'server.py'), ('aria', 'server-aria.py'))
+FUNCTIONS = ('_detect_response_type_fallback', 'detect_emotion_fallback', 'is_greeting', 'has_emotional_content')
+FILLER = ['我', '今天', '其實', '覺得', '他', '上班', '吃飯', '啦', '喔', '。', '，', '!', '~', ' ', 'OK', 'Hi', 'lol']
+
+
+def load_fallbacks(filename):
+    """從 server 原始碼取出 KeywordMatcher 相關的模組常數與 fallback 函數"""
+    with open(os.path.join(ROOT, filename), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(t, ast.Name) and (t.id.endswith('_KEYWORDS') or t.id.endswith('_matcher')
+                                         or t.id in ('_SYMBOLS_ONLY', '_EMOTION_FALLBACK_RESULTS'))
+            for t in node.targets
+        ):
+            nodes.append(node)
+        elif isinstance(node, ast.FunctionDef) and node.name in FUNCTIONS:
+            nodes.append(node)
+    namespace = {'KeywordMatcher': KeywordMatcher, 're': re}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), filename, 'exec'), namespace)
+    return namespace
+
+
+def make_legacy(ns):
+    """舊做法：與改版前的函數相同，依分類順序逐一 `any(word in message ...)`"""
+    response_types = ns['_RESPONSE_TYPE_KEYWORDS']
+    emotions = ns['_EMOTION_FALLBACK_KEYWORDS']
+
+    def response_type(user_message):
+        keywords = {k: list(v) for k, v in response_types.items()}  # 每次呼叫重建 list
+        message = user_message.lower()
+        if any(word in message for word in keywords['question']):
+            return 'question'
+        if any(phrase in message for phrase in keywords['neutral_override']):
+            return 'neutral'
+        if any(word in message for word in keywords['refuse']):
+            return 'refuse'
+        if any(word in message for word in keywords['dismiss']):
+            return 'dismiss'
+        if any(word in message for word in keywords['cooperative']):
+            return 'cooperative'
+        return 'neutral'
+
+    def emotion(user_message):
+        keywords = {k: list(v) for k, v in emotions.items()}
+        if any(p in user_message for p in keywords['neutral_override']):
+            emotion, reason = 'Neutral', 'neutral override'
+        elif any(p in user_message for p in keywords['negative_pattern']):
+            emotion, reason = 'Negative', 'negative pattern'
+        elif any(w in user_message for w in keywords['negative_keyword']):
+            emotion, reason = 'Negative', 'negative keyword'
+        elif any(w in user_message for w in keywords['positive_keyword']):
+            emotion, reason = 'Positive', 'positive keyword'
+        else:
+            emotion, reason = 'Neutral', 'neutral'
+        print(f'Fallback: Emotion detected ({reason}): {emotion}')
+        return emotion
+
+    def greeting(user_message):
+        message = user_message.strip()
+        if re.fullmatch(r'[\W_]+', message):
+            return True
+        greeting_keywords = list(ns['_GREETING_KEYWORDS'])
+        return any(word in message for word in greeting_keywords)
+
+    def emotional(user_message):
+        if len(user_message.strip()) > 8:
+            return True
+        emotional_keywords = list(ns['_EMOTIONAL_KEYWORDS'])
+        return any(word in user_message for word in emotional_keywords)
+
+    return {
+        '_detect_response_type_fallback': response_type,
+        'detect_emotion_fallback': emotion,
+        'is_greeting': greeting,
+        'has_emotional_content': emotional,
+    }
+
+
+def make_corpus(ns, n, seed=7):
+    rng = random.Random(seed)
+    keywords = []
+    for name in ('_RESPONSE_TYPE_KEYWORDS', '_EMOTION_FALLBACK_KEYWORDS'):
+        for words in ns[name].values():
+            keywords.extend(words)
+    keywords.extend(ns['_GREETING_KEYWORDS'])
+    keywords.extend(ns['_EMOTIONAL_KEYWORDS'])
+    corpus = ['', ' ', '...', '？？', '嗯', '好', 'HI', 'Hello!']
+    while len(corpus) < n:
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            word = rng.choice(keywords) if rng.random() < 0.5 else rng.choice(FILLER)
+            parts.append(word.upper() if rng.random() < 0.1 else word)
+        corpus.append(''.join(parts))
+    return corpus
+
+
+def bench(label, funcs, corpus):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for message in corpus:
+            for name in FUNCTIONS:
+                funcs[name](message)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<24} {len(corpus)} messages  {elapsed * 1000:8.1f} ms  {elapsed / len(corpus) * 1e6:8.1f} us/message')
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for bot, filename in SERVERS:
+        ns = load_fallbacks(filename)
+        new = {name: ns[name] for name in FUNCTIONS}
+        legacy = make_legacy(ns)
+        corpus = make_corpus(ns, n)
+        slow = bench(f'{bot} legacy any()', legacy, corpus)
+        fast = bench(f'{bot} KeywordMatcher', new, corpus)
+        print(f'[{bot}] speedup: {slow / fast:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
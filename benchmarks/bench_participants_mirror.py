@@ -0,0 +1,85 @@
+"""
+participants_mirror 查詢延遲量測：以假的 get_participants（不連 Sheets）全量載入 N 列後，
+量測 by_user_id / by_code 的平均與 p95 延遲，以及一次 delta sync（少數列變更）的時間。
+
+用法：
+    python benchmarks/bench_participants_mirror.py [列數]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from participants_mirror import ParticipantsMirror  # noqa: E402
+
+TW = timezone(timedelta(hours=8))
+PAGE_SIZE = 200
+
+
+def make_sheet(n):
+    return [
+        {
+            'code': f'{i:05d}',
+            'user_id': f'U{i:032x}' if i % 3 else '',
+            'group': 'ABCDEFGH'[i % 8],
+            'first_interaction': '2026-01-05 10:00:00' if i % 3 else '',
+            'd7_triggered': i % 5 == 0,
+            'd7_turn': 0,
+            'updated_at': 1000.0,
+        }
+        for i in range(n)
+    ]
+
+
+def fake_fetch(sheet):
+    def fetch_page(since, cursor):
+        rows = [row for row in sheet if since is None or row['updated_at'] > float(since)]
+        start = int(cursor or 0)
+        end = start + PAGE_SIZE
+        return {
+            'participants': rows[start:end],
+            'next_cursor': str(end) if end < len(rows) else None,
+            'server_time': time.time(),
+        }
+    return fetch_page
+
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return sum(samples) / len(samples), samples[int(len(samples) * 0.95)]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    sheet = make_sheet(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror = ParticipantsMirror(os.path.join(tmp, 'state.db'), fake_fetch(sheet), TW)
+        start = time.perf_counter()
+        mirror.sync(full=True)
+        print(f'full sync {n} rows: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+        user_ids = [(row['user_id'],) for row in sheet if row['user_id']] * 3
+        codes = [(row['code'],) for row in sheet] * 2
+        avg, p95 = timed(mirror.by_user_id, user_ids)
+        print(f'by_user_id: avg {avg:.1f} us  p95 {p95:.1f} us  ({len(user_ids)} lookups)')
+        avg, p95 = timed(mirror.by_code, codes)
+        print(f'by_code:    avg {avg:.1f} us  p95 {p95:.1f} us  ({len(codes)} lookups)')
+
+        for row in sheet[:20]:
+            row['updated_at'] = time.time() + 3600
+        start = time.perf_counter()
+        applied = mirror.sync()
+        print(f'delta sync ({applied} changed rows): {(time.perf_counter() - start) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+State store micro-benchmark：每次 connect（舊做法）vs 每 thread 長連線 + WAL（state_store.SQLiteEngine）
+
+模擬一則 D7 訊息的存取序列：
+get_d7_turn → get_d7_setup → get_d7_fired → set_d7_turn → try_lock_d7_fired → get_cached_user_data
+
+用法：
+    python benchmarks/bench_state_store.py [次數]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_store import SQLiteEngine  # noqa: E402
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bot_state (
+    user_id TEXT PRIMARY KEY,
+    conversation_id TEXT,
+    d7_turn INTEGER NOT NULL DEFAULT 0,
+    d7_setup INTEGER NOT NULL DEFAULT 0,
+    d7_fired INTEGER NOT NULL DEFAULT 0,
+    last_interaction_date TEXT,
+    cache_group TEXT,
+    cache_code TEXT,
+    cache_current_day TEXT,
+    cache_d7_triggered INTEGER NOT NULL DEFAULT 0,
+    cache_day TEXT
+)
+'''
+
+
+def one_message(conn_factory, user_id, i):
+    with conn_factory() as conn:
+        conn.execute('SELECT d7_turn FROM bot_state WHERE user_id = ?', (user_id,)).fetchone()
+    with conn_factory() as conn:
+        conn.execute('SELECT d7_setup FROM bot_state WHERE user_id = ?', (user_id,)).fetchone()
+    with conn_factory() as conn:
+        conn.execute('SELECT d7_fired FROM bot_state WHERE user_id = ?', (user_id,)).fetchone()
+    with conn_factory() as conn:
+        conn.execute(
+            'INSERT INTO bot_state (user_id, d7_turn) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET d7_turn = excluded.d7_turn',
+            (user_id, i % 4)
+        )
+    with conn_factory() as conn:
+        conn.execute(
+            'INSERT INTO bot_state (user_id, d7_fired) VALUES (?, 1) '
+            'ON CONFLICT(user_id) DO UPDATE SET d7_fired = 1 WHERE d7_fired = 0',
+            (user_id,)
+        )
+        conn.execute('SELECT changes()').fetchone()
+    with conn_factory() as conn:
+        conn.execute(
+            'SELECT cache_group, cache_code, cache_current_day, cache_d7_triggered, cache_day '
+            'FROM bot_state WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+
+
+def run(label, conn_factory, n):
+    start = time.perf_counter()
+    for i in range(n):
+        one_message(conn_factory, f'U{i % 50}', i)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28} {n} messages  {elapsed * 1000:8.1f} ms  {elapsed / n * 1e6:8.1f} us/message')
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        engine_path = os.path.join(tmp, 'engine.db')
+        for path in (legacy_path, engine_path):
+            conn = sqlite3.connect(path)
+            conn.execute(SCHEMA)
+            conn.commit()
+            conn.close()
+
+        # 舊做法：每次 sqlite3.connect，預設 rollback journal + synchronous=FULL
+        legacy = run('connect per call', lambda: sqlite3.connect(legacy_path, timeout=5), n)
+
+        engine = SQLiteEngine(engine_path)
+        fast = run('SQLiteEngine (WAL, reuse)', engine.connection, n)
+        engine.close()
+
+    print(f'speedup: {legacy / fast:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+GPT 分類結果快取（Alex / Aria 共用）
+
+detect_user_response_type / has_sharing_content / trigger_d7 的情緒分類都是 gpt-4o-mini、temperature 0，
+輸入多半是很短的中文訊息（「嗯」「好吧」「還好」「沒事」），不同受試者之間大量重複。
+
+- key = sha1(分類種類 | prompt 版本 | model | 正規化後文字)
+- 正規化：NFKC（全形半形統一）、去頭尾空白、連續空白合一、英文轉小寫
+- prompt 版本由 system prompt + user 模板的內容雜湊而來，改 prompt 會自動換一組 key，不會讀到舊結果
+- 兩層：行程內 LRU（OrderedDict，上限 max_entries）+ SQLite 表（與 bot_state 同一個 DB，重啟後仍有效）
+- 只快取 GPT 成功的結果；API 失敗走關鍵字 fallback 的結果不寫入
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from state_store import get_engine
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFKC', text or '')
+    return _WHITESPACE.sub(' ', text).strip().lower()
+
+
+def prompt_version(*parts):
+    """prompt 內容的短雜湊，作為快取 key 的一部分"""
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+class ClassifierCache:
+    def __init__(self, db_path, max_entries=4096, label='CLASSIFIER_CACHE'):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.label = label
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._init_table()
+
+    def _conn(self):
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        self._conn().execute(
+            '''
+            CREATE TABLE IF NOT EXISTS classifier_cache (
+                cache_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            '''
+        )
+
+    @staticmethod
+    def make_key(kind, version, model, text):
+        raw = f'{kind}|{version}|{model}|{normalize_text(text)}'
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, kind, version, model, text):
+        """回傳 (命中與否, 值)"""
+        key = self.make_key(kind, version, model, text)
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._incr(kind, 'memory_hits')
+                return True, self._lru[key]
+
+        row = self._conn().execute(
+            'SELECT value FROM classifier_cache WHERE cache_key = ?',
+            (key,)
+        ).fetchone()
+        if row:
+            value = json.loads(row[0])
+            with self._lock:
+                self._remember(key, value)
+                self._incr(kind, 'db_hits')
+            return True, value
+
+        with self._lock:
+            self._incr(kind, 'misses')
+        return False, None
+
+    def put(self, kind, version, model, text, value):
+        key = self.make_key(kind, version, model, text)
+        self._conn().execute(
+            'INSERT OR REPLACE INTO classifier_cache (cache_key, kind, value, created_at) VALUES (?, ?, ?, ?)',
+            (key, kind, json.dumps(value, ensure_ascii=False), time.time())
+        )
+        with self._lock:
+            self._remember(key, value)
+            self._incr(kind, 'stores')
+
+    def cached(self, kind, version, model, text, compute):
+        """
+        先查快取，未命中才呼叫 compute()。
+        compute 回傳 None 代表失敗（呼叫端會走 fallback），不寫入快取。
+        """
+        hit, value = self.get(kind, version, model, text)
+        if hit:
+            return value
+        value = compute()
+        if value is not None:
+            self.put(kind, version, model, text, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            kinds = {kind: dict(counts) for kind, counts in self._stats.items()}
+            size = len(self._lru)
+        for counts in kinds.values():
+            lookups = counts['memory_hits'] + counts['db_hits'] + counts['misses']
+            hits = counts['memory_hits'] + counts['db_hits']
+            counts['hit_rate'] = round(hits / lookups, 3) if lookups else None
+        return {'memory_entries': size, 'max_entries': self.max_entries, 'kinds': kinds}
+
+    def _remember(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _incr(self, kind, field):
+        counts = self._stats.setdefault(kind, {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0})
+        counts[field] += 1
@@ -0,0 +1,152 @@
+"""
+D7 衝突句預先生成池（Alex / Aria 共用）
+
+衝突句原本在受試者分享之後才呼叫 generate_conflict_sentence 即時生成，使用者要多等一次 OpenAI 往返。
+改為在推播引導句（d7_trigger job / Day 7 第一則 FOLLOWUP）時，背景為該使用者預先生成：
+
+- 依組別 prompt，每種情緒（Positive / Negative / Neutral）各生成數句候選，存入 SQLite
+  （與 bot_state 同一個 DB，重啟後仍有效）
+- 觸發時依情緒取一句未使用過的候選（取出即標記已使用），不必等 GPT
+- 池子是空的、過期（超過 max_age 秒）或生成失敗時回傳 None，呼叫端照舊即時生成
+- 同一使用者同一組別已有未使用、未過期的候選時不重複生成（cron 重跑、FOLLOWUP 與 job 都觸發時）
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from state_store import get_engine
+
+EMOTIONS = ('Positive', 'Negative', 'Neutral')
+
+
+class ConflictPool:
+    def __init__(self, db_path, generate_fn, per_emotion=3, max_age=3 * 86400, max_workers=2, label='CONFLICT_POOL'):
+        self.db_path = db_path
+        self.generate_fn = generate_fn  # (group, per_emotion) -> {emotion: [句子, ...]}
+        self.per_emotion = per_emotion
+        self.max_age = max_age
+        self.label = label
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='conflict-pool')
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._stats = {'prefill_jobs': 0, 'prefill_skipped': 0, 'prefill_failed': 0, 'generated': 0, 'hits': 0, 'misses': 0}
+        self._init_table()
+
+    def _conn(self):
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        conn = self._conn()
+        conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS d7_conflict_pool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                grp TEXT NOT NULL,
+                emotion TEXT NOT NULL,
+                sentence TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL
+            )
+            '''
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conflict_pool_user ON d7_conflict_pool (user_id, emotion, used_at)')
+
+    def prefill(self, user_id, group):
+        """排入背景生成；同一使用者已在生成中時略過"""
+        with self._lock:
+            if user_id in self._inflight:
+                return False
+            self._inflight.add(user_id)
+        self._pool.submit(self._prefill, user_id, group)
+        return True
+
+    def _prefill(self, user_id, group):
+        try:
+            self.fill(user_id, group)
+        except Exception as e:
+            self._incr('prefill_failed')
+            print(f'[{self.label}] Prefill failed for {user_id}: {str(e)}')
+        finally:
+            with self._lock:
+                self._inflight.discard(user_id)
+
+    def fill(self, user_id, group):
+        """同步生成並寫入；已有未使用的候選時不呼叫 GPT。回傳寫入的句數"""
+        if self._available(user_id, group):
+            self._incr('prefill_skipped')
+            return 0
+        self._incr('prefill_jobs')
+        candidates = self.generate_fn(group, self.per_emotion) or {}
+        now = time.time()
+        rows = [
+            (user_id, group, emotion, sentence.strip(), now)
+            for emotion in EMOTIONS
+            for sentence in candidates.get(emotion, [])[:self.per_emotion]
+            if sentence and sentence.strip()
+        ]
+        conn = self._conn()
+        # 清掉舊候選與寫入新候選在同一個交易：take() 不會看到清空到一半的池子，中途失敗也整批還原
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # 舊的候選（可能是其他組別或已過期）一併清掉
+            conn.execute('DELETE FROM d7_conflict_pool WHERE user_id = ? AND used_at IS NULL', (user_id,))
+            conn.executemany(
+                'INSERT INTO d7_conflict_pool (user_id, grp, emotion, sentence, created_at) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._stats['generated'] += len(rows)
+        print(f'[{self.label}] Prefilled {len(rows)} conflict sentence(s) for {user_id} (group={group})')
+        return len(rows)
+
+    def take(self, user_id, group, emotion):
+        """取一句該情緒的候選並標記已使用；沒有可用候選時回傳 None"""
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT id, sentence FROM d7_conflict_pool '
+            'WHERE user_id = ? AND grp = ? AND emotion = ? AND used_at IS NULL AND created_at >= ? '
+            'ORDER BY id LIMIT 1',
+            (user_id, group, emotion, time.time() - self.max_age)
+        ).fetchone()
+        if row:
+            # used_at IS NULL 條件確保同一句不會被兩個事件同時取走
+            claimed = conn.execute(
+                'UPDATE d7_conflict_pool SET used_at = ? WHERE id = ? AND used_at IS NULL',
+                (time.time(), row[0])
+            ).rowcount
+            if claimed:
+                self._incr('hits')
+                return row[1]
+        self._incr('misses')
+        return None
+
+    def clear(self, user_id):
+        self._conn().execute('DELETE FROM d7_conflict_pool WHERE user_id = ?', (user_id,))
+
+    def _available(self, user_id, group):
+        row = self._conn().execute(
+            'SELECT COUNT(*) FROM d7_conflict_pool '
+            'WHERE user_id = ? AND grp = ? AND used_at IS NULL AND created_at >= ?',
+            (user_id, group, time.time() - self.max_age)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['inflight'] = len(self._inflight)
+        row = self._conn().execute('SELECT COUNT(*) FROM d7_conflict_pool WHERE used_at IS NULL').fetchone()
+        data['available'] = row[0] if row else 0
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 3) if lookups else None
+        return data
+
+    def _incr(self, key):
+        with self._lock:
+            self._stats[key] += 1
@@ -0,0 +1,115 @@
+"""
+Dify chat-messages 串流模式（SSE）解析（Alex / Aria 共用）
+
+blocking 模式要等整段回覆生成完才返回。streaming 模式邊生成邊送：
+
+- 逐行解析 `data: {...}` 事件，message / agent_message 事件的 answer 依序串接
+- 第一個帶 conversation_id 的事件就記下 conversation_id
+- 收到 message_end 立即結束（不必等連線關閉）；收到 error 事件視為失敗
+- 記錄 time to first token（TTFT）與總時間，stats() 提供給 /metrics
+"""
+import json
+import threading
+import time
+
+ANSWER_EVENTS = ('message', 'agent_message')
+
+
+def iter_sse_events(response):
+    """
+    逐一產生 SSE 的 data 事件（dict）；ping 等非 JSON 行略過。
+    SSE 固定是 UTF-8：text/event-stream 沒帶 charset 時 requests 會當成 ISO-8859-1 解碼（中文變亂碼），
+    所以逐行取 bytes 自行以 UTF-8 解碼（UTF-8 的多位元組字元不含換行位元組，依行切開不會切壞字元）
+    """
+    for raw in response.iter_lines():
+        line = raw.decode('utf-8', errors='replace') if isinstance(raw, bytes) else raw
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if not data:
+            continue
+        try:
+            yield json.loads(data)
+        except ValueError:
+            continue
+
+
+class StreamStats:
+    def __init__(self, window=200):
+        self.window = window  # 保留最近幾次的數值計算平均 / p95
+        self._lock = threading.Lock()
+        self._ttft = []
+        self._total = []
+        self._count = 0
+        self._errors = 0
+
+    def record(self, ttft_ms, total_ms):
+        with self._lock:
+            self._count += 1
+            if ttft_ms is not None:
+                self._ttft = (self._ttft + [ttft_ms])[-self.window:]
+            self._total = (self._total + [total_ms])[-self.window:]
+
+    def record_error(self):
+        with self._lock:
+            self._errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': self._count,
+                'errors': self._errors,
+                'ttft_ms': _summary(self._ttft),
+                'total_ms': _summary(self._total),
+            }
+
+
+def _summary(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'last': values[-1],
+        'avg': int(sum(values) / len(values)),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+
+def read_chat_stream(response, started_at, stats=None):
+    """
+    讀取 Dify streaming 回應，回傳與 blocking 模式相同形狀的 dict：
+    {'answer': ..., 'conversation_id': ..., 'message_id': ...}
+    """
+    parts = []
+    result = {}
+    first_token_at = None
+    try:
+        for event in iter_sse_events(response):
+            kind = event.get('event')
+            if 'conversation_id' not in result and event.get('conversation_id'):
+                result['conversation_id'] = event['conversation_id']
+            if kind in ANSWER_EVENTS:
+                if first_token_at is None:
+                    first_token_at = time.time()
+                parts.append(event.get('answer', ''))
+                result.setdefault('message_id', event.get('message_id'))
+            elif kind == 'message_end':
+                break
+            elif kind == 'error':
+                raise RuntimeError(f'Dify stream error: {event.get("status")} {event.get("message", "")[:200]}')
+    except Exception:
+        if stats is not None:
+            stats.record_error()
+        raise
+    finally:
+        response.close()  # message_end 之後剩下的資料不再讀取，直接釋放連線
+
+    finished_at = time.time()
+    if stats is not None:
+        stats.record(
+            int((first_token_at - started_at) * 1000) if first_token_at else None,
+            int((finished_at - started_at) * 1000)
+        )
+    if parts:
+        result['answer'] = ''.join(parts)
+    return result
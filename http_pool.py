@@ -0,0 +1,97 @@
+"""
+上游 HTTP 連線池（Alex / Aria 共用）
+
+每個上游（Dify / LINE / OpenAI / Google Sheets）各用一個 requests.Session，
+keep-alive 重用 TCP + TLS 連線，不必每次呼叫都重新握手。
+
+- 每個上游有自己的連線池大小與 connect / read timeout
+- 呼叫端傳入的 timeout 視為 read timeout，connect timeout 固定用上游設定
+- stats() 回傳各上游的請求數、新建連線數與連線重用率（pool hit）
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 預設值；可用環境變數 HTTP_POOL_SIZE_<NAME> 覆寫連線池大小（例如 HTTP_POOL_SIZE_DIFY=20）
+UPSTREAMS = {
+    'dify':   {'pool_size': 10, 'connect_timeout': 3.05, 'read_timeout': 30},
+    'line':   {'pool_size': 10, 'connect_timeout': 3.05, 'read_timeout': 10},
+    'openai': {'pool_size': 10, 'connect_timeout': 3.05, 'read_timeout': 10},
+    'sheets': {'pool_size': 10, 'connect_timeout': 5, 'read_timeout': 10},
+}
+
+
+class UpstreamPool:
+    def __init__(self, name, pool_size, connect_timeout, read_timeout):
+        self.name = name
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._lock = threading.Lock()
+        self._errors = 0
+
+    def request(self, method, url, timeout=None, **kwargs):
+        try:
+            return self.session.request(
+                method, url,
+                timeout=(self.connect_timeout, timeout or self.read_timeout),
+                **kwargs
+            )
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        # urllib3 每個 host 一個 HTTPConnectionPool，記錄送出請求數與新建連線數
+        requests_sent = 0
+        connections = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections += pool.num_connections
+        reused = max(0, requests_sent - connections)
+        return {
+            'pool_size': self.pool_size,
+            'requests': requests_sent,
+            'new_connections': connections,
+            'reused': reused,
+            'hit_rate': round(reused / requests_sent, 3) if requests_sent else None,
+            'errors': self._errors,
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    """取得（或建立）指定上游的共用連線池"""
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            config = dict(UPSTREAMS[name])
+            config['pool_size'] = int(os.environ.get(f'HTTP_POOL_SIZE_{name.upper()}', config['pool_size']))
+            pool = UpstreamPool(name, **config)
+            _pools[name] = pool
+        return pool
+
+
+def stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.stats() for name, pool in pools.items()}
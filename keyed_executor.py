@@ -0,0 +1,57 @@
+"""
+依 key 分片的執行器（Alex / Aria 共用）
+
+同一個 key（LINE userId）的工作嚴格依提交順序執行，不同 key 之間並行，
+整體 thread 數受 max_workers 限制。用來避免同一使用者的兩則訊息同時跑
+D7 狀態機（get_d7_turn / set_d7_turn）造成 race condition。
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class KeyedExecutor:
+    def __init__(self, max_workers=4, name='keyed'):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queues = {}  # key -> deque[(future, fn, args, kwargs)]，存在代表該 key 有 drain 在跑
+        self.max_workers = max_workers
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([(future, fn, args, kwargs)])
+                self._pool.submit(self._drain, key)
+            else:
+                queue.append((future, fn, args, kwargs))
+        return future
+
+    def _drain(self, key):
+        # 每次只執行一筆，若同 key 還有工作就重新排入 pool，讓其他使用者不會被同一人的大量訊息餓死
+        with self._lock:
+            future, fn, args, kwargs = self._queues[key].popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        with self._lock:
+            if self._queues[key]:
+                self._pool.submit(self._drain, key)
+            else:
+                del self._queues[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'active_keys': len(self._queues),
+                'pending': sum(len(q) for q in self._queues.values()),
+            }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,89 @@
+"""
+關鍵字比對（Alex / Aria 共用）
+
+_detect_response_type_fallback / detect_emotion_fallback / is_greeting / has_emotional_content
+原本每次呼叫都重建關鍵字 list，再對每個分類各跑一次 `any(word in message ...)`，訊息被掃好幾遍。
+
+- import 時把所有分類的關鍵字編成一個 Aho–Corasick 自動機（trie + failure link）
+- 掃描訊息一次就得到所有分類的命中（含重疊、互為子字串的關鍵字，例如「不好」與「不好意思」）
+- 優先順序仍由呼叫端決定：first() 依分類順序回傳第一個有命中的分類，
+  結果與原本依序 `any(word in message ...)` 完全相同
+"""
+from collections import deque
+
+
+class KeywordMatcher:
+    def __init__(self, categories):
+        """categories：{分類名稱: [關鍵字, ...]}，dict 的順序即預設優先順序"""
+        self.order = tuple(categories)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                if keyword:
+                    self._add(keyword, category)
+        self._build_failure_links()
+
+    def _add(self, keyword, category):
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = nxt
+        self._out[node] = self._out[node] + ((category, keyword),)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                # 子節點也輸出 failure 節點上的關鍵字（較短、結尾相同的關鍵字）
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def _iter_hits(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                yield from out[node]
+
+    def scan(self, text):
+        """掃描一次，回傳 {分類: [命中的關鍵字, ...]}（只含有命中的分類）"""
+        hits = {}
+        for category, keyword in self._iter_hits(text):
+            hits.setdefault(category, []).append(keyword)
+        return hits
+
+    def first(self, text, order=None):
+        """依優先順序回傳第一個有命中的分類；都沒有命中回傳 None"""
+        order = order or self.order
+        found = set()
+        for category, _ in self._iter_hits(text):
+            if category == order[0]:
+                return category  # 最高優先的分類已命中，不必掃完
+            found.add(category)
+        for category in order:
+            if category in found:
+                return category
+        return None
+
+    def contains(self, text):
+        """是否有任何關鍵字出現在 text 中"""
+        for _ in self._iter_hits(text):
+            return True
+        return False
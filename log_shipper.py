@@ -0,0 +1,211 @@
+"""
+對話記錄批次上傳（Alex / Aria 共用）
+
+原本每則訊息呼叫兩次 log_conversation()，每次都同步 POST 到 Apps Script（10 秒 timeout + 重試），
+而且在 send_line_reply 之前執行。改為：
+
+- log_conversation() 只把一列寫入本地 SQLite journal（與 bot_state 同一個 DB），立即返回
+- 背景 thread 累積到 batch_size 列或距離第一列超過 flush_interval 秒時送出一批：
+  - batch_payload=True：一次 POST 整批 {'log_conversation_batch': True, 'rows': [...]}，
+    回應 JSON 的 written 等於列數才算成功（未部署新 handler 的 Apps Script 也會回 200，不能只看狀態碼）
+  - batch_payload=False（預設）：沿用原本的單筆 {'log_conversation': True, ...} 逐列 POST，每列成功才刪除
+- 依 journal id（寫入順序）送出，單一 flusher，前一批成功前不送下一批，Sheets 列順序與寫入順序一致
+- 至少送達一次（at-least-once）：每列帶 dedup_key，Apps Script 端略過已寫入過的 key，重送不會重複
+- 失敗時整批保留、指數退避重試；重啟後 journal 裡未送出的列會繼續送
+"""
+import json
+import threading
+import time
+import traceback
+import uuid
+
+from state_store import get_engine
+
+
+class LogShipper:
+    def __init__(self, db_path, http, url_getter, batch_size=20, flush_interval=2.0, max_backoff=300,
+                 batch_payload=False, label='LOGS'):
+        self.db_path = db_path
+        self.http = http
+        self.url_getter = url_getter  # 每次送出時讀取 URL（SHEETS_API_URL 可能未設定）
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.batch_payload = batch_payload
+        self.label = label
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._failures = 0
+        self._retry_at = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {'appended': 0, 'batches': 0, 'rows_sent': 0, 'failed_batches': 0, 'last_batch_ms': 0}
+        self._init_table()
+
+    def _conn(self):
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        self._conn().execute(
+            '''
+            CREATE TABLE IF NOT EXISTS conversation_log_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dedup_key TEXT NOT NULL UNIQUE,
+                row TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+            '''
+        )
+
+    def append(self, row):
+        """寫入一列對話記錄，回傳 dedup_key"""
+        dedup_key = uuid.uuid4().hex
+        row = dict(row, dedup_key=dedup_key)
+        self._conn().execute(
+            'INSERT INTO conversation_log_journal (dedup_key, row, created_at) VALUES (?, ?, ?)',
+            (dedup_key, json.dumps(row, ensure_ascii=False), time.time())
+        )
+        self._incr('appended')
+        if self.pending_count() >= self.batch_size:
+            self._wakeup.set()
+        return dedup_key
+
+    def pending_count(self):
+        row = self._conn().execute('SELECT COUNT(*) FROM conversation_log_journal').fetchone()
+        return row[0] if row else 0
+
+    def _oldest_age(self):
+        row = self._conn().execute('SELECT MIN(created_at) FROM conversation_log_journal').fetchone()
+        return time.time() - row[0] if row and row[0] is not None else 0
+
+    def flush_once(self, force=False):
+        """
+        送出一批（最舊的 batch_size 列），回傳送出的列數。
+        未達門檻（列數不足且最舊一列未超過 flush_interval）或仍在退避期間時不送，除非 force=True。
+        """
+        url = self.url_getter()
+        if not url:
+            return 0
+        if not force:
+            if time.time() < self._retry_at:
+                return 0
+            if self.pending_count() < self.batch_size and self._oldest_age() < self.flush_interval:
+                return 0
+
+        rows = self._conn().execute(
+            'SELECT id, row FROM conversation_log_journal ORDER BY id LIMIT ?',
+            (self.batch_size,)
+        ).fetchall()
+        if not rows:
+            return 0
+
+        start = time.time()
+        if self.batch_payload:
+            sent, error = self._post_batch(url, rows)
+        else:
+            sent, error = self._post_rows(url, rows)
+
+        if sent:
+            self._failures = 0
+            self._retry_at = 0
+            with self._stats_lock:
+                self._stats['batches'] += 1
+                self._stats['rows_sent'] += sent
+                self._stats['last_batch_ms'] = int((time.time() - start) * 1000)
+            print(f'[{self.label}] Shipped {sent} conversation log row(s)')
+        if error is None:
+            return sent
+
+        failed_ids = [r[0] for r in rows[sent:]]
+        placeholders = ', '.join('?' for _ in failed_ids)
+        self._conn().execute(
+            f'UPDATE conversation_log_journal SET attempts = attempts + 1, last_error = ? WHERE id IN ({placeholders})',
+            [error[:300]] + failed_ids
+        )
+        backoff = min(self.max_backoff, 2 ** self._failures)
+        self._failures += 1
+        self._retry_at = time.time() + backoff
+        self._incr('failed_batches')
+        print(f'[{self.label}] Batch of {len(failed_ids)} failed: {error}, retry in {backoff}s')
+        return sent
+
+    def _delete(self, ids):
+        placeholders = ', '.join('?' for _ in ids)
+        self._conn().execute(f'DELETE FROM conversation_log_journal WHERE id IN ({placeholders})', ids)
+
+    def _post_batch(self, url, rows):
+        """整批一次 POST；回應的 written 等於列數才刪除 journal。回傳 (送出列數, 錯誤或 None)"""
+        try:
+            response = self.http.post(
+                url,
+                json={'log_conversation_batch': True, 'rows': [json.loads(r[1]) for r in rows]},
+                timeout=15
+            )
+            if response.status_code != 200:
+                return 0, f'HTTP {response.status_code}'
+            try:
+                written = response.json().get('written')
+            except (ValueError, AttributeError):
+                written = None
+            if written != len(rows):
+                return 0, f'unexpected response (written={written!r}, expected {len(rows)}): {response.text[:100]}'
+        except Exception as e:
+            return 0, str(e)
+        self._delete([r[0] for r in rows])
+        return len(rows), None
+
+    def _post_rows(self, url, rows):
+        """單筆 log_conversation 逐列 POST，依序送出，遇到失敗就停（之後的列保留到下次）"""
+        for index, (row_id, row) in enumerate(rows):
+            try:
+                response = self.http.post(url, json=dict(json.loads(row), log_conversation=True), timeout=10)
+                error = None if response.status_code == 200 else f'HTTP {response.status_code}'
+            except Exception as e:
+                error = str(e)
+            if error:
+                return index, error
+            self._delete([row_id])
+        return len(rows), None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'{self.label.lower()}-shipper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """停止背景 thread 並盡量把 journal 送完"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        deadline = time.time() + timeout
+        try:
+            while self.pending_count() and time.time() < deadline:
+                if not self.flush_once(force=True):
+                    break
+        except Exception as e:
+            print(f'[{self.label}] Final flush failed: {str(e)}')
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        data['pending'] = self.pending_count()
+        data['batch_size'] = self.batch_size
+        return data
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(min(self.flush_interval, 1.0))
+            self._wakeup.clear()
+            try:
+                # 積壓時連續送，直到剩下的不到一批
+                while not self._stopping.is_set() and self.flush_once():
+                    pass
+            except Exception as e:
+                print(f'[{self.label}] Ship error: {str(e)}')
+                traceback.print_exc()
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
@@ -0,0 +1,112 @@
+"""
+Dify 記憶同步 pipeline（Alex / Aria 共用）
+
+D7 腳本回覆後需要把「使用者訊息 + 腳本回應」補寫進 Dify 對話記憶。
+原本每次都開一條 daemon thread，爆量時 thread 無上限、重啟會遺失、
+也可能和下一次前景 call_dify 交錯寫入同一個 conversation。
+
+改為：
+- 寫入 DurableQueue（SQLite），重啟後未完成的工作會繼續處理
+- 固定數量 worker，同一使用者 FIFO（依 shard_key 依序 claim）
+- 前景 call_dify 前可呼叫 wait_for_user()，確保先前的記憶已寫完（is_retrying() 為真時呼叫端不必等）
+- 佇列超過 max_pending 時呼叫端會短暫等待（backpressure），並記錄在 stats
+- 關機時 drain()：等待已排入的工作完成，逾時未完成的留在 DB 下次再跑
+"""
+import threading
+import time
+
+from work_queue import QueueConsumer
+
+
+class MemorySyncPipeline:
+    def __init__(self, queue, handler, workers=2, max_pending=500, backpressure_wait=2.0, label='MEMORY'):
+        self.queue = queue
+        self.handler = handler
+        self.max_pending = max_pending
+        self.backpressure_wait = backpressure_wait
+        self.label = label
+        self._consumer = QueueConsumer(queue, self._handle, workers=workers, label=label, on_settled=self._notify)
+        self._done = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'completed': 0,
+            'failed': 0,
+            'backpressure_waits': 0,
+            'last_lag_ms': 0,
+            'max_lag_ms': 0,
+        }
+
+    def start(self):
+        self._consumer.start()
+
+    def submit(self, user_id, payload):
+        pending = self.queue.pending_count()
+        if pending >= self.max_pending:
+            self._incr('backpressure_waits')
+            print(f'[{self.label}] Backpressure: {pending} pending, waiting up to {self.backpressure_wait}s')
+            deadline = time.time() + self.backpressure_wait
+            with self._done:
+                while self.queue.pending_count() >= self.max_pending and time.time() < deadline:
+                    self._done.wait(max(0, deadline - time.time()))
+        # 記憶寫入不可丟棄：即使仍滿載也照樣入佇列（存在 SQLite，不佔記憶體）
+        self.queue.put(payload, shard_key=user_id)
+        self._incr('enqueued')
+        self._consumer.notify()
+
+    def has_pending(self, user_id):
+        return self.queue.pending_count(shard_key=user_id) > 0
+
+    def is_retrying(self, user_id):
+        """該使用者是否有寫入失敗、正在退避的記憶工作（等下去可能要數十秒）"""
+        return self.queue.has_failed(user_id)
+
+    def wait_for_user(self, user_id, timeout=10):
+        """等待該使用者先前排入的記憶寫入完成；逾時回傳 False"""
+        deadline = time.time() + timeout
+        with self._done:
+            while self.queue.pending_count(shard_key=user_id) > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print(f'[{self.label}] wait_for_user timed out for {user_id}')
+                    return False
+                self._done.wait(min(remaining, 0.5))
+        return True
+
+    def drain(self, timeout=20):
+        """關機前等待佇列清空，再停止 worker"""
+        deadline = time.time() + timeout
+        with self._done:
+            while self.queue.pending_count() > 0 and time.time() < deadline:
+                self._done.wait(min(max(0, deadline - time.time()), 0.5))
+        left = self.queue.pending_count()
+        self._consumer.stop(max(0, deadline - time.time()))
+        print(f'[{self.label}] Drained, {left} job(s) left for next start')
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        data['pending'] = self.queue.pending_count()
+        data['max_pending'] = self.max_pending
+        return data
+
+    def _handle(self, payload, enqueued_at):
+        lag_ms = int((time.time() - enqueued_at) * 1000)
+        try:
+            self.handler(payload)
+            self._incr('completed')
+        except Exception:
+            self._incr('failed')
+            raise
+        finally:
+            with self._stats_lock:
+                self._stats['last_lag_ms'] = lag_ms
+                self._stats['max_lag_ms'] = max(self._stats['max_lag_ms'], lag_ms)
+
+    def _notify(self):
+        with self._done:
+            self._done.notify_all()
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
@@ -0,0 +1,303 @@
+"""
+Participants 工作表本地鏡像（Alex / Aria 共用）
+
+get_user_data_by_user_id 快取過期（每天台灣午夜）後一定打一次 Sheets，
+query_google_sheets_by_code（驗證）每次都打 Sheets。改為在本地 SQLite 保留一份 Participants：
+
+- participants 表（與 bot_state 同一個 DB），以 code 為主鍵，另建 user_id 索引
+- 啟動時背景全量載入（分頁，sheets_pager.iter_paged），之後每 interval 秒做一次 delta sync
+  （只取 updated_at 晚於上次同步的列），每 full_interval 秒重新全量載入一次（處理刪除的列）
+- 第一次全量載入完成前 ready() 為 False，呼叫端照舊查 Sheets
+- 伺服器自己的寫入（驗證綁定、RESET、TESTDAY、D7 觸發）同時寫入本地鏡像（write-through），
+  Sheets 仍是唯一的資料來源；該使用者在 outbox 還有未送出的寫入時，delta sync 不覆蓋本地那一列
+- current_day 不存，查詢時由 first_interaction 依台灣日期計算（Day 1 = 驗證當天；bot_state 的 user_data 快取也用同樣的函數）
+
+Apps Script 端的 get_participants 約定見 ARCHITECTURE.md「八、Google Apps Script API 端點」。
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sheets_pager import iter_paged
+from state_store import get_engine
+
+UPDATABLE = ('first_interaction', 'd7_triggered', 'd7_turn')  # update() 可寫入（write-through）的欄位
+SYNC_OVERLAP = 60  # delta sync 的 since 往前重疊的秒數（Apps Script 寫入 updated_at 與回應之間的時間差）
+
+
+def parse_first_interaction(first_interaction, tz):
+    """First_Interaction → 台灣日期（date）；沒有或無法解析時回傳 None"""
+    if not first_interaction:
+        return None
+    text = str(first_interaction).strip()
+    try:
+        if 'T' in text:
+            # Apps Script 直接序列化 Date 時是 UTC ISO 字串（...Z），換算成台灣日期
+            parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+            return (parsed.astimezone(tz) if parsed.tzinfo else parsed).date()
+        return datetime.strptime(text[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def current_day_from(first_interaction, tz, now=None):
+    """First_Interaction → 實驗第幾天（台灣日期相減 + 1）；沒有或無法解析時回傳 0"""
+    start = parse_first_interaction(first_interaction, tz)
+    if start is None:
+        return 0
+    today = (now or datetime.now(tz)).date()
+    return max((today - start).days + 1, 0)
+
+
+def first_interaction_for_day(current_day, tz, now=None):
+    """current_day → 對應的 First_Interaction（當天台灣時間 00:00:00）；無法解析時回傳 None"""
+    try:
+        day = int(current_day)
+    except (TypeError, ValueError):
+        return None
+    if day < 1:
+        return None
+    start = (now or datetime.now(tz)) - timedelta(days=day - 1)
+    return start.strftime('%Y-%m-%d 00:00:00')
+
+
+class ParticipantsMirror:
+    def __init__(self, db_path, fetch_page, tz, interval=300, full_interval=86400, is_pending=None, label='PARTICIPANTS'):
+        self.db_path = db_path
+        self.fetch_page = fetch_page  # (since, cursor) -> {'participants': [...], 'next_cursor': ..., 'server_time': epoch 秒}
+        self.tz = tz
+        self.interval = interval
+        self.full_interval = full_interval
+        self.is_pending = is_pending or (lambda user_ids: set())  # user_ids -> 其中在 outbox 還有未送出寫入的 user_id
+        self.label = label
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._sync_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'full_syncs': 0, 'delta_syncs': 0, 'sync_errors': 0, 'rows_synced': 0, 'rows_skipped': 0}
+        self._last_sync = None
+        self._init_table()
+
+    def _conn(self):
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        conn = self._conn()
+        conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS participants (
+                code TEXT PRIMARY KEY,
+                user_id TEXT,
+                grp TEXT,
+                first_interaction TEXT,
+                d7_triggered INTEGER NOT NULL DEFAULT 0,
+                d7_turn INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT,
+                synced_at REAL NOT NULL
+            )
+            '''
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id)')
+        conn.execute('CREATE TABLE IF NOT EXISTS participants_sync (key TEXT PRIMARY KEY, value TEXT)')
+
+    # ---------- 查詢 ----------
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def by_user_id(self, user_id):
+        row = self._conn().execute(
+            'SELECT code, user_id, grp, first_interaction, d7_triggered, d7_turn FROM participants WHERE user_id = ? LIMIT 1',
+            (user_id,)
+        ).fetchone()
+        return self._result(row)
+
+    def by_code(self, code):
+        row = self._conn().execute(
+            'SELECT code, user_id, grp, first_interaction, d7_triggered, d7_turn FROM participants WHERE code = ?',
+            (code,)
+        ).fetchone()
+        return self._result(row)
+
+    def _result(self, row):
+        """與 Sheets ?user_id= / ?code= 回應相同的欄位；找不到回傳 None"""
+        if not row:
+            self._incr('misses')
+            return None
+        self._incr('hits')
+        return {
+            'found': True,
+            'code': row[0],
+            'user_id': row[1] or '',
+            'group': row[2] or '',
+            'first_interaction': row[3] or '',
+            'current_day': current_day_from(row[3], self.tz),
+            'd7_triggered': bool(row[4]),
+            'd7_turn': row[5] or 0,
+        }
+
+    # ---------- write-through ----------
+
+    def bind(self, code, user_id, first_interaction):
+        """驗證成功：code 綁定 user_id（同一 user_id 先前綁定的其他 code 解除）"""
+        conn = self._conn()
+        conn.execute('UPDATE participants SET user_id = NULL WHERE user_id = ? AND code != ?', (user_id, code))
+        conn.execute(
+            'UPDATE participants SET user_id = ?, first_interaction = ?, d7_triggered = 0, d7_turn = 0, synced_at = ? WHERE code = ?',
+            (user_id, first_interaction, time.time(), code)
+        )
+
+    def unbind(self, user_id):
+        """RESET：清除 user_id 與相關欄位"""
+        self._conn().execute(
+            'UPDATE participants SET user_id = NULL, first_interaction = NULL, d7_triggered = 0, d7_turn = 0, synced_at = ? '
+            'WHERE user_id = ?',
+            (time.time(), user_id)
+        )
+
+    def update(self, user_id, **fields):
+        """TESTDAY（first_interaction）、D7 觸發（d7_triggered）、D7 輪次（d7_turn）等單一使用者欄位更新"""
+        sets = [(key, int(value) if key != 'first_interaction' else value) for key, value in fields.items() if key in UPDATABLE]
+        if not sets:
+            return
+        self._conn().execute(
+            f'UPDATE participants SET {", ".join(f"{column} = ?" for column, _ in sets)}, synced_at = ? WHERE user_id = ?',
+            [value for _, value in sets] + [time.time(), user_id]
+        )
+
+    # ---------- 同步 ----------
+
+    def sync(self, full=False):
+        """全量（full=True 或尚未同步過）或 delta 同步，逐頁寫入；回傳寫入的列數"""
+        with self._sync_lock:
+            since = None if full else self._get_meta('since')
+            started = time.time()
+            server_times = []
+
+            def fetch(cursor):
+                data = self.fetch_page(since, cursor)
+                server_times.append(data.get('server_time'))
+                return [data.get('participants', [])], data.get('next_cursor')
+
+            applied = received = 0
+            for page in iter_paged(fetch, label=self.label):
+                received += len(page)
+                applied += self._apply(page)
+            if since is None:
+                # 全量載入：這一輪沒出現的列（Sheets 上已刪除）一併刪除
+                self._conn().execute('DELETE FROM participants WHERE synced_at < ?', (started,))
+                self._set_meta('full_synced_at', str(started))
+            if server_times and server_times[0]:
+                # 以第一頁的 Sheets 時間為下次的 since（分頁期間被更新的列下次會再取到一次，重複寫入無妨）
+                self._set_meta('since', str(float(server_times[0]) - SYNC_OVERLAP))
+            self._incr('delta_syncs' if since else 'full_syncs')
+            with self._stats_lock:
+                self._stats['rows_synced'] += applied
+                self._stats['rows_skipped'] += received - applied
+            self._last_sync = time.time()
+            self._ready.set()
+            print(f'[{self.label}] {"Delta" if since else "Full"} sync: {applied}/{received} row(s) applied')
+            return applied
+
+    def _apply(self, rows):
+        """寫入一頁；本地有未送出寫入的使用者以本地為準，只更新 synced_at（全量載入時不會被當成已刪除）"""
+        rows = [dict(row, code=str(row['code'])) for row in rows if row.get('code')]
+        if not rows:
+            return 0
+        conn = self._conn()
+        codes = [row['code'] for row in rows]
+        local = dict(conn.execute(
+            f'SELECT code, user_id FROM participants WHERE code IN ({", ".join("?" * len(codes))}) AND user_id IS NOT NULL',
+            codes
+        ).fetchall())
+        # 新舊 user_id 都要檢查：綁定 / RESET 尚未送到 Sheets 時兩邊不同
+        candidates = {row.get('user_id') for row in rows if row.get('user_id')} | set(local.values())
+        pending = self.is_pending(candidates) if candidates else set()
+        now = time.time()
+        values, kept = [], []
+        for row in rows:
+            if row.get('user_id') in pending or local.get(row['code']) in pending:
+                kept.append((now, row['code']))
+                continue
+            values.append((
+                row['code'], row.get('user_id') or None, row.get('group', ''), row.get('first_interaction') or None,
+                1 if row.get('d7_triggered') else 0, int(row.get('d7_turn') or 0), row.get('updated_at'), now,
+            ))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                '''
+                INSERT INTO participants (code, user_id, grp, first_interaction, d7_triggered, d7_turn, updated_at, synced_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(code) DO UPDATE SET
+                    user_id = excluded.user_id,
+                    grp = excluded.grp,
+                    first_interaction = excluded.first_interaction,
+                    d7_triggered = excluded.d7_triggered,
+                    d7_turn = excluded.d7_turn,
+                    updated_at = excluded.updated_at,
+                    synced_at = excluded.synced_at
+                ''',
+                values
+            )
+            conn.executemany('UPDATE participants SET synced_at = ? WHERE code = ?', kept)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return len(values)
+
+    def _get_meta(self, key):
+        row = self._conn().execute('SELECT value FROM participants_sync WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn().execute(
+            'INSERT INTO participants_sync (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, value)
+        )
+
+    # ---------- 背景 thread ----------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'{self.label.lower()}-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # 啟動時一律全量載入：Render 重啟後 DB 可能是空的，也可能停機期間有列被刪除
+        full = True
+        while not self._stopping.is_set():
+            try:
+                self.sync(full=full)
+                last_full = float(self._get_meta('full_synced_at') or 0)
+                full = time.time() - last_full >= self.full_interval
+                wait = self.interval
+            except Exception as e:
+                self._incr('sync_errors')
+                print(f'[{self.label}] Sync failed: {str(e)}')
+                wait = min(self.interval, 30)  # 尚未 ready 時盡快重試
+            self._stopping.wait(wait)
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        row = self._conn().execute('SELECT COUNT(*), COUNT(user_id) FROM participants').fetchone()
+        data['rows'] = row[0] if row else 0
+        data['bound'] = row[1] if row else 0
+        data['ready'] = self.ready()
+        data['last_sync_age_s'] = int(time.time() - self._last_sync) if self._last_sync else None
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 3) if lookups else None
+        return data
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
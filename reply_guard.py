@@ -0,0 +1,113 @@
+"""
+LINE reply token 期限保護（Alex / Aria 共用）
+
+reply token 約 30 秒後失效，但 call_dify 本身 timeout 就是 30 秒，前面還有 Sheets / OpenAI 呼叫，
+逾時後 send_line_reply 只會得到 400，使用者什麼都收不到。
+
+- 每個事件依 LINE event.timestamp 算出 reply token 期限（deadline），扣掉安全邊際
+- send()：期限內用 reply；已過期或 reply 失敗時改用 push 送出
+- send_slow()：在背景 thread 執行慢的呼叫（call_dify），只等到期限為止；
+  來不及時先用 reply 送出 holding message（未設定則不送），拿到結果後再用 push 送出真正的回覆
+- stats() 記錄每條路徑發生的次數
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class ReplyDeadlineGuard:
+    def __init__(self, reply_fn, push_fn, ttl=30, safety_margin=3.0, holding_message='', max_workers=8, label='REPLY'):
+        self.reply_fn = reply_fn  # (reply_token, message) -> bool
+        self.push_fn = push_fn    # (user_id, message) -> bool
+        self.ttl = ttl
+        self.safety_margin = safety_margin  # 保留給 reply 請求本身的時間
+        self.holding_message = holding_message
+        self.label = label
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='reply-guard')
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'replied': 0,              # 期限內 reply 成功
+            'expired_push': 0,         # 送出前已過期，直接 push
+            'reply_failed_push': 0,    # reply 失敗（token 失效等），改 push
+            'holding_then_push': 0,    # 慢呼叫逾時：先 reply holding message，結果再 push
+            'silent_then_push': 0,     # 慢呼叫逾時：不回 holding message，結果直接 push
+            'push_failed': 0,
+        }
+
+    def deadline_for(self, event):
+        """reply token 期限（epoch 秒）；以 LINE 事件發生時間為準，沒有 timestamp 時從現在起算"""
+        now = time.time()
+        timestamp = event.get('timestamp')
+        start = timestamp / 1000 if isinstance(timestamp, (int, float)) else now
+        return min(start, now) + self.ttl
+
+    def session(self, event, user_id):
+        return ReplySession(self, event.get('replyToken'), user_id, self.deadline_for(event))
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+
+class ReplySession:
+    """單一事件的回覆：reply token + 期限"""
+
+    def __init__(self, guard, reply_token, user_id, deadline):
+        self.guard = guard
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.deadline = deadline
+        self.replied = False  # reply token 只能用一次
+
+    def remaining(self):
+        """reply token 扣掉安全邊際後還剩幾秒"""
+        return self.deadline - self.guard.safety_margin - time.time()
+
+    def send(self, message):
+        """期限內 reply，否則（或 reply 失敗時）push"""
+        guard = self.guard
+        if self.replied or self.remaining() <= 0:
+            guard._incr('expired_push')
+            print(f'[{guard.label}] Reply token expired for {self.user_id}, sending via push')
+            return self._push(message)
+
+        self.replied = True
+        if guard.reply_fn(self.reply_token, message):
+            guard._incr('replied')
+            return True
+        guard._incr('reply_failed_push')
+        print(f'[{guard.label}] Reply failed for {self.user_id}, falling back to push')
+        return self._push(message)
+
+    def send_slow(self, fn, *args):
+        """
+        執行 fn(*args) 取得回覆內容並送出；只等到 reply token 期限為止。
+        逾時則先送 holding message（或不送），繼續等結果後用 push 送出。回傳 fn 的結果。
+        """
+        guard = self.guard
+        future = guard._pool.submit(fn, *args)
+        try:
+            result = future.result(timeout=max(0, self.remaining()))
+        except FutureTimeout:
+            if guard.holding_message and not self.replied:
+                self.replied = True
+                guard.reply_fn(self.reply_token, guard.holding_message)
+                guard._incr('holding_then_push')
+            else:
+                guard._incr('silent_then_push')
+            print(f'[{guard.label}] Deadline reached for {self.user_id}, answer will be pushed')
+            result = future.result()
+            self._push(result)
+            return result
+        self.send(result)
+        return result
+
+    def _push(self, message):
+        ok = self.guard.push_fn(self.user_id, message)
+        if not ok:
+            self.guard._incr('push_failed')
+        return ok
@@ -0,0 +1,293 @@
+"""
+本地反應類型分類器（Alex / Aria 共用）
+
+detect_user_response_type 每則 D7 turn 2 / 3 訊息都要呼叫一次 gpt-4o-mini。改為先跑本地模型：
+
+- 模型：字元 n-gram（預設 1~3）+ 多類別 logistic regression，權重存成 JSON
+  （部署環境沒有 NumPy，推論與訓練都是純 Python；D7 回覆多半很短，單則推論遠低於 1ms）
+- 最高機率 ≥ threshold 才直接採用，否則照舊交給 GPT（classifier_cache → OpenAI → 關鍵字 fallback）
+- 交給 GPT 時記錄本地模型的猜測是否與 GPT 一致（agreement），用來判斷 threshold 是否可以再調低
+
+訓練資料來自 Conversation_Logs（由 Sheets 匯出 CSV）：
+同一使用者 d7_turn2 / d7_turn3 的 user 列，下一列 ai 的腳本內容反查 D7_SCRIPTS 即可得到當時的分類結果；
+同一組同一輪中多個分類共用相同腳本（例如 D 組的「嗯」）時無法反推，該筆略過。
+
+用法：
+    python response_classifier.py Conversation_Logs.csv --server server.py --out response_model_alex.json
+"""
+import argparse
+import ast
+import csv
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from classifier_cache import normalize_text
+
+LABELS = ['cooperative', 'dismiss', 'refuse', 'question', 'neutral']
+SCRIPT_TURNS = {'d7_turn2': '2_', 'd7_turn3': '3_'}
+
+
+def char_ngrams(text, ngram_range=(1, 3)):
+    """正規化後加上頭尾標記再切字元 n-gram（同一則訊息內重複的 n-gram 只算一次）"""
+    text = f'^{normalize_text(text)}$'
+    low, high = ngram_range
+    grams = set()
+    for n in range(low, high + 1):
+        for i in range(len(text) - n + 1):
+            grams.add(text[i:i + n])
+    return grams
+
+
+class ResponseClassifier:
+    def __init__(self, labels, weights, bias, ngram_range=(1, 3), meta=None):
+        self.labels = list(labels)
+        self.weights = weights  # {n-gram: [每個 label 的權重]}
+        self.bias = list(bias)
+        self.ngram_range = tuple(ngram_range)
+        self.meta = meta or {}
+
+    def predict_proba(self, text):
+        scores = list(self.bias)
+        for gram in char_ngrams(text, self.ngram_range):
+            row = self.weights.get(gram)
+            if row:
+                for i, w in enumerate(row):
+                    scores[i] += w
+        return dict(zip(self.labels, _softmax(scores)))
+
+    def predict(self, text):
+        """回傳 (label, 機率)"""
+        proba = self.predict_proba(text)
+        label = max(proba, key=proba.get)
+        return label, proba[label]
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'labels': self.labels,
+                'ngram_range': list(self.ngram_range),
+                'bias': [round(b, 6) for b in self.bias],
+                'weights': {g: [round(w, 6) for w in row] for g, row in self.weights.items()},
+                'meta': self.meta,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['labels'], data['weights'], data['bias'], data.get('ngram_range', (1, 3)), data.get('meta'))
+
+    @classmethod
+    def train(cls, samples, labels=LABELS, ngram_range=(1, 3), min_count=2, epochs=30, lr=0.5, l2=1e-4, seed=42):
+        """
+        samples：[(訊息, label), ...]
+        SGD 訓練多類別 logistic regression；出現次數少於 min_count 的 n-gram 不列入特徵
+        """
+        index = {label: i for i, label in enumerate(labels)}
+        rows = [(char_ngrams(text, ngram_range), index[label]) for text, label in samples if label in index]
+        counts = Counter(g for grams, _ in rows for g in grams)
+        vocab = {g for g, c in counts.items() if c >= min_count}
+        rows = [([g for g in grams if g in vocab], y) for grams, y in rows]
+
+        k = len(labels)
+        weights = {g: [0.0] * k for g in vocab}
+        bias = [0.0] * k
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(rows)
+            step = lr / (1 + epoch * 0.1)
+            for grams, y in rows:
+                scores = list(bias)
+                for g in grams:
+                    for i, w in enumerate(weights[g]):
+                        scores[i] += w
+                proba = _softmax(scores)
+                for i in range(k):
+                    grad = proba[i] - (1.0 if i == y else 0.0)
+                    bias[i] -= step * grad
+                    for g in grams:
+                        weights[g][i] -= step * (grad + l2 * weights[g][i])
+
+        # 全為 0 的特徵不影響結果，不存
+        weights = {g: row for g, row in weights.items() if any(abs(w) > 1e-6 for w in row)}
+        meta = {'samples': len(rows), 'features': len(weights), 'trained_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+        return cls(labels, weights, bias, ngram_range, meta)
+
+
+def _softmax(scores):
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+class LocalResponseModel:
+    """
+    執行期的門檻判斷與統計。
+    classify() 回傳本地模型有把握的 label；沒有模型或信心不足時回傳 None（呼叫端改問 GPT）。
+    """
+
+    def __init__(self, path, threshold=0.85, label='RESPONSE_MODEL'):
+        self.path = path
+        self.threshold = threshold
+        self.label = label
+        self.model = None
+        self._last_guess = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {'local': 0, 'escalated': 0, 'agreed': 0, 'disagreed': 0, 'predict_us': 0}
+        if path and os.path.exists(path):
+            try:
+                self.model = ResponseClassifier.load(path)
+                print(f'[{self.label}] Loaded {path}: {len(self.model.weights)} features, threshold {threshold}')
+            except Exception as e:
+                print(f'[{self.label}] Failed to load {path}: {str(e)}')
+        elif path:
+            print(f'[{self.label}] Model file not found: {path}, every message goes to GPT')
+
+    def classify(self, text):
+        self._last_guess.value = None
+        if self.model is None:
+            return None
+        start = time.perf_counter()
+        label, confidence = self.model.predict(text)
+        elapsed_us = int((time.perf_counter() - start) * 1e6)
+        with self._stats_lock:
+            self._stats['predict_us'] += elapsed_us
+            if confidence >= self.threshold:
+                self._stats['local'] += 1
+                return label
+            self._stats['escalated'] += 1
+        self._last_guess.value = label
+        return None
+
+    def record_escalation(self, gpt_label):
+        """GPT 的結果回來後，比對同一 thread 上一次信心不足時本地模型的猜測"""
+        guess = getattr(self._last_guess, 'value', None)
+        self._last_guess.value = None
+        if guess is None or gpt_label is None:
+            return
+        self._incr('agreed' if guess == gpt_label else 'disagreed')
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        predictions = data['local'] + data['escalated']
+        compared = data['agreed'] + data['disagreed']
+        data['enabled'] = self.model is not None
+        data['threshold'] = self.threshold
+        data['local_rate'] = round(data['local'] / predictions, 3) if predictions else None
+        data['agreement_rate'] = round(data['agreed'] / compared, 3) if compared else None
+        data['avg_predict_us'] = int(data.pop('predict_us') / predictions) if predictions else None
+        return data
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+
+# ========== 訓練資料 ==========
+
+def load_d7_scripts(server_path):
+    """從 server 原始碼讀出 D7_SCRIPTS（不 import server，避免啟動 Flask / 背景 thread）"""
+    with open(server_path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'D7_SCRIPTS' for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError(f'D7_SCRIPTS not found in {server_path}')
+
+
+def script_label_index(d7_scripts):
+    """{(輪次前綴, 腳本內容): label}；同一內容對應多個 label 的不收"""
+    candidates = {}
+    for scripts in d7_scripts.values():
+        for key, text in scripts.items():
+            prefix, _, label = key.partition('_')
+            if label in LABELS:
+                candidates.setdefault((f'{prefix}_', text.strip()), set()).add(label)
+    return {key: labels.pop() for key, labels in candidates.items() if len(labels) == 1}
+
+
+def samples_from_logs(csv_path, d7_scripts):
+    """
+    讀取 Conversation_Logs 匯出的 CSV（欄位名稱同 log_conversation：user_id、message_type、message_content、script_type），
+    回傳 ([(訊息, label), ...], 略過的筆數)
+    """
+    index = script_label_index(d7_scripts)
+    samples = []
+    skipped = 0
+    pending = {}  # user_id → (script_type, 使用者訊息)
+    with open(csv_path, encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            script_type = (row.get('script_type') or '').strip()
+            if script_type not in SCRIPT_TURNS:
+                continue
+            user_id = row.get('user_id', '')
+            message_type = (row.get('message_type') or '').strip()
+            content = (row.get('message_content') or '').strip()
+            if message_type == 'user':
+                if user_id in pending:
+                    skipped += 1
+                pending[user_id] = (script_type, content)
+            elif message_type == 'ai' and user_id in pending:
+                user_script_type, user_message = pending.pop(user_id)
+                label = index.get((SCRIPT_TURNS[script_type], content))
+                if user_script_type != script_type or label is None or not user_message:
+                    skipped += 1
+                    continue
+                samples.append((user_message, label))
+    return samples, skipped + len(pending)
+
+
+def evaluate(model, samples, thresholds=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95)):
+    """各門檻下本地採用的比例（coverage）與採用部分的準確率"""
+    predictions = [(model.predict(text), label) for text, label in samples]
+    report = []
+    for threshold in thresholds:
+        taken = [(guess, label) for (guess, confidence), label in predictions if confidence >= threshold]
+        correct = sum(1 for guess, label in taken if guess == label)
+        report.append({
+            'threshold': threshold,
+            'coverage': round(len(taken) / len(samples), 3) if samples else None,
+            'accuracy': round(correct / len(taken), 3) if taken else None,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the local D7 response-type classifier from Conversation_Logs')
+    parser.add_argument('csv', help='Conversation_Logs exported as CSV')
+    parser.add_argument('--server', default='server.py', help='server file whose D7_SCRIPTS produced the logs')
+    parser.add_argument('--out', default='response_model.json')
+    parser.add_argument('--holdout', type=float, default=0.2, help='fraction of samples held out for evaluation')
+    parser.add_argument('--min-count', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=30)
+    args = parser.parse_args()
+
+    samples, skipped = samples_from_logs(args.csv, load_d7_scripts(args.server))
+    print(f'Labelled samples: {len(samples)} ({skipped} skipped), {dict(Counter(label for _, label in samples))}')
+    if not samples:
+        raise SystemExit('No labelled D7 turn 2/3 rows found')
+
+    shuffled = list(samples)
+    random.Random(7).shuffle(shuffled)
+    cut = int(len(shuffled) * (1 - args.holdout))
+    train_set, test_set = shuffled[:cut], shuffled[cut:]
+    model = ResponseClassifier.train(train_set, min_count=args.min_count, epochs=args.epochs)
+    for row in evaluate(model, test_set):
+        print(f"threshold {row['threshold']:.2f}  coverage {row['coverage']}  accuracy {row['accuracy']}")
+
+    # 評估完用全部資料重新訓練再輸出
+    model = ResponseClassifier.train(samples, min_count=args.min_count, epochs=args.epochs)
+    model.meta['source'] = os.path.basename(args.csv)
+    model.save(args.out)
+    print(f'Saved {args.out}: {model.meta}')
+
+
+if __name__ == '__main__':
+    main()
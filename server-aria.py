@@ -1,10 +1,30 @@
 from flask import Flask, request, jsonify
-import requests
 import os
-import sqlite3
-import threading
+import json
 from datetime import datetime, timedelta
 import pytz
+import time
+import uuid
+import threading
+import atexit
+import re
+from work_queue import DurableQueue, QueueConsumer
+from keyed_executor import KeyedExecutor
+from memory_sync import MemorySyncPipeline
+import http_pool
+from state_store import get_engine, UserState
+from sheets_outbox import SheetsOutbox
+from log_shipper import LogShipper
+from reply_guard import ReplyDeadlineGuard
+import dify_stream
+from classifier_cache import ClassifierCache, prompt_version
+from speculative import SpeculativeRunner
+from keyword_matcher import KeywordMatcher
+from response_classifier import LocalResponseModel
+from conflict_pool import ConflictPool
+from batch_jobs import BatchJobRunner, TokenBucket
+from sheets_pager import iter_paged
+from participants_mirror import ParticipantsMirror, current_day_from, first_interaction_for_day, parse_first_interaction
 
 app = Flask(__name__)
 
@@ -14,6 +34,10 @@ TW_TZ = pytz.timezone('Asia/Taipei')
 # Dify API 設定
 DIFY_API_URL = 'https://api.dify.ai/v1/chat-messages'
 
+# Dify 回應模式：blocking（等整段生成完）或 streaming（SSE，收到 message_end 即結束）
+DIFY_RESPONSE_MODE = os.environ.get('DIFY_RESPONSE_MODE', 'blocking')
+dify_stream_stats = dify_stream.StreamStats()
+
 # 4 組 Dify App 的 API Keys（E/F/G/H）
 DIFY_KEYS = {
     'E': os.environ.get('DIFY_KEY_E'),
@@ -25,13 +49,63 @@ DIFY_KEYS = {
 # LINE Channel Access Token（Aria Bot）
 LINE_CHANNEL_ACCESS_TOKEN_ARIA = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN_ARIA')
 
+# 上游 HTTP 連線池（keep-alive，兩個 Bot 共用）
+dify_http = http_pool.get_pool('dify')
+line_http = http_pool.get_pool('line')
+openai_http = http_pool.get_pool('openai')
+sheets_http = http_pool.get_pool('sheets')
+
+# OpenAI API Key（可選；未設定時分類走關鍵字 fallback）。import 時讀取一次，
+# server_multi 載入時 ALEX_OPENAI_API_KEY / ARIA_OPENAI_API_KEY 才會生效
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+
 # Google Sheets API URL
 SHEETS_API_URL = os.environ.get('SHEETS_API_URL')
+SHEETS_PAGE_SIZE = int(os.environ.get('SHEETS_PAGE_SIZE', 200))  # get_active_users / get_participants 每頁筆數
+# Participants 本地鏡像：user_id / 手機碼查詢改讀本地 SQLite，背景 delta sync
+PARTICIPANTS_MIRROR = os.environ.get('PARTICIPANTS_MIRROR', '0') == '1'
+PARTICIPANTS_SYNC_INTERVAL = int(os.environ.get('PARTICIPANTS_SYNC_INTERVAL', 300))  # delta sync 間隔（秒）
 
 # Daily nudge 設定
 JOB_SECRET = os.environ.get('JOB_SECRET')
+NUDGE_WORKERS = int(os.environ.get('NUDGE_WORKERS', 8))  # 推播工作的並行 worker 數
+LINE_PUSH_RATE = float(os.environ.get('LINE_PUSH_RATE', 50))  # 推播工作每秒最多送出的 LINE push 數
+NUDGE_MULTICAST = os.environ.get('NUDGE_MULTICAST', '1') == '1'  # 每日推播以 multicast 分批送出（0 = 逐一 push）
 NUDGE_MESSAGE = os.environ.get('NUDGE_MESSAGE', '嗨！今天還好嗎？有什麼想聊的嗎？')
 
+# Webhook 非同步模式：事件寫入 SQLite 佇列後立即回 200，由背景 worker 處理
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '0') == '1'
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 4))  # 同步與非同步模式共用的並行上限
+REPLY_TOKEN_TTL = 30  # LINE reply token 有效期約 30 秒
+REPLY_SAFETY_MARGIN = float(os.environ.get('REPLY_SAFETY_MARGIN', 3))  # 保留給 reply 請求本身的秒數
+HOLDING_MESSAGE = os.environ.get('HOLDING_MESSAGE', '')  # Dify 來不及時先回的暫時訊息（空字串 = 不回，直接 push）
+
+# Dify 記憶同步 pipeline（D7 腳本回應補寫進 Dify）
+MEMORY_SYNC_WORKERS = int(os.environ.get('MEMORY_SYNC_WORKERS', 2))
+MEMORY_SYNC_MAX_PENDING = int(os.environ.get('MEMORY_SYNC_MAX_PENDING', 500))
+MEMORY_SYNC_WAIT = 10  # 正常對話前最多等待該使用者記憶寫完的秒數
+# 使用者訊息 + 腳本回應合併成一則 query，一次呼叫寫進 Dify 記憶
+DIFY_MEMORY_TEMPLATE = os.environ.get('DIFY_MEMORY_TEMPLATE', '{user}\n\n[以下是我的回應]：{script}')
+
+# 對話記錄批次上傳：累積 LOG_BATCH_SIZE 列或最舊一列等待超過 LOG_FLUSH_INTERVAL 秒就送出一批
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 20))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))
+LOG_BATCH_PAYLOAD = os.environ.get('LOG_BATCH_PAYLOAD', '0') == '1'  # 整批一次 POST（需 Apps Script 支援 log_conversation_batch）
+
+# GPT 分類（反應類型 / 是否分享 / 情緒）結果快取：行程內 LRU 上限筆數，另存 SQLite
+OPENAI_CHAT_URL = 'https://api.openai.com/v1/chat/completions'
+OPENAI_CLASSIFIER_MODEL = 'gpt-4o-mini'
+CLASSIFIER_CACHE_SIZE = int(os.environ.get('CLASSIFIER_CACHE_SIZE', 4096))
+RESPONSE_MODEL_PATH = os.environ.get('RESPONSE_MODEL_PATH', '')
+RESPONSE_MODEL_THRESHOLD = float(os.environ.get('RESPONSE_MODEL_THRESHOLD', 0.85))
+# Day 7：是否分享 / 情緒 / 衝突句合併成一次 JSON mode 呼叫（失敗時退回原本的個別呼叫）
+D7_COMBINED_ANALYSIS = os.environ.get('D7_COMBINED_ANALYSIS', '1') == '1'
+# Day 7 turn 1 走個別呼叫時，判斷是否分享的同時先在背景生成衝突句（推測執行）
+D7_SPECULATIVE = os.environ.get('D7_SPECULATIVE', '0') == '1'
+# 推播引導句時預先生成衝突句候選（每種情緒 D7_CONFLICT_POOL_SIZE 句），觸發時直接取用
+D7_CONFLICT_POOL = os.environ.get('D7_CONFLICT_POOL', '0') == '1'
+D7_CONFLICT_POOL_SIZE = int(os.environ.get('D7_CONFLICT_POOL_SIZE', 3))
+
 # 本地狀態儲存（避免重啟後遺失）
 STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'state_aria.db')
 
@@ -161,8 +235,8 @@ ONBOARDING_MESSAGES = {
 # ========== 狀態儲存函數 ==========
 
 def _state_conn():
-    conn = sqlite3.connect(STATE_DB_PATH, timeout=5)
-    return conn
+    # 每個 thread 共用一條 WAL 長連線（見 state_store.py），不再每次呼叫都重新 connect
+    return get_engine(STATE_DB_PATH).connection()
 
 def init_state_store():
     with _state_conn() as conn:
@@ -208,6 +282,35 @@ def init_state_store():
             conn.execute('ALTER TABLE bot_state ADD COLUMN cache_day TEXT')
         except Exception:
             pass
+        try:
+            conn.execute('ALTER TABLE bot_state ADD COLUMN cache_first_interaction TEXT')
+        except Exception:
+            pass
+        # d7-trigger 推播認領紀錄（run_key = 台灣日期；已推播的使用者在同一輪重跑時略過）
+        conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS d7_setup_claims (
+                run_key TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                claimed_at REAL NOT NULL,
+                finished_at REAL,
+                latency_ms INTEGER,
+                PRIMARY KEY (run_key, user_id)
+            )
+            '''
+        )
+
+def load_user_state(user_id):
+    """事件開始時一次讀出該使用者整列 bot_state"""
+    with _state_conn() as conn:
+        return UserState.load(conn, user_id)
+
+def flush_user_state(state):
+    """事件結束時把快照中有變更的欄位以一次 UPSERT 寫回"""
+    with _state_conn() as conn:
+        state.flush(conn)
 
 def get_conversation_id(user_id):
     with _state_conn() as conn:
@@ -238,35 +341,30 @@ def get_d7_turn(user_id):
         ).fetchone()
     return int(row[0]) if row and row[0] else 0
 
-def set_d7_turn(user_id, turn):
-    with _state_conn() as conn:
-        conn.execute(
-            '''
-            INSERT INTO bot_state (user_id, d7_turn)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET d7_turn = excluded.d7_turn
-            ''',
-            (user_id, turn)
-        )
-    # 同步寫 Sheets（Render 重啟後可以恢復），失敗時 retry 一次
-    for attempt in range(2):
-        try:
-            resp = requests.post(
-                SHEETS_API_URL,
-                json={'user_id': user_id, 'd7_turn': turn},
-                timeout=5
+def set_d7_turn(user_id, turn, state=None):
+    if state is not None:
+        state.d7_turn = turn  # 事件結束時由 flush_user_state 寫回
+    else:
+        with _state_conn() as conn:
+            conn.execute(
+                '''
+                INSERT INTO bot_state (user_id, d7_turn)
+                VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET d7_turn = excluded.d7_turn
+                ''',
+                (user_id, turn)
             )
-            if resp.status_code == 200:
-                break
-            print(f'[ARIA WARNING] d7_turn Sheets sync HTTP {resp.status_code} (attempt {attempt + 1})')
-        except Exception as e:
-            if attempt == 1:
-                print(f'[ARIA WARNING] d7_turn Sheets sync failed after retry: {str(e)}')
+    # 鏡像到 Sheets（Render 重啟後可以恢復），由 outbox 背景送出並重試
+    sheets_outbox.put(user_id, 'd7_turn', {'user_id': user_id, 'd7_turn': turn})
+    participants_mirror.update(user_id, d7_turn=turn)
 
-def clear_d7_turn(user_id):
-    set_d7_turn(user_id, 0)
+def clear_d7_turn(user_id, state=None):
+    set_d7_turn(user_id, 0, state)
 
-def clear_d7_fired(user_id):
+def clear_d7_fired(user_id, state=None):
+    if state is not None:
+        state.d7_fired = 0
+        return
     with _state_conn() as conn:
         conn.execute(
             'UPDATE bot_state SET d7_fired = 0 WHERE user_id = ?',
@@ -289,7 +387,10 @@ def get_d7_setup(user_id):
         ).fetchone()
     return bool(row and row[0])
 
-def set_d7_setup(user_id, value):
+def set_d7_setup(user_id, value, state=None):
+    if state is not None:
+        state.d7_setup = 1 if value else 0
+        return
     with _state_conn() as conn:
         conn.execute(
             '''
@@ -300,21 +401,68 @@ def set_d7_setup(user_id, value):
             (user_id, 1 if value else 0)
         )
 
-def try_lock_d7_fired(user_id):
+def try_lock_d7_fired(user_id, state=None):
     """
     原子操作：嘗試將 d7_fired 從 0 設為 1。
     回傳 True 代表搶到鎖（本次請求可觸發衝突）；
     回傳 False 代表已有其他請求搶先，應跳過。
+    有快照時先寫回尚未 flush 的變更，鎖本身一律直接寫 DB。
     """
     with _state_conn() as conn:
+        if state is not None:
+            state.flush(conn)
         conn.execute(
             'INSERT INTO bot_state (user_id, d7_fired) VALUES (?, 1) '
             'ON CONFLICT(user_id) DO UPDATE SET d7_fired = 1 WHERE d7_fired = 0',
             (user_id,)
         )
         row = conn.execute('SELECT changes()').fetchone()
+    locked = bool(row and row[0])
+    if locked and state is not None:
+        state.d7_fired = 1
+        state.mark_clean('d7_fired')
+    return locked
+
+D7_CLAIM_STALE_SECONDS = 300  # 認領後超過此秒數仍未完成（行程中斷）視為失效，可被重新認領
+
+def try_claim_d7_setup(run_key, user_id):
+    """
+    原子操作：認領本輪（run_key）某位使用者的引導句推播。
+    回傳 True 代表由本次執行推播；
+    已推播過、或另一個執行正在處理（認領尚未失效）時回傳 False。
+    上次推播失敗或認領已失效的使用者可以重新認領。
+    """
+    now = time.time()
+    with _state_conn() as conn:
+        conn.execute(
+            '''
+            INSERT INTO d7_setup_claims (run_key, user_id, status, claimed_at) VALUES (?, ?, 'claimed', ?)
+            ON CONFLICT(run_key, user_id) DO UPDATE SET
+                status = 'claimed', claimed_at = excluded.claimed_at, attempts = attempts + 1, finished_at = NULL
+            WHERE status = 'failed' OR (status = 'claimed' AND claimed_at < ?)
+            ''',
+            (run_key, user_id, now, now - D7_CLAIM_STALE_SECONDS)
+        )
+        row = conn.execute('SELECT changes()').fetchone()
     return bool(row and row[0])
 
+def finish_d7_setup_claim(run_key, user_id, pushed, latency_ms):
+    """記錄認領結果（checkpoint）：pushed 的使用者在同一輪重跑時一律略過"""
+    with _state_conn() as conn:
+        conn.execute(
+            'UPDATE d7_setup_claims SET status = ?, finished_at = ?, latency_ms = ? WHERE run_key = ? AND user_id = ?',
+            ('pushed' if pushed else 'failed', time.time(), latency_ms, run_key, user_id)
+        )
+
+def d7_setup_checkpoint(run_key):
+    """本輪各狀態的使用者數（跨多次執行累計）"""
+    with _state_conn() as conn:
+        rows = conn.execute(
+            'SELECT status, COUNT(*) FROM d7_setup_claims WHERE run_key = ? GROUP BY status',
+            (run_key,)
+        ).fetchall()
+    return {status: count for status, count in rows}
+
 def clear_user_state(user_id):
     with _state_conn() as conn:
         conn.execute('DELETE FROM bot_state WHERE user_id = ?', (user_id,))
@@ -330,14 +478,31 @@ def _parse_json_response(response, source):
 # 先建立本地狀態表
 init_state_store()
 
+# Sheets 鏡像寫入 outbox（d7_turn / last_interaction / d7_trigger 等，背景 flush）
+sheets_outbox = SheetsOutbox(STATE_DB_PATH, sheets_http, lambda: SHEETS_API_URL)
+sheets_outbox.start()
+atexit.register(sheets_outbox.stop)
+
+# GPT 分類結果快取
+classifier_cache = ClassifierCache(STATE_DB_PATH, max_entries=CLASSIFIER_CACHE_SIZE)
+response_model = LocalResponseModel(RESPONSE_MODEL_PATH, threshold=RESPONSE_MODEL_THRESHOLD)
+
+# 對話記錄 journal（Conversation_Logs，背景批次上傳）
+log_shipper = LogShipper(
+    STATE_DB_PATH, sheets_http, lambda: SHEETS_API_URL,
+    batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL, batch_payload=LOG_BATCH_PAYLOAD
+)
+log_shipper.start()
+atexit.register(log_shipper.stop)
+
 # ========== 輔助函數 ==========
 
 def log_conversation(user_id, participant_code, message_type, message_content, is_script=False, script_type='', current_day=None):
     """記錄對話到 Google Sheets Conversation_Logs"""
     try:
         tw_now = datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S')
-        payload = {
-            'log_conversation': True,
+        # 只寫入本地 journal，由 log_shipper 背景批次送到 Sheets（時間戳記在此時決定）
+        log_shipper.append({
             'user_id': user_id,
             'participant_code': participant_code,
             'timestamp': tw_now,
@@ -346,111 +511,150 @@ def log_conversation(user_id, participant_code, message_type, message_content, i
             'is_script': is_script,
             'script_type': script_type,
             'current_day': current_day
-        }
-
-        for attempt in range(2):
-            try:
-                response = requests.post(SHEETS_API_URL, json=payload, timeout=10)
-                if response.status_code == 200:
-                    print(f'[ARIA] Conversation logged: {message_type} - {message_content[:30]}...')
-                    break
-                print(f'[ARIA] Failed to log conversation: {response.status_code} (attempt {attempt + 1})')
-            except Exception as e:
-                if attempt == 1:
-                    print(f'[ARIA] Log conversation failed after retry: {str(e)}')
+        })
+        print(f'[DEBUG] Conversation queued: {message_type} - {message_content[:30]}...')
 
     except Exception as e:
-        print(f'[ARIA] Log conversation error: {str(e)}')
+        print(f'[ERROR] Log conversation error: {str(e)}')
+
+# 反應類型分類 prompt（內容變更時快取 key 會跟著換）
+_RESPONSE_TYPE_PROMPT = (
+    '你是心理實驗助手，負責判斷受試者對 AI 伴侶一句輕微否定語的反應類型。\n\n'
+    '反應類型定義：\n'
+    '- cooperative：願意溝通、接受繼續聊、正向回應\n'
+    '  例：「好啊」「可以說說看」「嗯嗯」「我願意」\n'
+    '- dismiss：敷衍帶過、表面接受不想深入、自我否定帶過\n'
+    '  例：「好吧算了」「你說的也是」「沒什麼」「可能是我的問題」「算了不重要」\n'
+    '- refuse：明確拒絕、不想聊、抗拒\n'
+    '  例：「不想說」「不要」「不用問我」「不聊了」\n'
+    '- question：質疑、反問、對對方說法感到不滿\n'
+    '  例：「為什麼這樣說」「你什麼意思」「幹嘛」「憑什麼」\n'
+    '- neutral：忽略衝突、繼續分享自己的事、陳述想法或感受\n'
+    '  例：「就是覺得很累」「今天發生了⋯」「我只是想說⋯」\n\n'
+    '只回傳一個英文單字：cooperative、dismiss、refuse、question 或 neutral。不要有任何其他文字。'
+)
+_RESPONSE_TYPE_USER = '受試者說：「{message}」\n\n反應類型是？'
+_RESPONSE_TYPE_VERSION = prompt_version(_RESPONSE_TYPE_PROMPT, _RESPONSE_TYPE_USER)
+_RESPONSE_TYPES = ['cooperative', 'dismiss', 'refuse', 'question', 'neutral']
+
+_openai_usage = threading.local()  # 目前 thread 累計的 OpenAI token 用量（推測執行統計浪費用）
+
+def _gpt_chat(openai_api_key, system_prompt, user_content, max_tokens, timeout, temperature=0, json_mode=False):
+    """呼叫 gpt-4o-mini，回傳 (HTTP 狀態碼, 模型輸出文字或 None)"""
+    body = {
+        'model': OPENAI_CLASSIFIER_MODEL,
+        'messages': [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_content}
+        ],
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }
+    if json_mode:
+        body['response_format'] = {'type': 'json_object'}
+    response = openai_http.post(
+        OPENAI_CHAT_URL,
+        headers={
+            'Authorization': f'Bearer {openai_api_key}',
+            'Content-Type': 'application/json'
+        },
+        json=body,
+        timeout=timeout
+    )
+    if response.status_code != 200:
+        return response.status_code, None
+    data = _parse_json_response(response, 'OpenAI')
+    tokens = (data.get('usage') or {}).get('total_tokens', 0)
+    _openai_usage.total_tokens = getattr(_openai_usage, 'total_tokens', 0) + tokens
+    return response.status_code, data['choices'][0]['message']['content'].strip()
 
 def detect_user_response_type(user_message):
     """
     使用 GPT-4o-mini 判斷使用者對衝突句的反應類型。
     返回：'cooperative', 'dismiss', 'refuse', 'question', 'neutral'
+    有本地模型（RESPONSE_MODEL_PATH）且信心 ≥ RESPONSE_MODEL_THRESHOLD 時直接採用，不呼叫 API。
+    GPT 成功的結果存入 classifier_cache，相同訊息不再呼叫 API。
     API 失敗時 fallback 到關鍵字比對。
     """
-    openai_api_key = os.environ.get('OPENAI_API_KEY')
+    local = response_model.classify(user_message)
+    if local:
+        print(f'[ARIA] Response type (local model): {local}')
+        return local
+
+    openai_api_key = OPENAI_API_KEY
     if not openai_api_key:
         return _detect_response_type_fallback(user_message)
 
+    result = classifier_cache.cached(
+        'response_type', _RESPONSE_TYPE_VERSION, OPENAI_CLASSIFIER_MODEL, user_message,
+        lambda: _gpt_response_type(openai_api_key, user_message)
+    )
+    if result:
+        response_model.record_escalation(result)
+        print(f'[ARIA] Response type (GPT): {result}')
+        return result
+    return _detect_response_type_fallback(user_message)
+
+def _gpt_response_type(openai_api_key, user_message):
+    """GPT 反應類型分類；失敗或結果不合法時回傳 None"""
     try:
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {openai_api_key}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': 'gpt-4o-mini',
-                'messages': [
-                    {
-                        'role': 'system',
-                        'content': (
-                            '你是心理實驗助手，負責判斷受試者對 AI 伴侶一句輕微否定語的反應類型。\n\n'
-                            '反應類型定義：\n'
-                            '- cooperative：願意溝通、接受繼續聊、正向回應\n'
-                            '  例：「好啊」「可以說說看」「嗯嗯」「我願意」\n'
-                            '- dismiss：敷衍帶過、表面接受不想深入、自我否定帶過\n'
-                            '  例：「好吧算了」「你說的也是」「沒什麼」「可能是我的問題」「算了不重要」\n'
-                            '- refuse：明確拒絕、不想聊、抗拒\n'
-                            '  例：「不想說」「不要」「不用問我」「不聊了」\n'
-                            '- question：質疑、反問、對對方說法感到不滿\n'
-                            '  例：「為什麼這樣說」「你什麼意思」「幹嘛」「憑什麼」\n'
-                            '- neutral：忽略衝突、繼續分享自己的事、陳述想法或感受\n'
-                            '  例：「就是覺得很累」「今天發生了⋯」「我只是想說⋯」\n\n'
-                            '只回傳一個英文單字：cooperative、dismiss、refuse、question 或 neutral。不要有任何其他文字。'
-                        )
-                    },
-                    {
-                        'role': 'user',
-                        'content': f'受試者說：「{user_message}」\n\n反應類型是？'
-                    }
-                ],
-                'temperature': 0,
-                'max_tokens': 15
-            },
-            timeout=10
+        status, result = _gpt_chat(
+            openai_api_key, _RESPONSE_TYPE_PROMPT,
+            _RESPONSE_TYPE_USER.format(message=user_message),
+            max_tokens=15, timeout=10
         )
-
-        if response.status_code == 200:
-            data = _parse_json_response(response, 'OpenAI-ResponseType')
-            result = data['choices'][0]['message']['content'].strip().lower()
-            valid_types = ['cooperative', 'dismiss', 'refuse', 'question', 'neutral']
-            if result in valid_types:
-                print(f'[ARIA] Response type (GPT): {result}')
-                return result
-            print(f'[ARIA] GPT response type unexpected result: {result}, using fallback')
-        else:
-            print(f'[ARIA] GPT response type HTTP {response.status_code}, using fallback')
-
+        if result is None:
+            print(f'[ARIA] GPT response type HTTP {status}, using fallback')
+            return None
+        result = result.lower()
+        if result in _RESPONSE_TYPES:
+            return result
+        print(f'[ARIA] GPT response type unexpected result: {result}, using fallback')
     except Exception as e:
         print(f'[ARIA] GPT response type error: {str(e)}, using fallback')
+    return None
 
-    return _detect_response_type_fallback(user_message)
 
+# 關鍵字 fallback 字典：import 時編譯成 KeywordMatcher，訊息只掃一次
+# dict 順序即優先順序：question > neutral（覆蓋）> refuse > dismiss > cooperative
+_RESPONSE_TYPE_KEYWORDS = {
+    'question': ['為什麼', '為何', '怎麼', '幹嘛', '幹麻', '你在', '?', '？', '憑什麼'],
+    'neutral_override': ['不好意思', '還好', '沒想到', '想太多', '要死了', '要瘋了',
+                         '好奇怪', '好莫名', '不知道好不好', '是不是'],
+    'refuse': ['不要', '不想', '不行', '不會', '沒有', '不用', '算了', '免了',
+               '不好', '不太好', '不是', '不對', '不願意', '不可以'],
+    'dismiss': ['好吧', '也是嘛', '也對嘛', '算了嘛', '沒什麼', '沒關係嘛', '可能是我'],
+    'cooperative': ['好啊', '好喔', '好呀', '好耶', '可以', '嗯嗯', '願意'],
+}
+_response_type_matcher = KeywordMatcher(_RESPONSE_TYPE_KEYWORDS)
+
+_GREETING_KEYWORDS = [
+    # 稱呼
+    '寶貝', '親愛的', '帥哥', '老公', '老婆', '小可愛', '小寶貝',
+    '小念', '點', '點點',
+    # 問候
+    '嗨', '哈囉', '你好', '晨安', '早安', '晚安', '晚安安',
+    '晚安嗨', '昏安', '早安嗨', '在嗎', '你在嗎',
+    '我來了', '我回來了', '我到了',
+    # 簡單問候詞
+    'hi', 'hey', 'hello', 'yo',
+]
+_greeting_matcher = KeywordMatcher({'greeting': _GREETING_KEYWORDS})
+_SYMBOLS_ONLY = re.compile(r'[\W_]+')
+
+_EMOTIONAL_KEYWORDS = [
+    '難過', '傷心', '生氣', '煩', '累', '壓力', '開心', '高興', '快樂', '好棒',
+    '焦慮', '緊張', '失望', '害怕', '無聲', '崩潰', 'emo', '厭世', '想哭', '受不了',
+    '興奮', '期待', '滿意', '幸福', '苦', '痛苦', '委屈', '心痛'
+]
+_emotional_matcher = KeywordMatcher({'emotional': _EMOTIONAL_KEYWORDS})
 
 def _detect_response_type_fallback(user_message):
     """關鍵字 fallback（GPT API 失敗時使用）"""
-    cooperative_keywords = ['好啊', '好喔', '好呀', '好耶', '可以', '嗯嗯', '願意']
-    refuse_keywords = ['不要', '不想', '不行', '不會', '沒有', '不用', '算了', '免了',
-                       '不好', '不太好', '不是', '不對', '不願意', '不可以']
-    question_keywords = ['為什麼', '為何', '怎麼', '幹嘛', '幹麻', '你在', '?', '？', '憑什麼']
-    dismiss_keywords = ['好吧', '也是嘛', '也對嘛', '算了嘛', '沒什麼', '沒關係嘛', '可能是我']
-    neutral_overrides = ['不好意思', '還好', '沒想到', '想太多', '要死了', '要瘋了',
-                         '好奇怪', '好莫名', '不知道好不好', '是不是']
-
-    message = user_message.lower()
-
-    if any(word in message for word in question_keywords):
-        return 'question'
-    if any(phrase in message for phrase in neutral_overrides):
+    category = _response_type_matcher.first(user_message.lower())
+    if category is None or category == 'neutral_override':
         return 'neutral'
-    if any(word in message for word in refuse_keywords):
-        return 'refuse'
-    if any(word in message for word in dismiss_keywords):
-        return 'dismiss'
-    if any(word in message for word in cooperative_keywords):
-        return 'cooperative'
-    return 'neutral'
+    return category
 
 def is_greeting(user_message):
     """
@@ -460,22 +664,10 @@ def is_greeting(user_message):
     message = user_message.strip()
 
     # 純符號 / 標點組成
-    import re
-    if re.fullmatch(r'[\W_]+', message):
+    if _SYMBOLS_ONLY.fullmatch(message):
         return True
 
-    greeting_keywords = [
-        # 稱呼
-        '寶貝', '親愛的', '帥哥', '老公', '老婆', '小可愛', '小寶貝',
-        '小念', '點', '點點',
-        # 問候
-        '嗨', '哈囉', '你好', '晨安', '早安', '晚安', '晚安安',
-        '晚安嗨', '昏安', '早安嗨', '在嗎', '你在嗎',
-        '我來了', '我回來了', '我到了',
-        # 簡單問候詞
-        'hi', 'hey', 'hello', 'yo',
-    ]
-    return any(word in message for word in greeting_keywords)
+    return _greeting_matcher.contains(message)
 
 def has_emotional_content(user_message):
     """
@@ -484,12 +676,7 @@ def has_emotional_content(user_message):
     """
     if len(user_message.strip()) > 8:
         return True
-    emotional_keywords = [
-        '難過', '傷心', '生氣', '煩', '累', '壓力', '開心', '高興', '快樂', '好棒',
-        '焦慮', '緊張', '失望', '害怕', '無聲', '崩潰', 'emo', '厭世', '想哭', '受不了',
-        '興奮', '期待', '滿意', '幸福', '苦', '痛苦', '委屈', '心痛'
-    ]
-    return any(word in user_message for word in emotional_keywords)
+    return _emotional_matcher.contains(user_message)
 
 # ========== 路由 ==========
 
@@ -508,11 +695,32 @@ def webhook():
     if not events:
         return jsonify({'status': 'no events'}), 200
 
+    if WEBHOOK_ASYNC:
+        # 只做基本檢查並寫入佇列，立即回 200（LINE 重送的事件以 webhookEventId 去重）
+        queued = 0
+        for event in events:
+            if event.get('type') != 'message':
+                continue
+            item_id = event_queue.put(
+                event,
+                dedup_key=event.get('webhookEventId'),
+                shard_key=event.get('source', {}).get('userId')
+            )
+            if item_id:
+                queued += 1
+        event_consumer.notify()
+        return jsonify({'status': 'queued', 'queued': queued}), 200
+
+    # 依 userId 分片：同一人的事件依序處理，不同人並行
+    futures = [
+        event_executor.submit(event.get('source', {}).get('userId') or '', handle_message_event, event)
+        for event in events
+    ]
+
     results = []
-    for event in events:
+    for future in futures:
         try:
-            result = handle_message_event(event)
-            results.append(result)
+            results.append(future.result())
         except Exception as e:
             print(f'[ARIA] Event processing error: {str(e)}')
             import traceback
@@ -536,24 +744,38 @@ def handle_message_event(event):
 
     print(f'[ARIA] Received message: {user_message} from {user_id}')
 
+    state = load_user_state(user_id)
+    reply = reply_guard.session(event, user_id)  # reply token 期限內 reply，過期改 push
+
+    # 回覆送出後才執行的記帳工作（對話記錄），由 bookkeeping_executor 在背景依使用者順序執行
+    after_reply = []
+
+    def log_after_reply(*args):
+        after_reply.append((log_conversation, args))
+
+    count_interaction = False  # 已驗證受試者的訊息：回覆後更新一次 last_interaction
+
     try:
         if user_message == 'RESET':
+            reply_message = '✅ 已重置，可以重新驗證。'
+            reply.send(reply_message)
+            # 回覆後才清除（仍在同一事件內完成，同一使用者下一則訊息開始前一定已清除）
+            sheets_outbox.discard(user_id)  # 尚未送出的鏡像寫入不再需要
             clear_user_id_from_sheets(user_id)
             clear_user_state(user_id)
-            reply_message = '✅ 已重置，可以重新驗證。'
-            send_line_reply(reply_token, reply_message)
+            conflict_pool.clear(user_id)
             print(f'[ARIA] User {user_id} reset')
             return {'status': 'reset'}
 
         # ========== 提前取得 user_data（後續全部共用，避免重複呼叫 Sheets）==========
-        user_data = get_user_data_by_user_id(user_id)
+        user_data = get_user_data_by_user_id(user_id, state)
 
         if user_message.startswith('TESTDAY'):
             print(f'[ARIA] TESTDAY command: {user_message}')
 
             if not user_data:
                 reply_message = '❌ 請先驗證（輸入手機末5碼）'
-                send_line_reply(reply_token, reply_message)
+                reply.send(reply_message)
                 return {'status': 'not_verified'}
 
             parts = user_message.split()
@@ -568,7 +790,7 @@ def handle_message_event(event):
                 print(f'[ARIA] Setting Day {target_day}: First_Interaction = {target_date_str}')
 
                 try:
-                    requests.post(
+                    sheets_http.post(
                         SHEETS_API_URL,
                         json={
                             'user_id': user_id,
@@ -580,29 +802,30 @@ def handle_message_event(event):
                     )
                     print(f'[ARIA] TESTDAY update response: success')
 
-                    clear_d7_turn(user_id)
-                    clear_d7_fired(user_id)  # 重置衝突鎖，確保可重複測試
+                    clear_d7_turn(user_id, state)
+                    clear_d7_fired(user_id, state)  # 重置衝突鎖，確保可重複測試
+                    participants_mirror.update(user_id, first_interaction=target_date_str, d7_triggered=0)
 
-                    # 清除 user_data 快取（讓下一則從 Sheets 拿到正確 current_day）
-                    with _state_conn() as conn:
-                        conn.execute('UPDATE bot_state SET cache_day = NULL WHERE user_id = ?', (user_id,))
+                    # 更新 user_data 快取的起始日（current_day 由本地計算，不必再打 Sheets）
+                    state.cache_first_interaction = target_date_str
+                    state.cache_d7_triggered = 0
 
                     if target_day == CONFLICT_DAY:
                         reply_message = f'✅ 已設定為 Day {target_day}\n📅 日期：{target_date_str}\n\n現在可以測試衝突觸發了！（Day {CONFLICT_DAY}）'
                     else:
                         reply_message = f'✅ 已設定為 Day {target_day}\n📅 日期：{target_date_str}'
 
-                    send_line_reply(reply_token, reply_message)
+                    reply.send(reply_message)
                     return {'status': 'testday_set'}
 
                 except Exception as e:
                     print(f'[ARIA] TESTDAY failed: {str(e)}')
                     reply_message = f'❌ 設定失敗：{str(e)}'
-                    send_line_reply(reply_token, reply_message)
+                    reply.send(reply_message)
                     return {'status': 'error'}
             else:
                 reply_message = f'❌ 格式錯誤\n正確用法：TESTDAY 7\n（設定為 Day {CONFLICT_DAY}）'
-                send_line_reply(reply_token, reply_message)
+                reply.send(reply_message)
                 return {'status': 'invalid_format'}
 
         if user_message == 'TEST_D7':
@@ -610,36 +833,36 @@ def handle_message_event(event):
 
             if not user_data:
                 reply_message = '請先驗證（輸入手機末5碼）'
-                send_line_reply(reply_token, reply_message)
+                reply.send(reply_message)
                 return {'status': 'not_verified'}
 
             group = user_data.get('group')
 
-            if get_d7_turn(user_id) > 0:
+            if state.d7_turn > 0:
                 print(f'[ARIA] Clearing old d7 turn for {user_id}')
-                clear_d7_turn(user_id)
-            clear_d7_fired(user_id)  # 重置衝突鎖，確保可重複測試
+                clear_d7_turn(user_id, state)
+            clear_d7_fired(user_id, state)  # 重置衝突鎖，確保可重複測試
 
-            emotion, trigger_sentence = trigger_d7('測試', group, user_id)
+            emotion, trigger_sentence = trigger_d7('測試', group, user_id, state=state)
 
             # 先回覆 LINE（reply token 有效期約 30 秒）
-            set_d7_turn(user_id, 2)
             reply_message = f'[測試模式] 衝突觸發\n{trigger_sentence}'
-            send_line_reply(reply_token, reply_message)
+            reply.send(reply_message)
+            set_d7_turn(user_id, 2, state)
             # 維護 Dify 記憶
-            _ = call_dify(group, '測試', user_id)
-            mock_trigger = f'[以下是我的回應]：{trigger_sentence}'
-            call_dify(group, mock_trigger, user_id)
+            enqueue_dify_memory(group, user_id, '測試', trigger_sentence)
             print(f'[ARIA] TEST_D7 completed for {user_id}, group {group}')
             return {'status': 'test_d7'}
 
+        count_interaction = bool(user_data)
+
         # Recovery：Render 重啟後 SQLite 清空，從 Sheets 還原 d7_turn
-        turn = get_d7_turn(user_id)
+        turn = state.d7_turn
         if turn == 0 and user_data:
             sheets_d7_turn = int(user_data.get('d7_turn', 0) or 0)
             if sheets_d7_turn > 0:
                 turn = sheets_d7_turn
-                set_d7_turn(user_id, turn)
+                set_d7_turn(user_id, turn, state)
                 print(f'[ARIA] Recovered d7_turn={turn} from Sheets after Render restart')
 
         if turn > 0:
@@ -650,81 +873,72 @@ def handle_message_event(event):
                 group = user_data.get('group') if user_data else None
                 d7_triggered = user_data.get('d7_triggered', False) if user_data else False
                 if not group or d7_triggered:
-                    clear_d7_turn(user_id)
+                    clear_d7_turn(user_id, state)
                 else:
-                    current_setup = get_d7_setup(user_id)
+                    current_setup = state.d7_setup
                     participant_code = user_data.get('code', '')
                     current_day = user_data.get('current_day', '')
 
                     if current_setup == 0:
                         # 判斷使用者是否已在分享實質內容（方案 C+D 智慧判斷）
-                        if has_sharing_content(user_message):
+                        analysis = analyze_d7_message(group, user_message) if D7_COMBINED_ANALYSIS else None
+                        speculation = None
+                        if analysis is None and D7_SPECULATIVE:
+                            # 推測執行：判斷是否分享的同時先在背景生成衝突句
+                            speculation = d7_speculation.start(_speculative_conflict_sentence, group, user_message)
+                        sharing = analysis['has_sharing'] if analysis else has_sharing_content(user_message)
+                        if sharing:
                             # 已有實質分享 → 跳過 FOLLOWUP 2，直接觸發衝突
                             print(f'[ARIA] Day 7 has_sharing=YES → skip FOLLOWUP 2, trigger conflict (group={group})')
-                            if try_lock_d7_fired(user_id):
-                                log_conversation(user_id, participant_code, 'user', user_message, False, 'd7_trigger', current_day)
-                                emotion, trigger_sentence = trigger_d7(user_message, group, user_id)
-                                log_conversation(user_id, participant_code, 'ai', trigger_sentence, True, 'd7_trigger', current_day)
-                                set_d7_setup(user_id, 0)
-                                set_d7_turn(user_id, 2)
-                                send_line_reply(reply_token, trigger_sentence)
-                                def _dify_memory_skip_f2(grp, uid, usr_msg, mock_msg):
-                                    call_dify(grp, usr_msg, uid)
-                                    call_dify(grp, mock_msg, uid)
-                                threading.Thread(
-                                    target=_dify_memory_skip_f2,
-                                    args=(group, user_id, user_message, f'[以下是我的回應]：{trigger_sentence}'),
-                                    daemon=True
-                                ).start()
+                            if try_lock_d7_fired(user_id, state):
+                                if speculation:
+                                    analysis = _use_speculative_sentence(speculation)
+                                emotion, trigger_sentence = trigger_d7(user_message, group, user_id, analysis, state)
+                                reply.send(trigger_sentence)
+                                set_d7_setup(user_id, 0, state)
+                                set_d7_turn(user_id, 2, state)
+                                enqueue_dify_memory(group, user_id, user_message, trigger_sentence)
+                                log_after_reply(user_id, participant_code, 'user', user_message, False, 'd7_trigger', current_day)
+                                log_after_reply(user_id, participant_code, 'ai', trigger_sentence, True, 'd7_trigger', current_day)
                                 print(f'[ARIA] Conflict triggered (skipped FOLLOWUP 2)')
                                 return {'status': 'conflict_triggered_skip_followup2'}
                             else:
-                                clear_d7_turn(user_id)
+                                if speculation:
+                                    speculation.discard()
+                                clear_d7_turn(user_id, state)
                         else:
+                            if speculation:
+                                speculation.discard()
                             # 尚未分享 → 送第二次 FOLLOWUP（方案 C）
                             followup2_msg = D7_FOLLOWUP2_MESSAGES.get(group, '最近有什麼事嗎')
                             print(f'[ARIA] Day 7 has_sharing=NO → FOLLOWUP 2 path (group={group})')
-                            log_conversation(user_id, participant_code, 'user', user_message, False, 'd7_followup2', current_day)
-                            log_conversation(user_id, participant_code, 'ai', followup2_msg, True, 'd7_followup2', current_day)
-                            set_d7_setup(user_id, 1)
-                            send_line_reply(reply_token, followup2_msg)
-                            def _dify_memory_followup2(grp, uid, usr_msg, mock_msg):
-                                call_dify(grp, usr_msg, uid)
-                                call_dify(grp, mock_msg, uid)
-                            threading.Thread(
-                                target=_dify_memory_followup2,
-                                args=(group, user_id, user_message, f'[以下是我的回應]：{followup2_msg}'),
-                                daemon=True
-                            ).start()
+                            reply.send(followup2_msg)
+                            set_d7_setup(user_id, 1, state)
+                            enqueue_dify_memory(group, user_id, user_message, followup2_msg)
+                            log_after_reply(user_id, participant_code, 'user', user_message, False, 'd7_followup2', current_day)
+                            log_after_reply(user_id, participant_code, 'ai', followup2_msg, True, 'd7_followup2', current_day)
                             print(f'[ARIA] FOLLOWUP 2 sent, d7_setup set to 1')
                             return {'status': 'd7_followup2_sent'}
 
                     else:
                         # 強制觸發衝突（方案 D：動態生成）
-                        if try_lock_d7_fired(user_id):
-                            log_conversation(user_id, participant_code, 'user', user_message, False, 'd7_trigger', current_day)
-                            emotion, trigger_sentence = trigger_d7(user_message, group, user_id)
-                            log_conversation(user_id, participant_code, 'ai', trigger_sentence, True, 'd7_trigger', current_day)
-                            set_d7_setup(user_id, 0)
-                            set_d7_turn(user_id, 2)
-                            send_line_reply(reply_token, trigger_sentence)
-                            def _dify_memory_followup(grp, uid, usr_msg, mock_msg):
-                                call_dify(grp, usr_msg, uid)
-                                call_dify(grp, mock_msg, uid)
-                            threading.Thread(
-                                target=_dify_memory_followup,
-                                args=(group, user_id, user_message, f'[以下是我的回應]：{trigger_sentence}'),
-                                daemon=True
-                            ).start()
+                        if try_lock_d7_fired(user_id, state):
+                            emotion, trigger_sentence = trigger_d7(user_message, group, user_id, state=state)
+                            reply.send(trigger_sentence)
+                            set_d7_setup(user_id, 0, state)
+                            set_d7_turn(user_id, 2, state)
+                            enqueue_dify_memory(group, user_id, user_message, trigger_sentence)
+                            log_after_reply(user_id, participant_code, 'user', user_message, False, 'd7_trigger', current_day)
+                            log_after_reply(user_id, participant_code, 'ai', trigger_sentence, True, 'd7_trigger', current_day)
                             print(f'[ARIA] Conflict triggered after FOLLOWUP 2 (turn 1→2)')
                             return {'status': 'conflict_triggered_after_followup'}
                         else:
-                            clear_d7_turn(user_id)
+                            clear_d7_turn(user_id, state)
 
             elif 2 <= turn <= 3:
                 group = user_data.get('group') if user_data else None
                 if not group:
-                    clear_d7_turn(user_id)
+                    clear_d7_turn(user_id, state)
                     return {'status': 'error', 'message': 'no user_data for D7 turn'}
 
                 script_group = D7_GROUP_MAPPING.get(group, 'A')
@@ -749,33 +963,21 @@ def handle_message_event(event):
                 else:
                     script_type = 'd7_turn3'
 
-                log_conversation(user_id, participant_code, 'user', user_message, False, script_type, current_day)
-                log_conversation(user_id, participant_code, 'ai', ai_reply, True, script_type, current_day)
-
                 # ⭐ 先回覆 LINE（reply token 有效期約 30 秒，必須在 call_dify 之前）
-                send_line_reply(reply_token, ai_reply)
-                set_d7_turn(user_id, turn + 1)
+                reply.send(ai_reply)
+                set_d7_turn(user_id, turn + 1, state)
 
                 # 維護 Dify 記憶（背景執行，不阻塞 worker）
-                _ai_reply = ai_reply
-                _user_message = user_message
-                _group = group
-                _user_id = user_id
-                def _dify_memory_script(grp, uid, usr_msg, script_msg):
-                    call_dify(grp, usr_msg, uid)
-                    call_dify(grp, f'[以下是我的回應]：{script_msg}', uid)
-                threading.Thread(
-                    target=_dify_memory_script,
-                    args=(_group, _user_id, _user_message, _ai_reply),
-                    daemon=True
-                ).start()
+                enqueue_dify_memory(group, user_id, user_message, ai_reply)
+                log_after_reply(user_id, participant_code, 'user', user_message, False, script_type, current_day)
+                log_after_reply(user_id, participant_code, 'ai', ai_reply, True, script_type, current_day)
                 print(f'[ARIA] D7 turn {turn} completed, Dify memory update in background')
                 return {'status': 'success'}
 
             elif turn == 4:  # Turn 4：軟著陸緩衝，送完後清除 D7
                 group = user_data.get('group') if user_data else None
                 if not group:
-                    clear_d7_turn(user_id)
+                    clear_d7_turn(user_id, state)
                     return {'status': 'error', 'message': 'no user_data for D7 turn 4'}
 
                 script_group = D7_GROUP_MAPPING.get(group, 'A')
@@ -783,30 +985,18 @@ def handle_message_event(event):
                 participant_code = user_data.get('code', '')
                 current_day = user_data.get('current_day', '')
 
-                log_conversation(user_id, participant_code, 'user', user_message, False, 'd7_turn4', current_day)
-                log_conversation(user_id, participant_code, 'ai', ai_reply, True, 'd7_turn4', current_day)
-
-                send_line_reply(reply_token, ai_reply)
-                clear_d7_turn(user_id)  # 送完後清除，下一則走正常 Dify
-
-                _ai_reply = ai_reply
-                _user_message = user_message
-                _group = group
-                _user_id = user_id
-                def _dify_memory_turn4(grp, uid, usr_msg, script_msg):
-                    call_dify(grp, usr_msg, uid)
-                    call_dify(grp, f'[以下是我的回應]：{script_msg}', uid)
-                threading.Thread(
-                    target=_dify_memory_turn4,
-                    args=(_group, _user_id, _user_message, _ai_reply),
-                    daemon=True
-                ).start()
+                reply.send(ai_reply)
+                clear_d7_turn(user_id, state)  # 送完後清除，下一則走正常 Dify
+
+                enqueue_dify_memory(group, user_id, user_message, ai_reply)
+                log_after_reply(user_id, participant_code, 'user', user_message, False, 'd7_turn4', current_day)
+                log_after_reply(user_id, participant_code, 'ai', ai_reply, True, 'd7_turn4', current_day)
                 print(f'[ARIA] D7 turn 4 (landing) completed, D7 cleared')
                 return {'status': 'success'}
 
             else:
                 print(f'[ARIA] D7 conversation ended for {user_id} (all turns completed)')
-                clear_d7_turn(user_id)
+                clear_d7_turn(user_id, state)
 
         # ========== 檢查使用者是否已驗證 ==========
         if not user_data:
@@ -817,20 +1007,22 @@ def handle_message_event(event):
 
                     if assigned_group not in ['E', 'F', 'G', 'H']:
                         reply_message = '❌ 此代碼不適用於此 Bot，請確認您加入的是正確的 AI 伴侶。'
-                        send_line_reply(reply_token, reply_message)
+                        reply.send(reply_message)
                         return {'status': 'wrong_bot'}
 
-                    update_user_id_in_sheets(user_message, user_id)
                     reply_message = ONBOARDING_MESSAGES.get(assigned_group, '✅ 驗證成功！歡迎加入實驗。')
-                    send_line_reply(reply_token, reply_message)
+                    reply.send(reply_message)
+                    update_user_id_in_sheets(user_message, user_id)
+                    # 綁定寫入由 outbox 背景送出；先寫本地快取，下一則訊息不必等 Sheets 更新完成
+                    cache_user_data(user_id, {'group': assigned_group, 'code': user_message, 'current_day': 1, 'd7_triggered': False}, state)
                     return {'status': 'verification success'}
                 else:
                     reply_message = '❌ 查無此代碼，請確認您的手機末5碼是否正確。'
-                    send_line_reply(reply_token, reply_message)
+                    reply.send(reply_message)
                     return {'status': 'verification failed'}
             else:
                 reply_message = '你好！我是 Aria。請輸入您的手機末5碼以開始實驗。'
-                send_line_reply(reply_token, reply_message)
+                reply.send(reply_message)
                 return {'status': 'awaiting verification'}
 
         group = user_data.get('group')
@@ -843,39 +1035,41 @@ def handle_message_event(event):
 
         # ========== D7：Day 7 第一則訊息一律觸發衝突 ==========
         # 若 d7_setup=1 但已不是 Day 7（引導句昨天沒人回），順便清除
-        if get_d7_setup(user_id) and current_day != CONFLICT_DAY:
-            set_d7_setup(user_id, 0)
+        if state.d7_setup and current_day != CONFLICT_DAY:
+            set_d7_setup(user_id, 0, state)
             print(f'[ARIA] d7_setup expired (current_day={current_day}), resetting')
 
-        if current_day == CONFLICT_DAY and not d7_triggered and get_d7_turn(user_id) == 0 and not get_d7_fired(user_id):
+        if current_day == CONFLICT_DAY and not d7_triggered and state.d7_turn == 0 and not state.d7_fired:
             # turn==0：Day 7 第一則訊息一律先送 FOLLOWUP 引導，下一則再觸發衝突
             print(f'[ARIA] Day 7 FOLLOWUP path (first message of day 7: "{user_message}")')
             followup_msg = D7_FOLLOWUP_MESSAGES.get(group, '欸 最近怎樣 跟我說說')
 
-            log_conversation(user_id, participant_code, 'user', user_message, False, 'd7_followup', current_day)
-            log_conversation(user_id, participant_code, 'ai', followup_msg, True, 'd7_followup', current_day)
-
-            set_d7_setup(user_id, 0)
-            set_d7_turn(user_id, 1)  # 標記「引導中」，下一則一定觸發衝突
-            send_line_reply(reply_token, followup_msg)
-
-            def _dify_memory_followup_msg(grp, uid, usr_msg, mock_msg):
-                call_dify(grp, usr_msg, uid)
-                call_dify(grp, mock_msg, uid)
-            threading.Thread(
-                target=_dify_memory_followup_msg,
-                args=(group, user_id, user_message, f'[以下是我的回應]：{followup_msg}'),
-                daemon=True
-            ).start()
+            reply.send(followup_msg)
+            set_d7_setup(user_id, 0, state)
+            set_d7_turn(user_id, 1, state)  # 標記「引導中」，下一則一定觸發衝突
+            if D7_CONFLICT_POOL:
+                conflict_pool.prefill(user_id, group)  # 趁受試者回覆引導句之前先生成衝突句候選
+
+            enqueue_dify_memory(group, user_id, user_message, followup_msg)
+            log_after_reply(user_id, participant_code, 'user', user_message, False, 'd7_followup', current_day)
+            log_after_reply(user_id, participant_code, 'ai', followup_msg, True, 'd7_followup', current_day)
             print(f'[ARIA] Follow-up sent, d7_turn set to 1, Dify memory update in background')
             return {'status': 'd7_followup_sent'}
-        log_conversation(user_id, participant_code, 'user', user_message, False, 'normal', current_day)
-
-        ai_reply = call_dify(group, user_message, user_id)
-
-        log_conversation(user_id, participant_code, 'ai', ai_reply, False, 'normal', current_day)
+        if memory_sync.has_pending(user_id):
+            # 先前的記憶寫入完成後再接續對話，並重新讀取可能被背景更新的 conversation_id
+            if memory_sync.is_retrying(user_id):
+                # 先前的寫入已失敗、正在退避重試：不等（會吃掉 reply token 的時間），直接接續對話
+                print(f'[ARIA] Memory sync for {user_id} is retrying, not waiting before Dify')
+            else:
+                # 最多等到 reply token 期限，Dify 來不及時由 send_slow 改用 push
+                memory_sync.wait_for_user(user_id, timeout=max(0, min(MEMORY_SYNC_WAIT, reply.remaining())))
+            with _state_conn() as conn:
+                state.refresh(conn, 'conversation_id')
+        # Dify 只等到 reply token 期限為止，來不及就改用 push 送出
+        ai_reply = reply.send_slow(call_dify, group, user_message, user_id, state)
 
-        send_line_reply(reply_token, ai_reply)
+        log_after_reply(user_id, participant_code, 'user', user_message, False, 'normal', current_day)
+        log_after_reply(user_id, participant_code, 'ai', ai_reply, False, 'normal', current_day)
 
         return {'status': 'success'}
 
@@ -884,13 +1078,24 @@ def handle_message_event(event):
         import traceback
         traceback.print_exc()
         return {'status': 'error', 'message': str(e)}
+    finally:
+        if count_interaction:
+            update_last_interaction(user_id, state)
+        # RESET 已刪除整列，不必寫回
+        if user_message != 'RESET':
+            flush_user_state(state)
+        run_after_reply(user_id, after_reply)
 
 # ========== Google Sheets 函數 ==========
 
 def query_google_sheets_by_code(code):
-    """用手機碼查詢"""
+    """用手機碼查詢（本地鏡像優先；鏡像沒有時可能是剛新增的列，再查 Sheets）"""
+    if PARTICIPANTS_MIRROR and participants_mirror.ready():
+        data = participants_mirror.by_code(code)
+        if data:
+            return data
     try:
-        response = requests.get(f'{SHEETS_API_URL}?code={code}', timeout=10)
+        response = sheets_http.get(f'{SHEETS_API_URL}?code={code}', timeout=10)
         data = _parse_json_response(response, 'Google Sheets')
         if data.get('found'):
             return data
@@ -899,18 +1104,36 @@ def query_google_sheets_by_code(code):
         print(f'[ARIA] Google Sheets query error: {str(e)}')
         return None
 
-def cache_user_data(user_id, data):
-    """將 Sheets 查到的 user_data 存入 SQLite 快取（當天有效）"""
+def cache_user_data(user_id, data, state=None):
+    """
+    將 Sheets 查到的 user_data 存入 SQLite 快取。
+    存 first_interaction（Sheets 沒給或無法解析時由 current_day 反推），之後 current_day 由本地依台灣日期計算，快取不必每天過期
+    """
     today = datetime.now(TW_TZ).date().isoformat()
+    first_interaction = data.get('first_interaction')
+    if parse_first_interaction(first_interaction, TW_TZ) is None:
+        # 無法解析（例如 Date.toString() 的格式）時不能存：快取不過期，current_day 會永遠是 0
+        if first_interaction:
+            print(f'[ARIA] Unparseable first_interaction for {user_id}: {first_interaction!r}, using current_day')
+        first_interaction = first_interaction_for_day(data.get('current_day'), TW_TZ)
+    if state is not None:
+        state.cache_group = data.get('group', '')
+        state.cache_code = data.get('code', '')
+        state.cache_current_day = str(data.get('current_day', ''))
+        state.cache_first_interaction = first_interaction
+        state.cache_d7_triggered = 1 if data.get('d7_triggered', False) else 0
+        state.cache_day = today
+        return
     with _state_conn() as conn:
         conn.execute(
             '''
-            INSERT INTO bot_state (user_id, cache_group, cache_code, cache_current_day, cache_d7_triggered, cache_day)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO bot_state (user_id, cache_group, cache_code, cache_current_day, cache_first_interaction, cache_d7_triggered, cache_day)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 cache_group = excluded.cache_group,
                 cache_code = excluded.cache_code,
                 cache_current_day = excluded.cache_current_day,
+                cache_first_interaction = excluded.cache_first_interaction,
                 cache_d7_triggered = excluded.cache_d7_triggered,
                 cache_day = excluded.cache_day
             ''',
@@ -919,41 +1142,71 @@ def cache_user_data(user_id, data):
                 data.get('group', ''),
                 data.get('code', ''),
                 str(data.get('current_day', '')),
+                first_interaction,
                 1 if data.get('d7_triggered', False) else 0,
                 today,
             )
         )
 
-def get_cached_user_data(user_id):
-    """從 SQLite 讀取快取的 user_data（當天有效，過期返回 None）"""
+def get_cached_user_data(user_id, state=None):
+    """
+    從 SQLite 讀取快取的 user_data；有 first_interaction 時 current_day 依台灣日期即時計算，不會過期。
+    舊版快取（沒有 first_interaction）仍只在當天有效，過期返回 None
+    """
     today = datetime.now(TW_TZ).date().isoformat()
-    with _state_conn() as conn:
-        row = conn.execute(
-            'SELECT cache_group, cache_code, cache_current_day, cache_d7_triggered, cache_day FROM bot_state WHERE user_id = ?',
-            (user_id,)
-        ).fetchone()
-    if not row or row[4] != today or not row[0]:
+    if state is not None:
+        row = (state.cache_group, state.cache_code, state.cache_current_day, state.cache_d7_triggered, state.cache_day,
+               state.cache_first_interaction)
+    else:
+        with _state_conn() as conn:
+            row = conn.execute(
+                'SELECT cache_group, cache_code, cache_current_day, cache_d7_triggered, cache_day, cache_first_interaction '
+                'FROM bot_state WHERE user_id = ?',
+                (user_id,)
+            ).fetchone()
+    if not row or not row[0]:
+        return None
+    if row[5]:
+        current_day = current_day_from(row[5], TW_TZ)
+    elif row[4] == today:
+        current_day = int(row[2]) if row[2] not in (None, '') else 0
+    else:
         return None
     return {
         'found': True,
         'group': row[0],
         'code': row[1],
-        'current_day': int(row[2]) if row[2] not in (None, '') else 0,
+        'current_day': current_day,
+        'first_interaction': row[5] or '',
         'd7_triggered': bool(row[3]),
     }
 
-def get_user_data_by_user_id(user_id):
-    """用 User ID 查詢（優先讀 SQLite 快取，當天有效）"""
-    cached = get_cached_user_data(user_id)
+def mark_cached_d7_triggered(user_id, state=None):
+    """
+    D7 觸發後同步更新 user_data 快取的 d7_triggered（與 participants_mirror 的 write-through 一致）。
+    快取不再每天過期，不寫回的話同一使用者之後仍會讀到 d7_triggered=False
+    """
+    if state is not None:
+        state.cache_d7_triggered = 1
+        return
+    with _state_conn() as conn:
+        conn.execute('UPDATE bot_state SET cache_d7_triggered = 1 WHERE user_id = ?', (user_id,))
+
+def get_user_data_by_user_id(user_id, state=None):
+    """用 User ID 查詢（本地鏡像已載入時直接讀鏡像；否則優先讀 SQLite 快取）"""
+    if PARTICIPANTS_MIRROR and participants_mirror.ready():
+        # 綁定都經過本 Bot（write-through）或由 delta sync 帶入，鏡像沒有就是尚未驗證
+        return participants_mirror.by_user_id(user_id)
+    cached = get_cached_user_data(user_id, state)
     if cached:
         print(f'[ARIA] user_data cache hit for {user_id}')
         return cached
     try:
-        response = requests.get(f'{SHEETS_API_URL}?user_id={user_id}', timeout=10)
+        response = sheets_http.get(f'{SHEETS_API_URL}?user_id={user_id}', timeout=10)
         data = _parse_json_response(response, 'Google Sheets')
         if data.get('found'):
             try:
-                cache_user_data(user_id, data)
+                cache_user_data(user_id, data, state)
                 print(f'[ARIA] user_data cache miss, fetched from Sheets for {user_id}')
             except Exception as cache_err:
                 print(f'[ARIA WARNING] cache_user_data failed (non-critical): {str(cache_err)}')
@@ -970,27 +1223,23 @@ def update_user_id_in_sheets(code, user_id):
         
         print(f'[ARIA] Updating User ID for code: {code}, user_id: {user_id}, first: {tw_now}')
         
-        response = requests.post(
-            SHEETS_API_URL,
-            json={
-                'code': code,
-                'user_id': user_id,
-                'first_interaction': tw_now
-            },
-            timeout=10
-        )
-        
-        print(f'[ARIA] Update User ID response: {response.text}')
+        sheets_outbox.put(user_id, 'verify', {
+            'code': code,
+            'user_id': user_id,
+            'first_interaction': tw_now
+        })
+        participants_mirror.bind(code, user_id, tw_now)
         
     except Exception as e:
         print(f'[ARIA] Update User ID error: {str(e)}')
 
 def clear_user_id_from_sheets(user_id):
     """RESET 時清除"""
+    participants_mirror.unbind(user_id)
     try:
         print(f'[ARIA] Clearing User ID: {user_id}')
         
-        response = requests.post(
+        response = sheets_http.post(
             SHEETS_API_URL,
             json={
                 'clear_user_id': True,
@@ -1004,45 +1253,43 @@ def clear_user_id_from_sheets(user_id):
     except Exception as e:
         print(f'[ARIA] Clear User ID error: {str(e)}')
 
-def update_last_interaction(user_id):
+def update_last_interaction(user_id, state=None):
     """更新 Last_Interaction"""
     try:
         tw_now = datetime.now(TW_TZ)
         current_date_str = tw_now.date().isoformat()
 
-        with _state_conn() as conn:
-            row = conn.execute(
-                'SELECT last_interaction_date FROM bot_state WHERE user_id = ?',
-                (user_id,)
-            ).fetchone()
-
-            last_date = row[0] if row and row[0] else None
-            is_first_today = (last_date != current_date_str)
-
-            conn.execute(
-                '''
-                INSERT INTO bot_state (user_id, last_interaction_date)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET last_interaction_date = excluded.last_interaction_date
-                ''',
-                (user_id, current_date_str)
-            )
+        if state is not None:
+            is_first_today = (state.last_interaction_date != current_date_str)
+            state.last_interaction_date = current_date_str
+        else:
+            with _state_conn() as conn:
+                row = conn.execute(
+                    'SELECT last_interaction_date FROM bot_state WHERE user_id = ?',
+                    (user_id,)
+                ).fetchone()
+
+                last_date = row[0] if row and row[0] else None
+                is_first_today = (last_date != current_date_str)
+
+                conn.execute(
+                    '''
+                    INSERT INTO bot_state (user_id, last_interaction_date)
+                    VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET last_interaction_date = excluded.last_interaction_date
+                    ''',
+                    (user_id, current_date_str)
+                )
         
         tw_now_str = tw_now.strftime('%Y-%m-%d %H:%M:%S')
         
         print(f'[ARIA] Updating last interaction: {user_id}, time: {tw_now_str}, first_today: {is_first_today}')
         
-        response = requests.post(
-            SHEETS_API_URL,
-            json={
-                'user_id': user_id,
-                'last_interaction': tw_now_str,
-                'is_first_today': is_first_today
-            },
-            timeout=10
-        )
-        
-        print(f'[ARIA] Update response: {response.text}')
+        sheets_outbox.put(user_id, 'last_interaction', {
+            'user_id': user_id,
+            'last_interaction': tw_now_str,
+            'is_first_today': is_first_today
+        })
         
     except Exception as e:
         print(f'[ARIA] Update sheets error: {str(e)}')
@@ -1089,44 +1336,46 @@ _D7_CONFLICT_PROMPTS = {
 }
 
 
+# 是否有實質分享的分類 prompt
+_HAS_SHARING_PROMPT = (
+    '你是一個分類助手。判斷使用者的訊息是否包含「實質內容」。\n'
+    '實質內容定義：分享事件、心情、人際關係、生活狀況等具體的事情。\n'
+    '非實質內容：打招呼、撒嬌、問問題、只回應Bot、單純閒聊。\n'
+    '只回答 YES 或 NO，不要說其他任何東西。'
+)
+_HAS_SHARING_USER = '訊息：「{message}」'
+_HAS_SHARING_VERSION = prompt_version(_HAS_SHARING_PROMPT, _HAS_SHARING_USER)
+
 def has_sharing_content(user_message):
     """
     判斷使用者是否在分享實質內容（事件/心情/人際/生活狀況等）
     YES → 已有實質分享，可跳過 FOLLOWUP 2 直接觸發衝突
     NO  → 尚未分享，仍需送 FOLLOWUP 2
-    失敗時回傳 False（保守策略）
+    GPT 成功的結果存入 classifier_cache；失敗時回傳 False（保守策略）
     """
-    openai_api_key = os.environ.get('OPENAI_API_KEY')
+    openai_api_key = OPENAI_API_KEY
     if not openai_api_key:
         return False
+    result = classifier_cache.cached(
+        'has_sharing', _HAS_SHARING_VERSION, OPENAI_CLASSIFIER_MODEL, user_message,
+        lambda: _gpt_has_sharing(openai_api_key, user_message)
+    )
+    return bool(result)
+
+def _gpt_has_sharing(openai_api_key, user_message):
+    """GPT YES/NO 判斷；失敗時回傳 None"""
     try:
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers={'Authorization': f'Bearer {openai_api_key}', 'Content-Type': 'application/json'},
-            json={
-                'model': 'gpt-4o-mini',
-                'messages': [
-                    {'role': 'system', 'content': (
-                        '你是一個分類助手。判斷使用者的訊息是否包含「實質內容」。\n'
-                        '實質內容定義：分享事件、心情、人際關係、生活狀況等具體的事情。\n'
-                        '非實質內容：打招呼、撒嬌、問問題、只回應Bot、單純閒聊。\n'
-                        '只回答 YES 或 NO，不要說其他任何東西。'
-                    )},
-                    {'role': 'user', 'content': f'訊息：「{user_message}」'}
-                ],
-                'temperature': 0,
-                'max_tokens': 5
-            },
-            timeout=8
+        status, answer = _gpt_chat(
+            openai_api_key, _HAS_SHARING_PROMPT,
+            _HAS_SHARING_USER.format(message=user_message),
+            max_tokens=5, timeout=8
         )
-        if response.status_code != 200:
-            return False
-        data = _parse_json_response(response, 'OpenAI has_sharing')
-        answer = data['choices'][0]['message']['content'].strip().upper()
-        return answer.startswith('YES')
+        if answer is None:
+            return None
+        return answer.upper().startswith('YES')
     except Exception as e:
         print(f'[ARIA] has_sharing_content failed: {e}')
-        return False
+        return None
 
 
 def generate_conflict_sentence(group, user_message):
@@ -1134,82 +1383,201 @@ def generate_conflict_sentence(group, user_message):
     方案 D：根據受試者說的內容動態生成針對性衝突句
     失敗時由 trigger_d7 fallback 到 D7_TRIGGERS 固定句
     """
-    openai_api_key = os.environ.get('OPENAI_API_KEY')
+    openai_api_key = OPENAI_API_KEY
     if not openai_api_key:
         raise ValueError('No OPENAI_API_KEY')
 
     # Aria 使用 E/F/G/H，直接用對應 prompt
     system_prompt = _D7_CONFLICT_PROMPTS.get(group, _D7_CONFLICT_PROMPTS['E'])
-    response = requests.post(
-        'https://api.openai.com/v1/chat/completions',
-        headers={'Authorization': f'Bearer {openai_api_key}', 'Content-Type': 'application/json'},
-        json={
-            'model': 'gpt-4o-mini',
-            'messages': [
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': f'對方說：「{user_message}」\n\n請生成一句衝突句：'}
-            ],
-            'temperature': 0.7,
-            'max_tokens': 60
-        },
-        timeout=10
+    status, sentence = _gpt_chat(
+        openai_api_key, system_prompt,
+        f'對方說：「{user_message}」\n\n請生成一句衝突句：',
+        max_tokens=60, timeout=10, temperature=0.7
     )
-    if response.status_code != 200:
-        raise RuntimeError(f'OpenAI error {response.status_code}')
+    if sentence is None:
+        raise RuntimeError(f'OpenAI error {status}')
 
-    data = _parse_json_response(response, 'OpenAI conflict gen')
-    sentence = data['choices'][0]['message']['content'].strip().strip('「」\'"')
+    # 移除首尾引號（GPT 有時會加）
+    sentence = sentence.strip('「」\'"')
     print(f'[ARIA] Dynamic conflict sentence generated: {sentence}')
     return sentence
 
 
-def trigger_d7(user_message, group, user_id):
-    """D7 觸發：先嘗試動態生成衝突句（方案D），失敗再 fallback 固定句"""
+def _speculative_conflict_sentence(group, user_message):
+    """推測執行用：回傳 (衝突句, 這次呼叫的 token 數)"""
+    _openai_usage.total_tokens = 0
+    sentence = generate_conflict_sentence(group, user_message)
+    return sentence, _openai_usage.total_tokens
+
+def _use_speculative_sentence(speculation):
+    """取用推測生成的衝突句，包成 trigger_d7 的 analysis；失敗時回傳 None（trigger_d7 會重新生成）"""
+    try:
+        return {'has_sharing': True, 'emotion': None, 'conflict_sentence': speculation.result(timeout=15)}
+    except Exception as e:
+        print(f'[ARIA] Speculative conflict sentence failed: {str(e)}')
+        return None
+
+
+# 合併分析：在各組衝突句 prompt 後面加上分類與 JSON 輸出要求
+_D7_ANALYSIS_INSTRUCTIONS = (
+    '\n\n除了衝突句，也請一併判斷對方的訊息：\n'
+    '- has_sharing：是否包含實質內容（分享事件、心情、人際關係、生活狀況等具體的事情）；'
+    '打招呼、撒嬌、問問題、只回應Bot、單純閒聊都不算\n'
+    '- emotion：對方訊息的情緒，只能是 Positive、Negative 或 Neutral（「不開心」「不快樂」「不爽」等都是負面情緒）\n'
+    '- conflict_sentence：依上面的要求生成的一句衝突句\n'
+    '只輸出 JSON：{"has_sharing": true 或 false, "emotion": "...", "conflict_sentence": "..."}'
+)
+_D7_EMOTIONS = ('Positive', 'Negative', 'Neutral')
+
+def analyze_d7_message(group, user_message):
+    """
+    Day 7 合併分析：一次 JSON mode 呼叫同時取得
+    has_sharing（是否有實質分享）、emotion（情緒）、conflict_sentence（動態衝突句）。
+    失敗時回傳 None，由呼叫端改用 has_sharing_content / generate_conflict_sentence / 情緒分類。
+    temperature=0：has_sharing / emotion 是分類結果，與單獨的分類呼叫一樣要可重現。
+    注意：同一次呼叫產生的 conflict_sentence 因此也是 temperature=0（同一組、同一句訊息會得到相同衝突句），
+    不同於 generate_conflict_sentence 的 0.7；需要原本的取樣方式時設 D7_COMBINED_ANALYSIS=0。
+    """
+    openai_api_key = OPENAI_API_KEY
+    if not openai_api_key:
+        return None
+
+    system_prompt = _D7_CONFLICT_PROMPTS.get(group, _D7_CONFLICT_PROMPTS['E']) + _D7_ANALYSIS_INSTRUCTIONS
+    try:
+        status, content = _gpt_chat(
+            openai_api_key, system_prompt,
+            f'對方說：「{user_message}」',
+            max_tokens=120, timeout=10, temperature=0, json_mode=True
+        )
+        if content is None:
+            print(f'[ARIA] D7 analysis HTTP {status}, using separate calls')
+            return None
+        result = json.loads(content)
+        has_sharing = result.get('has_sharing')
+        emotion = result.get('emotion')
+        analysis = {
+            'has_sharing': has_sharing is True or str(has_sharing).lower() in ('true', 'yes'),
+            'emotion': emotion if emotion in _D7_EMOTIONS else None,
+            'conflict_sentence': str(result.get('conflict_sentence') or '').strip().strip('「」\'"'),
+        }
+        print(f'[ARIA] D7 analysis: {analysis}')
+        return analysis
+    except Exception as e:
+        print(f'[ARIA] D7 analysis error: {str(e)}, using separate calls')
+        return None
+
+
+# 衝突句預先生成：推播引導句時對方還沒分享，依情緒各寫數句可直接套用的候選
+_D7_POOL_INSTRUCTIONS = (
+    '\n\n這次請先預備好回應：對方等一下會分享一件事或一種心情，但現在還不知道內容。\n'
+    '請分成三種情況，每種寫 {count} 句彼此不同的衝突句：\n'
+    '- Positive：對方分享開心、順利的事或心情\n'
+    '- Negative：對方分享難過、疲累、煩躁的事或心情\n'
+    '- Neutral：對方只是聊日常、沒有明顯情緒\n'
+    '句子不能提到具體的人事物，要能套用在同一種情況的任何分享上。\n'
+    '只輸出 JSON：{{"Positive": ["..."], "Negative": ["..."], "Neutral": ["..."]}}'
+)
+
+def generate_conflict_pool(group, per_emotion):
+    """
+    conflict_pool 的生成函數：一次 JSON mode 呼叫取得三種情緒各 per_emotion 句候選。
+    失敗時丟出例外，由 conflict_pool 記錄；觸發時沒有候選就照舊即時生成。
+    """
+    openai_api_key = OPENAI_API_KEY
+    if not openai_api_key:
+        raise ValueError('No OPENAI_API_KEY')
+
+    system_prompt = _D7_CONFLICT_PROMPTS.get(group, _D7_CONFLICT_PROMPTS['E']) + _D7_POOL_INSTRUCTIONS.format(count=per_emotion)
+    status, content = _gpt_chat(
+        openai_api_key, system_prompt, '請生成候選衝突句：',
+        max_tokens=60 * per_emotion * len(_D7_EMOTIONS), timeout=20, temperature=0.9, json_mode=True
+    )
+    if content is None:
+        raise RuntimeError(f'OpenAI error {status}')
+    result = json.loads(content)
+    return {
+        emotion: [str(s).strip().strip('「」\'"') for s in result.get(emotion) or [] if str(s).strip()]
+        for emotion in _D7_EMOTIONS
+    }
+
+def take_pooled_conflict_sentence(user_id, group, user_message, analysis=None):
+    """
+    從 conflict_pool 取預先生成的衝突句；沒有可用候選時回傳 None（trigger_d7 照舊即時生成）。
+    情緒用合併分析的結果或快取中的 GPT 分類；都沒有時用關鍵字判斷，不為了挑句子再呼叫 GPT。
+    """
+    try:
+        emotion = analysis.get('emotion') if analysis else None
+        if not emotion:
+            _, emotion = classifier_cache.get('emotion', _EMOTION_VERSION, OPENAI_CLASSIFIER_MODEL, user_message)
+        if not emotion:
+            emotion = detect_emotion_fallback(user_message)
+        sentence = conflict_pool.take(user_id, group, emotion)
+        if sentence:
+            print(f'[ARIA] Pooled conflict sentence ({emotion}) for {user_id}')
+        return sentence
+    except Exception as e:
+        print(f'[ARIA] Conflict pool lookup failed: {str(e)}')
+        return None
+
+
+# trigger_d7 fallback 路徑的情緒分類 prompt
+_EMOTION_PROMPT = '你是情感分析專家。請判斷使用者訊息的情緒，只回答一個英文單字：Positive（正面）、Negative（負面）或 Neutral（中性）。'
+_EMOTION_USER = '使用者說：「{message}」\n\n這句話的情緒是？只回答 Positive、Negative 或 Neutral。'
+_EMOTION_VERSION = prompt_version(_EMOTION_PROMPT, _EMOTION_USER)
+
+def _gpt_detect_emotion(openai_api_key, user_message):
+    """GPT 情緒分類（Positive / Negative / Neutral）；失敗時回傳 None"""
+    try:
+        status, answer = _gpt_chat(
+            openai_api_key, _EMOTION_PROMPT,
+            _EMOTION_USER.format(message=user_message),
+            max_tokens=10, timeout=10
+        )
+        if answer is None:
+            return None
+        if 'Negative' in answer:
+            return 'Negative'
+        if 'Positive' in answer:
+            return 'Positive'
+        return 'Neutral'
+    except Exception as e:
+        print(f'[ARIA] GPT emotion error: {str(e)}')
+        return None
+
+
+def trigger_d7(user_message, group, user_id, analysis=None, state=None):
+    """D7 觸發：先用合併分析的衝突句，沒有才動態生成（方案D），失敗再 fallback 固定句"""
     try:
         # 方案 D：先嘗試動態生成針對性衝突句
         try:
-            trigger_sentence = generate_conflict_sentence(group, user_message)
-            emotion = 'Dynamic'
-            print(f'[ARIA] Using dynamic conflict sentence for group={group}')
+            if analysis and analysis.get('conflict_sentence'):
+                trigger_sentence = analysis['conflict_sentence']
+                emotion = 'Dynamic'
+            else:
+                # 推播引導句時預先生成的候選（D7_CONFLICT_POOL），沒有才即時生成
+                trigger_sentence = take_pooled_conflict_sentence(user_id, group, user_message, analysis) if D7_CONFLICT_POOL else None
+                emotion = 'Pooled' if trigger_sentence else 'Dynamic'
+                if not trigger_sentence:
+                    trigger_sentence = generate_conflict_sentence(group, user_message)
+            print(f'[ARIA] Using {emotion.lower()} conflict sentence for group={group}')
         except Exception as gen_err:
             print(f'[ARIA] Dynamic generation failed ({gen_err}), falling back to fixed sentence')
-            openai_api_key = os.environ.get('OPENAI_API_KEY')
-            if not openai_api_key:
-                emotion = detect_emotion_fallback(user_message)
-            else:
-                response = requests.post(
-                    'https://api.openai.com/v1/chat/completions',
-                    headers={'Authorization': f'Bearer {openai_api_key}', 'Content-Type': 'application/json'},
-                    json={
-                        'model': 'gpt-4o-mini',
-                        'messages': [
-                            {'role': 'system', 'content': '你是情感分析專家。請判斷使用者訊息的情緒，只回答一個英文單字：Positive（正面）、Negative（負面）或 Neutral（中性）。'},
-                            {'role': 'user', 'content': f'使用者說：「{user_message}」\n\n這句話的情緒是？只回答 Positive、Negative 或 Neutral。'}
-                        ],
-                        'temperature': 0,
-                        'max_tokens': 10
-                    },
-                    timeout=10
+            openai_api_key = OPENAI_API_KEY
+            emotion = analysis.get('emotion') if analysis else None
+            if not emotion and openai_api_key:
+                emotion = classifier_cache.cached(
+                    'emotion', _EMOTION_VERSION, OPENAI_CLASSIFIER_MODEL, user_message,
+                    lambda: _gpt_detect_emotion(openai_api_key, user_message)
                 )
-                if response.status_code == 200:
-                    data = _parse_json_response(response, 'OpenAI')
-                    ai_response = data['choices'][0]['message']['content'].strip()
-                    if 'Negative' in ai_response:
-                        emotion = 'Negative'
-                    elif 'Positive' in ai_response:
-                        emotion = 'Positive'
-                    else:
-                        emotion = 'Neutral'
-                    print(f'[ARIA] Emotion detected (fallback): {emotion}')
-                else:
-                    emotion = detect_emotion_fallback(user_message)
+                if emotion:
+                    print(f'[ARIA] Emotion detected by OpenAI (fallback): {emotion}')
+            if not emotion:
+                emotion = detect_emotion_fallback(user_message)
             trigger_sentence = D7_TRIGGERS[group][emotion]
 
-        requests.post(
-            SHEETS_API_URL,
-            json={'user_id': user_id, 'd7_trigger': True, 'emotion': emotion, 'trigger_sentence': trigger_sentence},
-            timeout=10
-        )
+        sheets_outbox.put(user_id, 'd7_trigger', {'user_id': user_id, 'd7_trigger': True, 'emotion': emotion, 'trigger_sentence': trigger_sentence})
+        participants_mirror.update(user_id, d7_triggered=1)
+        mark_cached_d7_triggered(user_id, state)
         print(f'[ARIA] Conflict triggered: user={user_id}, emotion={emotion}, trigger={trigger_sentence[:30]}...')
         return emotion, trigger_sentence
 
@@ -1221,109 +1589,138 @@ def trigger_d7(user_message, group, user_id):
         return emotion, D7_TRIGGERS[group][emotion]
 
 
-def detect_emotion_fallback(user_message):
-    """Fallback 情緒偵測"""
+# 情緒 fallback 字典；dict 順序即優先順序，第一個有命中的分類決定情緒
+_EMOTION_FALLBACK_KEYWORDS = {
     # 否定負面詞 → 語意為放心/不擔心/雙重否定，強制 Neutral 避免 negative_keywords 誤判
-    neutral_override_patterns = [
+    'neutral_override': [
         '沒有壓力', '沒壓力', '不用擔心', '別擔心', '不擔心',
         '不是不開心', '麻煩你', '沒有累', '不累', '沒累'
-    ]
-
+    ],
     # 否定詞組合（含「動詞+不起來」句型）
-    negative_patterns = [
+    'negative_pattern': [
         '不開心', '不高興', '不快樂', '不爽', '不滿意', '不舒服',
         '不好', '不太好', '不想', '不行', '不喜歡', '不愉快',
         '沒開心', '沒高興', '不是到太開心', '不是很開心',
         '開心不起來', '高興不起來', '快樂不起來'
-    ]
-
-    negative_keywords = [
+    ],
+    'negative_keyword': [
         '難過', '傷心', '生氣', '煩', '累', '壓力', '慘', '糟',
         '焦慮', '緊張', '失望', '後悔', '害怕', '擔心', '痛苦',
         '沮喪', '無聊', '難受', '辛苦', '鬱悶', '煩躁',
         '崩潰', '絕望', '受傷', '委屈', '心痛',
         'emo', '厭世', '想哭', '受不了', '快瘋了'
-    ]
-
-    positive_keywords = [
+    ],
+    'positive_keyword': [
         '開心', '高興', '快樂', '好棒', '太好了', '成功', '讚', '爽', '棒',
         '興奮', '期待', '滿意', '舒服', '幸福', '美好',
         '超開心', '超爽', '超棒', '太棒了', '讚啦'
-    ]
-
-    if any(p in user_message for p in neutral_override_patterns):
-        emotion = 'Neutral'
-        print(f'[ARIA] Fallback: Emotion detected (neutral override): {emotion}')
-    elif any(pattern in user_message for pattern in negative_patterns):
-        emotion = 'Negative'
-        print(f'[ARIA] Fallback: Emotion detected (negative pattern): {emotion}')
-    elif any(word in user_message for word in negative_keywords):
-        emotion = 'Negative'
-        print(f'[ARIA] Fallback: Emotion detected (negative keyword): {emotion}')
-    elif any(word in user_message for word in positive_keywords):
-        emotion = 'Positive'
-        print(f'[ARIA] Fallback: Emotion detected (positive keyword): {emotion}')
-    else:
-        emotion = 'Neutral'
-        print(f'[ARIA] Fallback: Emotion detected (neutral): {emotion}')
+    ],
+}
+_emotion_fallback_matcher = KeywordMatcher(_EMOTION_FALLBACK_KEYWORDS)
+_EMOTION_FALLBACK_RESULTS = {
+    'neutral_override': ('Neutral', 'neutral override'),
+    'negative_pattern': ('Negative', 'negative pattern'),
+    'negative_keyword': ('Negative', 'negative keyword'),
+    'positive_keyword': ('Positive', 'positive keyword'),
+}
 
+def detect_emotion_fallback(user_message):
+    """Fallback 情緒偵測"""
+    category = _emotion_fallback_matcher.first(user_message)
+    emotion, reason = _EMOTION_FALLBACK_RESULTS.get(category, ('Neutral', 'neutral'))
+    print(f'[ARIA] Fallback: Emotion detected ({reason}): {emotion}')
     return emotion
 
 # ========== Dify 函數 ==========
 
-def call_dify(group, message, user_id):
-    """呼叫 Dify API"""
+def call_dify(group, message, user_id, state=None, raise_on_error=False):
+    """
+    呼叫 Dify API
+    raise_on_error=False：失敗時回傳給使用者的 fallback 字串（回覆路徑）
+    raise_on_error=True：非 2xx、連線錯誤或找不到組別時拋出例外（記憶同步，交給 DurableQueue 重試 / dead letter）
+    """
     try:
         dify_key = DIFY_KEYS.get(group)
         if not dify_key:
             print(f'[ARIA] ERROR: No Dify key found for group: {group}')
+            if raise_on_error:
+                raise RuntimeError(f'No Dify key for group: {group}')
             return '系統錯誤：無法識別組別'
         
         request_data = {
             'inputs': {},
             'query': message,
             'user': user_id,
-            'response_mode': 'blocking'
+            'response_mode': DIFY_RESPONSE_MODE
         }
         
-        conversation_id = get_conversation_id(user_id)
+        conversation_id = state.conversation_id if state is not None else get_conversation_id(user_id)
         if conversation_id:
             request_data['conversation_id'] = conversation_id
             print(f'[ARIA] Using conversation: {conversation_id}')
         else:
             print(f'[ARIA] New conversation: {user_id}')
         
-        response = requests.post(
+        started_at = time.time()
+        streaming = DIFY_RESPONSE_MODE == 'streaming'
+        response = dify_http.post(
             DIFY_API_URL,
             headers={
                 'Authorization': f'Bearer {dify_key}',
                 'Content-Type': 'application/json'
             },
             json=request_data,
-            timeout=30
+            timeout=30,
+            stream=streaming
         )
-        
-        data = _parse_json_response(response, 'Dify')
+
+        if streaming and response.status_code < 400:
+            data = dify_stream.read_chat_stream(response, started_at, dify_stream_stats)
+        else:
+            data = _parse_json_response(response, 'Dify')
         ai_reply = data.get('answer', '抱歉，我現在無法回覆。')
         
         if 'conversation_id' in data:
-            set_conversation_id(user_id, data['conversation_id'])
+            if state is not None:
+                state.conversation_id = data['conversation_id']
+            else:
+                set_conversation_id(user_id, data['conversation_id'])
             print(f'[ARIA] Saved conversation ID: {data["conversation_id"]}')
         
-        update_last_interaction(user_id)
-        
         return ai_reply
         
     except Exception as e:
         print(f'[ARIA] Dify API error: {str(e)}')
+        if raise_on_error:
+            raise
         return '抱歉，系統暫時無法回應。'
 
+def enqueue_dify_memory(group, user_id, user_message, script_reply):
+    """將使用者訊息與腳本回應排入背景 pipeline（同一使用者 FIFO），之後以一次 Dify 呼叫寫入記憶"""
+    memory_sync.submit(user_id, {
+        'group': group,
+        'user_id': user_id,
+        'user_message': user_message,
+        'script_reply': script_reply
+    })
+
+def _sync_dify_memory(payload):
+    if 'messages' in payload:
+        # 升級前排入的舊格式：逐則呼叫；sent 記錄已寫入的則數（失敗時隨 payload 存回），重試從第一則失敗的接續
+        messages = payload['messages']
+        for index in range(payload.get('sent', 0), len(messages)):
+            call_dify(payload['group'], messages[index], payload['user_id'], raise_on_error=True)
+            payload['sent'] = index + 1
+        return
+    query = DIFY_MEMORY_TEMPLATE.format(user=payload['user_message'], script=payload['script_reply'])
+    call_dify(payload['group'], query, payload['user_id'], raise_on_error=True)
+
 # ========== LINE 函數 ==========
 
 def send_line_reply(reply_token, message):
     """發送 LINE 回覆"""
     try:
-        response = requests.post(
+        response = line_http.post(
             'https://api.line.me/v2/bot/message/reply',
             headers={
                 'Content-Type': 'application/json',
@@ -1337,13 +1734,16 @@ def send_line_reply(reply_token, message):
         )
         if response.status_code >= 400:
             print(f'[ARIA] LINE reply failed: {response.status_code} {response.text[:200]}')
+            return False
+        return True
     except Exception as e:
         print(f'[ARIA] LINE reply error: {str(e)}')
+        return False
 
 def send_line_push(user_id, message):
     """主動推播 LINE 訊息給指定 user_id"""
     try:
-        response = requests.post(
+        response = line_http.post(
             'https://api.line.me/v2/bot/message/push',
             headers={
                 'Content-Type': 'application/json',
@@ -1364,13 +1764,61 @@ def send_line_push(user_id, message):
         print(f'[ARIA] LINE push error for {user_id}: {str(e)}')
         return False
 
+LINE_MULTICAST_MAX = 500  # LINE multicast 每次最多收件人數
+LINE_MULTICAST_RETRIES = 2  # 結果不明（逾時 / 連線中斷 / 5xx）時以同一個 retry key 重送的次數
+_multicast_retry_sleep = time.sleep  # 重送前的等待（測試可替換，不影響全域 time.sleep）
+
+def send_line_multicast(user_ids, message, retry_key):
+    """
+    同一則訊息一次推播給多個 user_id（最多 LINE_MULTICAST_MAX 個）；回傳 'sent' / 'failed' / 'unknown'。
+    每次請求帶 X-Line-Retry-Key：以同一個 key 重送時 LINE 不會重複送出（已受理的回 409，視為 sent）。
+    'failed' 只代表 LINE 明確以 4xx（409 以外）拒絕（沒有送出）；
+    5xx 與逾時等例外無法確定是否已送達，回傳 'unknown'，由呼叫端以同一個 retry key 重送
+    """
+    try:
+        response = line_http.post(
+            'https://api.line.me/v2/bot/message/multicast',
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN_ARIA}',
+                'X-Line-Retry-Key': retry_key
+            },
+            json={
+                'to': list(user_ids),
+                'messages': [{'type': 'text', 'text': message}]
+            },
+            timeout=15
+        )
+        if response.status_code == 409:
+            print(f'[ARIA] LINE multicast already accepted (retry key {retry_key})')
+            return 'sent'
+        if response.status_code >= 500:
+            print(f'[ARIA] LINE multicast server error ({len(user_ids)} users): {response.status_code} {response.text[:200]}')
+            return 'unknown'
+        if response.status_code >= 400:
+            print(f'[ARIA] LINE multicast failed ({len(user_ids)} users): {response.status_code} {response.text[:200]}')
+            return 'failed'
+        print(f'[ARIA] LINE multicast sent to {len(user_ids)} users')
+        return 'sent'
+    except Exception as e:
+        print(f'[ARIA] LINE multicast error ({len(user_ids)} users): {str(e)}')
+        return 'unknown'
+
 # ========== Daily Nudge Job ==========
 
 ARIA_GROUPS = {'E', 'F', 'G', 'H'}
 
+# 推播工作：並行 worker 數與 LINE push 速率上限（每秒）
+batch_jobs = BatchJobRunner(max_workers=NUDGE_WORKERS, label='ARIA JOBS')
+line_push_bucket = TokenBucket(LINE_PUSH_RATE)
+
 @app.route('/jobs/daily-nudge', methods=['POST'])
 def daily_nudge():
-    """Render Cron Job 觸發的每日推播 endpoint（僅限 Aria bot：E/F/G/H 組）"""
+    """
+    Render Cron Job 觸發的每日推播 endpoint（僅限 Aria bot：E/F/G/H 組）
+    立即回傳 job_id（202），推播在背景並行執行；進度查詢 GET /jobs/status/<job_id>
+    NUDGE_MULTICAST 開啟時每 LINE_MULTICAST_MAX 位使用者為一批，符合條件的以一次 multicast 送出
+    """
     return jsonify({'status': 'disabled'}), 503  # 暫停 cron job
     # 驗證 JOB_SECRET
     secret = request.headers.get('X-Job-Secret') or request.args.get('secret', '')
@@ -1378,149 +1826,320 @@ def daily_nudge():
         return jsonify({'error': 'Unauthorized'}), 401
 
     tw_today = datetime.now(TW_TZ).date().isoformat()
-    print(f'[ARIA NUDGE] Starting daily nudge for Aria bot, date: {tw_today}')
-
-    # 取得所有 Active 用戶
-    try:
-        resp = requests.get(f'{SHEETS_API_URL}?action=get_active_users', timeout=15)
-        users = resp.json().get('users', [])
-    except Exception as e:
-        print(f'[ARIA NUDGE] Failed to fetch users: {str(e)}')
-        return jsonify({'error': 'Failed to fetch users'}), 500
-
-    pushed = []
-    skipped_interacted = []
-    skipped_nudged = []
-    failed = []
+    if NUDGE_MULTICAST:
+        process, chunk_size = (lambda users: _nudge_users(users, tw_today)), LINE_MULTICAST_MAX
+    else:
+        process, chunk_size = (lambda user: _nudge_user(user, tw_today)), None
+    job, started = batch_jobs.start(
+        'daily-nudge', lambda: (user for user in iter_active_users() if user.get('group', '') in ARIA_GROUPS),
+        process,
+        item_id=lambda user: user.get('user_id', ''),
+        keep_ids=('pushed',),
+        summary={'date': tw_today, 'multicast': NUDGE_MULTICAST},
+        chunk_size=chunk_size
+    )
+    if started:
+        print(f'[ARIA NUDGE] Starting daily nudge for Aria bot, date: {tw_today}, job: {job.job_id}')
+    else:
+        print(f'[ARIA NUDGE] Daily nudge already running: {job.job_id}')
+    return jsonify({
+        'status': 'started' if started else 'already_running',
+        'job_id': job.job_id,
+        'status_url': f'/jobs/status/{job.job_id}'
+    }), 202
+
+def fetch_active_users_page(cursor):
+    """Sheets get_active_users 的一頁；回傳 (users, next_cursor)，next_cursor 為空表示最後一頁"""
+    params = {'action': 'get_active_users', 'limit': SHEETS_PAGE_SIZE}
+    if cursor:
+        params['cursor'] = cursor
+    resp = sheets_http.get(SHEETS_API_URL, params=params, timeout=15)
+    resp.raise_for_status()
+    data = resp.json()
+    return data.get('users', []), data.get('next_cursor')
+
+def iter_active_users():
+    """逐筆取得所有 Active 用戶：分頁讀取，處理目前這頁時背景預取下一頁"""
+    return iter_paged(fetch_active_users_page, prefetch=2, label='ARIA JOBS')
+
+def fetch_participants_page(since, cursor):
+    """Sheets get_participants 的一頁（participants_mirror 同步用）；since 為空時是全量載入"""
+    params = {'action': 'get_participants', 'limit': SHEETS_PAGE_SIZE}
+    if since:
+        params['since'] = since
+    if cursor:
+        params['cursor'] = cursor
+    response = sheets_http.get(SHEETS_API_URL, params=params, timeout=15)
+    return _parse_json_response(response, 'Google Sheets')
+
+def _nudge_skip_reason(user, tw_today):
+    """每日推播的跳過條件；回傳結果名稱，None 表示應推播"""
+    user_id = user.get('user_id', '')
+    last_interaction = user.get('last_interaction', '')
+
+    # 今天已互動 → 跳過
+    if last_interaction and last_interaction[:10] == tw_today:
+        print(f'[ARIA NUDGE] Skip {user_id} (interacted today)')
+        return 'skipped_interacted'
+
+    # 今天已推播 → 跳過
+    if user.get('last_nudge_date', '') == tw_today:
+        print(f'[ARIA NUDGE] Skip {user_id} (already nudged today)')
+        return 'skipped_already_nudged'
+    return None
 
+def _after_nudge(user, tw_today):
+    """推播成功後的個別處理：快取、Last_Nudge_Date、對話記錄"""
+    user_id = user.get('user_id', '')
+    code = user.get('code', '')
+
+    # Pre-warm SQLite 快取（讓用戶回覆時不需再打 Sheets）
+    cache_user_data(user_id, {
+        'group': user.get('group', ''),
+        'code': code,
+        'current_day': user.get('current_day', ''),
+        'first_interaction': user.get('first_interaction', ''),
+        'd7_triggered': user.get('d7_triggered', False),
+    })
+
+    # 寫回 Sheets：更新 Last_Nudge_Date（outbox 背景送出）
+    sheets_outbox.put(user_id, 'last_nudge_date', {'user_id': user_id, 'last_nudge_date': tw_today})
+
+    # 記錄到 Conversation_Logs（journal 背景批次上傳）
+    log_conversation(user_id, code, 'ai', NUDGE_MESSAGE, True, 'nudge', None)
+
+def _nudge_user(user, tw_today):
+    """單一使用者的每日推播（NUDGE_MULTICAST=0 時在 batch_jobs 的 worker 執行）；回傳結果名稱"""
+    skipped = _nudge_skip_reason(user, tw_today)
+    if skipped:
+        return skipped
+
+    # 發送推播（等待 LINE 速率上限的 token）
+    line_push_bucket.acquire()
+    if not send_line_push(user.get('user_id', ''), NUDGE_MESSAGE):
+        return 'failed'
+    _after_nudge(user, tw_today)
+    return 'pushed'
+
+def _nudge_users(users, tw_today):
+    """
+    一批使用者（最多 LINE_MULTICAST_MAX 位）的每日推播；回傳 {結果: [user_id, ...] 或次數}
+    符合條件的使用者以一次 multicast 送出；LINE 明確以 4xx 拒絕時改為逐一 push，個別失敗記為 failed。
+    5xx / 逾時等結果不明時以同一個 retry key 重送，仍不明則記為 unconfirmed，不改逐一 push（避免重複推播）
+    """
+    results = {}
+    eligible = []
     for user in users:
-        user_id = user.get('user_id', '')
-        group = user.get('group', '')
-        code = user.get('code', '')
-        last_interaction = user.get('last_interaction', '')
-        last_nudge_date = user.get('last_nudge_date', '')
-
-        # 只處理 Aria 的組別
-        if group not in ARIA_GROUPS:
-            continue
-
-        # 今天已互動 → 跳過
-        if last_interaction and last_interaction[:10] == tw_today:
-            skipped_interacted.append(user_id)
-            print(f'[ARIA NUDGE] Skip {user_id} (interacted today)')
-            continue
-
-        # 今天已推播 → 跳過
-        if last_nudge_date == tw_today:
-            skipped_nudged.append(user_id)
-            print(f'[ARIA NUDGE] Skip {user_id} (already nudged today)')
-            continue
-
-        # 發送推播
-        success = send_line_push(user_id, NUDGE_MESSAGE)
-        if success:
-            pushed.append(user_id)
-
-            # Pre-warm SQLite 快取（讓用戶回覆時不需再打 Sheets）
-            cache_user_data(user_id, {
-                'group': group,
-                'code': code,
-                'current_day': user.get('current_day', ''),
-                'd7_triggered': user.get('d7_triggered', False),
-            })
-
-            # 寫回 Sheets：更新 Last_Nudge_Date
-            try:
-                requests.post(
-                    SHEETS_API_URL,
-                    json={'user_id': user_id, 'last_nudge_date': tw_today},
-                    timeout=10
-                )
-            except Exception as e:
-                print(f'[ARIA NUDGE] Failed to update last_nudge_date for {user_id}: {str(e)}')
-
-            # 記錄到 Conversation_Logs
-            log_conversation(user_id, code, 'ai', NUDGE_MESSAGE, True, 'nudge', None)
+        skipped = _nudge_skip_reason(user, tw_today)
+        if skipped:
+            results.setdefault(skipped, []).append(user.get('user_id', ''))
         else:
-            failed.append(user_id)
-
-    result = {
-        'date': tw_today,
-        'pushed': len(pushed),
-        'skipped_interacted': len(skipped_interacted),
-        'skipped_already_nudged': len(skipped_nudged),
-        'failed': len(failed),
-        'pushed_ids': pushed
-    }
-    print(f'[ARIA NUDGE] Done: {result}')
-    return jsonify(result), 200
+            eligible.append(user)
+    if not eligible:
+        return results
+
+    # multicast 一次請求只取一個 token
+    user_ids = [user.get('user_id', '') for user in eligible]
+    retry_key = str(uuid.uuid4())
+    for attempt in range(LINE_MULTICAST_RETRIES + 1):
+        line_push_bucket.acquire()
+        outcome = send_line_multicast(user_ids, NUDGE_MESSAGE, retry_key)
+        results['multicast_requests'] = results.get('multicast_requests', 0) + 1
+        if outcome != 'unknown':
+            break
+        if attempt < LINE_MULTICAST_RETRIES:
+            print(f'[ARIA NUDGE] Multicast result unknown, retrying with the same retry key ({attempt + 1}/{LINE_MULTICAST_RETRIES})')
+            _multicast_retry_sleep(2 ** attempt)
+
+    if outcome == 'sent':
+        delivered = eligible
+    elif outcome == 'failed':
+        print(f'[ARIA NUDGE] Multicast failed, falling back to push for {len(eligible)} users')
+        delivered = []
+        for user in eligible:
+            line_push_bucket.acquire()
+            if send_line_push(user.get('user_id', ''), NUDGE_MESSAGE):
+                delivered.append(user)
+            else:
+                results.setdefault('failed', []).append(user.get('user_id', ''))
+        results['fallback_pushes'] = len(eligible)
+    else:
+        print(f'[ARIA NUDGE] Multicast result unknown after {LINE_MULTICAST_RETRIES + 1} attempts, not falling back to push ({len(eligible)} users)')
+        delivered = []
+        results['unconfirmed'] = user_ids
+
+    for user in delivered:
+        _after_nudge(user, tw_today)
+    results['pushed'] = [user.get('user_id', '') for user in delivered]
+    return results
+
+@app.route('/jobs/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """背景工作進度（需 JOB_SECRET）"""
+    secret = request.headers.get('X-Job-Secret') or request.args.get('secret', '')
+    if not JOB_SECRET or secret != JOB_SECRET:
+        return jsonify({'error': 'Unauthorized'}), 401
+    job = batch_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict()), 200
 
 
 @app.route('/jobs/d7-trigger', methods=['POST'])
 def d7_trigger():
-    """Cron Job 觸發：Day 7 推播引導句，等待用戶回覆後再發衝突句（僅限 Aria bot：E/F/G/H 組）"""
+    """
+    Cron Job 觸發：Day 7 推播引導句，等待用戶回覆後再發衝突句（僅限 Aria bot：E/F/G/H 組）
+    立即回傳 job_id（202），推播在背景並行執行；每位使用者推播前先在 SQLite 認領（d7_setup_claims），
+    cron 重複觸發或逾時重跑時，本輪已推播的使用者會略過
+    """
     return jsonify({'status': 'disabled'}), 503  # 暫停 cron job
     secret = request.headers.get('X-Job-Secret') or request.args.get('secret', '')
     if not JOB_SECRET or secret != JOB_SECRET:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    print(f'[ARIA D7] Starting d7-trigger job for Aria bot')
-
-    try:
-        resp = requests.get(f'{SHEETS_API_URL}?action=get_active_users', timeout=15)
-        users = resp.json().get('users', [])
-    except Exception as e:
-        print(f'[ARIA D7] Failed to fetch users: {str(e)}')
-        return jsonify({'error': 'Failed to fetch users'}), 500
-
-    pushed = []
-    skipped = []
-    failed = []
-
-    for user in users:
-        user_id = user.get('user_id', '')
-        group = user.get('group', '')
-        code = user.get('code', '')
-        current_day = user.get('current_day', 0)
-        d7_triggered = user.get('d7_triggered', False)
-
-        # 只處理 Aria 的組別
-        if group not in ARIA_GROUPS:
-            continue
-
-        # 只處理 Day 7 且尚未觸發過衝突的用戶
-        if current_day != CONFLICT_DAY or d7_triggered:
-            skipped.append(user_id)
-            continue
-
-        # 避免重複發送：若 d7_setup 已為 1 則跳過
-        if get_d7_setup(user_id):
-            skipped.append(user_id)
-            print(f'[ARIA D7] Skip {user_id} (d7_setup already set)')
-            continue
-
-        setup_message = D7_SETUP_MESSAGES.get(group, '')
-        if not setup_message:
-            skipped.append(user_id)
-            continue
-
-        success = send_line_push(user_id, setup_message)
-        if success:
-            pushed.append(user_id)
-            set_d7_setup(user_id, 1)
-            log_conversation(user_id, code, 'ai', setup_message, True, 'd7_setup', current_day)
-            print(f'[ARIA D7] Sent setup message to {user_id} (group={group})')
-        else:
-            failed.append(user_id)
+    run_key = datetime.now(TW_TZ).date().isoformat()
+    job, started = batch_jobs.start(
+        'd7-trigger', iter_active_users,
+        lambda user: _d7_setup_user(user, run_key),
+        item_id=lambda user: user.get('user_id', ''),
+        keep_ids=('pushed',),
+        summary={'run_key': run_key},
+        finalize=lambda: {'checkpoint': d7_setup_checkpoint(run_key)}
+    )
+    if started:
+        print(f'[ARIA D7] Starting d7-trigger job for Aria bot, run: {run_key}, job: {job.job_id}')
+    else:
+        print(f'[ARIA D7] d7-trigger already running: {job.job_id}')
+    return jsonify({
+        'status': 'started' if started else 'already_running',
+        'job_id': job.job_id,
+        'status_url': f'/jobs/status/{job.job_id}'
+    }), 202
+
+def _d7_setup_user(user, run_key):
+    """單一使用者的 Day 7 引導句推播（在 batch_jobs 的 worker 執行）；回傳結果名稱，None 表示不屬於此 Bot"""
+    user_id = user.get('user_id', '')
+    group = user.get('group', '')
+    code = user.get('code', '')
+    current_day = user.get('current_day', 0)
+    d7_triggered = user.get('d7_triggered', False)
+
+    # 只處理 Aria 的組別
+    if group not in ARIA_GROUPS:
+        return None
 
-    result = {
-        'pushed': len(pushed),
-        'skipped': len(skipped),
-        'failed': len(failed),
-        'pushed_ids': pushed
-    }
-    print(f'[ARIA D7] Done: {result}')
-    return jsonify(result), 200
+    # 只處理 Day 7 且尚未觸發過衝突的用戶
+    if current_day != CONFLICT_DAY or d7_triggered:
+        return 'skipped'
+
+    # 避免重複發送：若 d7_setup 已為 1 則跳過
+    if get_d7_setup(user_id):
+        print(f'[ARIA D7] Skip {user_id} (d7_setup already set)')
+        return 'skipped'
+
+    setup_message = D7_SETUP_MESSAGES.get(group, '')
+    if not setup_message:
+        return 'skipped'
+
+    # 認領：本輪已推播，或另一個執行正在處理 → 跳過
+    if not try_claim_d7_setup(run_key, user_id):
+        print(f'[ARIA D7] Skip {user_id} (already claimed in run {run_key})')
+        return 'already_claimed'
+
+    start = time.time()
+    line_push_bucket.acquire()
+    success = send_line_push(user_id, setup_message)
+    finish_d7_setup_claim(run_key, user_id, success, int((time.time() - start) * 1000))
+    if not success:
+        return 'failed'
+
+    set_d7_setup(user_id, 1)
+    if D7_CONFLICT_POOL:
+        conflict_pool.prefill(user_id, group)
+    log_conversation(user_id, code, 'ai', setup_message, True, 'd7_setup', current_day)
+    print(f'[ARIA D7] Sent setup message to {user_id} (group={group})')
+    return 'pushed'
+
+
+# ========== Webhook 事件佇列 ==========
+
+def _process_queued_event(event, enqueued_at):
+    """背景 worker 處理佇列中的 LINE 事件"""
+    waited = time.time() - enqueued_at
+    if waited > REPLY_TOKEN_TTL:
+        print(f'[ARIA WARNING] Event waited {waited:.1f}s in queue, reply token may have expired')
+    result = handle_message_event(event)
+    print(f'[ARIA] Queued event processed in {time.time() - enqueued_at:.2f}s: {result.get("status")}')
+
+def run_after_reply(user_id, tasks):
+    """回覆送出後的記帳工作（對話記錄等）交給背景 executor；同一使用者依提交順序執行，記錄順序不會亂"""
+    if tasks:
+        bookkeeping_executor.submit(user_id, _run_bookkeeping, tasks)
+
+def _run_bookkeeping(tasks):
+    for fn, args in tasks:
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f'[ARIA] Bookkeeping {fn.__name__} failed: {str(e)}')
+
+event_executor = KeyedExecutor(max_workers=EVENT_WORKERS, name='line-event')
+bookkeeping_executor = KeyedExecutor(max_workers=2, name='bookkeeping')
+d7_speculation = SpeculativeRunner(max_workers=EVENT_WORKERS)
+conflict_pool = ConflictPool(STATE_DB_PATH, generate_conflict_pool, per_emotion=D7_CONFLICT_POOL_SIZE)
+reply_guard = ReplyDeadlineGuard(
+    send_line_reply, send_line_push,
+    ttl=REPLY_TOKEN_TTL, safety_margin=REPLY_SAFETY_MARGIN, holding_message=HOLDING_MESSAGE,
+    max_workers=EVENT_WORKERS, label='REPLY'
+)
+event_queue = DurableQueue(STATE_DB_PATH, 'line_events')
+event_consumer = QueueConsumer(event_queue, _process_queued_event, workers=EVENT_WORKERS, label='QUEUE')
+if WEBHOOK_ASYNC:
+    event_consumer.start()
+    atexit.register(event_consumer.stop)
+
+memory_sync = MemorySyncPipeline(
+    DurableQueue(STATE_DB_PATH, 'dify_memory'),
+    _sync_dify_memory,
+    workers=MEMORY_SYNC_WORKERS,
+    max_pending=MEMORY_SYNC_MAX_PENDING
+)
+memory_sync.start()
+atexit.register(memory_sync.drain)
+
+# Participants 本地鏡像（啟動時背景全量載入，之後定期 delta sync；outbox 還有未送出寫入的使用者不覆蓋）
+participants_mirror = ParticipantsMirror(
+    STATE_DB_PATH, fetch_participants_page, TW_TZ,
+    interval=PARTICIPANTS_SYNC_INTERVAL, is_pending=sheets_outbox.pending_users, label='ARIA PARTICIPANTS'
+)
+if PARTICIPANTS_MIRROR:
+    participants_mirror.start()
+    atexit.register(participants_mirror.stop)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """背景佇列 / 執行器狀態（需 JOB_SECRET）"""
+    secret = request.headers.get('X-Job-Secret') or request.args.get('secret', '')
+    if not JOB_SECRET or secret != JOB_SECRET:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({
+        'event_executor': event_executor.stats(),
+        'bookkeeping_executor': bookkeeping_executor.stats(),
+        'reply_guard': reply_guard.stats(),
+        'dify_stream': dify_stream_stats.stats(),
+        'classifier_cache': classifier_cache.stats(),
+        'response_model': response_model.stats(),
+        'd7_speculation': d7_speculation.stats(),
+        'd7_conflict_pool': conflict_pool.stats(),
+        'event_queue_pending': event_queue.pending_count(),
+        'memory_sync': memory_sync.stats(),
+        'http_pools': http_pool.stats(),
+        'sheets_outbox': sheets_outbox.stats(),
+        'log_shipper': log_shipper.stats(),
+        'batch_jobs': batch_jobs.stats(),
+        'participants_mirror': participants_mirror.stats(),
+    }), 200
 
 
 if __name__ == '__main__':
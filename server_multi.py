@@ -0,0 +1,118 @@
+"""
+Alex + Aria 單一行程（多 Bot 伺服器）
+
+server.py 與 server-aria.py 分開部署時是兩個行程：兩套 HTTP 連線池、兩次冷啟動、兩份 Python runtime。
+這裡用 importlib 在同一個行程載入兩個 Bot 模組，依路徑分派：
+
+- /webhook/alex、/webhook/aria → 各 Bot 的 /webhook（LINE Developers 後台的 Webhook URL 改成這兩個）
+- /alex/<路徑>、/aria/<路徑> → 各 Bot 的其他路由（/alex/jobs/daily-nudge、/aria/jobs/d7-trigger、/alex/metrics …）
+- /、/metrics → 健康檢查與兩個 Bot 合併的 metrics（需 JOB_SECRET）
+
+共用：http_pool 的連線池（模組層級，同一行程只建立一次）、state_store 引擎表、import 過的共用模組。
+各 Bot 仍各自一個 STATE_DB_PATH（事件佇列、outbox、journal 等表以 Bot 為單位，不能混用）。
+
+設定：Bot 模組在 import 時讀取環境變數。載入某個 Bot 時，`<前綴>_<名稱>` 會暫時覆蓋 `<名稱>`，
+例如 ALEX_STATE_DB_PATH、ARIA_RESPONSE_MODEL_PATH、ARIA_NUDGE_MESSAGE；沒有前綴版本時用共用值。
+STATE_DB_PATH 沒有前綴版本時一律用各 Bot 的預設檔名（state_alex.db / state_aria.db），不會共用同一個 DB。
+覆蓋只在 import 期間有效，所以 Bot 模組的設定都在 import 時讀成模組常數（含 OPENAI_API_KEY），執行期不再讀 os.environ。
+不能依 Bot 分開設定的：HTTP_POOL_SIZE_*（http_pool 的連線池整個行程共用，以第一個載入的 Bot 為準）與 PORT（server_multi 自己讀取）。
+
+啟動：
+    gunicorn -w 1 -b 0.0.0.0:${PORT:-10000} server_multi:app
+"""
+import importlib.util
+import os
+import sys
+from contextlib import contextmanager
+
+from flask import Flask, jsonify
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Bot 名稱 → 模組檔案與環境變數前綴
+TENANTS = {
+    'alex': {'file': 'server.py', 'env_prefix': 'ALEX_'},
+    'aria': {'file': 'server-aria.py', 'env_prefix': 'ARIA_'},
+}
+
+# 一定要分開的設定：沒有前綴版本時改用 Bot 模組自己的預設值，而不是共用值
+ISOLATED_ENV = ('STATE_DB_PATH',)
+
+
+@contextmanager
+def tenant_env(prefix):
+    """載入 Bot 模組期間套用 `<前綴>_*` 環境變數，結束後還原"""
+    saved = dict(os.environ)
+    for key in ISOLATED_ENV:
+        os.environ.pop(key, None)
+    for key, value in saved.items():
+        if key.startswith(prefix) and len(key) > len(prefix):
+            os.environ[key[len(prefix):]] = value
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def load_tenant(name, config):
+    module_name = f'bot_{name}'
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, config['file']))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    with tenant_env(config['env_prefix']):
+        spec.loader.exec_module(module)
+    print(f'[MULTI] Loaded {name} from {config["file"]} (state db: {module.STATE_DB_PATH})')
+    return module
+
+
+class BotDispatcher:
+    """依路徑把 WSGI 請求交給對應 Bot 的 Flask app；其他路徑交給 root app"""
+
+    def __init__(self, root_app, tenants):
+        self.root_app = root_app
+        self.tenants = tenants
+
+    def __call__(self, environ, start_response):
+        parts = environ.get('PATH_INFO', '').strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'webhook' and parts[1] in self.tenants:
+            return self._forward(parts[1], '/webhook', environ, start_response)
+        if parts[0] in self.tenants:
+            return self._forward(parts[0], '/' + '/'.join(parts[1:]), environ, start_response)
+        return self.root_app(environ, start_response)
+
+    def _forward(self, name, path, environ, start_response):
+        environ = dict(environ, PATH_INFO=path, SCRIPT_NAME=environ.get('SCRIPT_NAME', '') + f'/{name}')
+        return self.tenants[name].app(environ, start_response)
+
+
+bots = {name: load_tenant(name, config) for name, config in TENANTS.items()}
+
+root_app = Flask(__name__)
+
+
+@root_app.route('/', methods=['GET'])
+def health():
+    return 'OK', 200
+
+
+@root_app.route('/metrics', methods=['GET'])
+def metrics():
+    """兩個 Bot 的 /metrics 合併（需 JOB_SECRET；各 Bot 自己檢查）"""
+    result = {}
+    for name, bot in bots.items():
+        with bot.app.app_context():
+            response, status = bot.app.view_functions['metrics']()
+        if status != 200:
+            return response, status
+        result[name] = response.get_json()
+    return jsonify(result), 200
+
+
+app = BotDispatcher(root_app, bots)
+
+
+if __name__ == '__main__':
+    from werkzeug.serving import run_simple
+    port = int(os.environ.get('PORT', 10000))
+    run_simple('0.0.0.0', port, app, threaded=True)
@@ -0,0 +1,204 @@
+"""
+Google Sheets 狀態鏡像 outbox（Alex / Aria 共用）
+
+d7_turn、last_interaction、d7_trigger 等鏡像寫入原本同步 POST 到 Apps Script（每次 1～3 秒），
+直接卡在回覆路徑上。改為：
+
+- 先寫入本地 SQLite outbox（與 bot_state 同一個 DB），呼叫端立即返回
+- 同一使用者 + 同一種操作（op）只保留一筆：重複更新合併成最新值（coalesce）
+- 背景 thread 依首次入列順序 flush，失敗時指數退避重試；
+  同一使用者較早的寫入還沒成功前，不會送出他較晚的寫入
+"""
+import json
+import threading
+import time
+import traceback
+
+from state_store import get_engine
+
+
+def _merge_last_interaction(old, new):
+    # 合併期間只要有一次是「今天第一次互動」，送出時就必須保留 True
+    merged = dict(new)
+    merged['is_first_today'] = bool(old.get('is_first_today')) or bool(new.get('is_first_today'))
+    return merged
+
+
+# op -> 合併函式（未列出的 op 直接以新值覆蓋）
+MERGERS = {
+    'last_interaction': _merge_last_interaction,
+}
+
+
+class SheetsOutbox:
+    def __init__(self, db_path, http, url_getter, interval=1.0, batch_size=50, max_backoff=300, label='OUTBOX'):
+        self.db_path = db_path
+        self.http = http
+        self.url_getter = url_getter  # 每次 flush 時讀取 URL（SHEETS_API_URL 可能未設定）
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.label = label
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'coalesced': 0, 'sent': 0, 'failed': 0}
+        self._init_table()
+
+    def _conn(self):
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        self._conn().execute(
+            '''
+            CREATE TABLE IF NOT EXISTS sheets_outbox (
+                user_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, op)
+            )
+            '''
+        )
+
+    def put(self, user_id, op, payload):
+        """寫入（或合併）一筆待同步的 Sheets 更新"""
+        conn = self._conn()
+        now = time.time()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT payload FROM sheets_outbox WHERE user_id = ? AND op = ?',
+                (user_id, op)
+            ).fetchone()
+            if row:
+                merger = MERGERS.get(op)
+                merged = merger(json.loads(row[0]), payload) if merger else payload
+                conn.execute(
+                    'UPDATE sheets_outbox SET payload = ?, version = version + 1, attempts = 0, '
+                    'next_attempt_at = 0, updated_at = ? WHERE user_id = ? AND op = ?',
+                    (json.dumps(merged, ensure_ascii=False), now, user_id, op)
+                )
+            else:
+                conn.execute(
+                    'INSERT INTO sheets_outbox (user_id, op, payload, seq, updated_at) '
+                    'VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM sheets_outbox), ?)',
+                    (user_id, op, json.dumps(payload, ensure_ascii=False), now)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        self._incr('coalesced' if row else 'enqueued')
+        self._wakeup.set()
+
+    def discard(self, user_id):
+        """RESET 時丟棄該使用者尚未送出的更新"""
+        self._conn().execute('DELETE FROM sheets_outbox WHERE user_id = ?', (user_id,))
+
+    def pending_users(self, user_ids):
+        """user_ids 中在 outbox 還有未送出寫入的使用者"""
+        user_ids = list(user_ids)
+        pending = set()
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            rows = self._conn().execute(
+                f'SELECT DISTINCT user_id FROM sheets_outbox WHERE user_id IN ({", ".join("?" * len(chunk))})',
+                chunk
+            ).fetchall()
+            pending.update(row[0] for row in rows)
+        return pending
+
+    def pending_count(self):
+        row = self._conn().execute('SELECT COUNT(*) FROM sheets_outbox').fetchone()
+        return row[0] if row else 0
+
+    def flush_once(self):
+        """送出一批到期的更新，回傳成功筆數"""
+        url = self.url_getter()
+        if not url:
+            return 0
+        now = time.time()
+        rows = self._conn().execute(
+            'SELECT user_id, op, payload, version, attempts, next_attempt_at '
+            'FROM sheets_outbox ORDER BY seq LIMIT ?',
+            (self.batch_size,)
+        ).fetchall()
+
+        blocked = set()  # 本輪已失敗或尚未到重試時間的使用者，後面的寫入先不送
+        sent = 0
+        for user_id, op, payload, version, attempts, next_attempt_at in rows:
+            if user_id in blocked:
+                continue
+            if next_attempt_at > now:
+                blocked.add(user_id)
+                continue
+            try:
+                response = self.http.post(url, json=json.loads(payload), timeout=10)
+                ok = response.status_code == 200
+                error = None if ok else f'HTTP {response.status_code}'
+            except Exception as e:
+                ok = False
+                error = str(e)
+
+            if ok:
+                # 送出期間若又被合併更新（version 變了），保留該筆下次再送
+                self._conn().execute(
+                    'DELETE FROM sheets_outbox WHERE user_id = ? AND op = ? AND version = ?',
+                    (user_id, op, version)
+                )
+                sent += 1
+                self._incr('sent')
+            else:
+                blocked.add(user_id)
+                backoff = min(self.max_backoff, 2 ** attempts)
+                self._conn().execute(
+                    'UPDATE sheets_outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? '
+                    'WHERE user_id = ? AND op = ? AND version = ?',
+                    (time.time() + backoff, error[:300], user_id, op, version)
+                )
+                self._incr('failed')
+                print(f'[{self.label}] {op} for {user_id} failed (attempt {attempts + 1}): {error}, retry in {backoff}s')
+        return sent
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'{self.label.lower()}-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """停止背景 thread 並盡量把剩下的更新送出"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        try:
+            self.flush_once()
+        except Exception as e:
+            print(f'[{self.label}] Final flush failed: {str(e)}')
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        data['pending'] = self.pending_count()
+        return data
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush_once()
+            except Exception as e:
+                print(f'[{self.label}] Flush error: {str(e)}')
+                traceback.print_exc()
+
+    def _incr(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
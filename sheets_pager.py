@@ -0,0 +1,62 @@
+"""
+Sheets 分頁讀取（Alex / Aria 共用）
+
+cron job 原本以一次 GET ?action=get_active_users 取回整張名單再 resp.json()，
+受試者一多單次請求就逾時（15 秒），整個工作失敗。改為：
+
+- 以 cursor / limit 分頁請求，每頁各自有 timeout
+- 背景 thread 先抓下一頁（最多預取 prefetch 頁），呼叫端處理第 1 頁時第 2 頁已在傳輸中
+- 以 generator 逐筆交出，記憶體只保留預取中的幾頁，與名單大小無關
+- Apps Script 尚未支援分頁時（回應沒有 next_cursor）等同一次取回全部，行為與舊版相同
+
+Apps Script 端的分頁約定見 ARCHITECTURE.md「八、Google Apps Script API 端點」。
+"""
+import queue
+import threading
+
+_DONE = object()
+
+
+def iter_paged(fetch_page, prefetch=2, label='SHEETS'):
+    """
+    fetch_page(cursor) -> (items, next_cursor)；第一頁 cursor 為 None，next_cursor 為空時結束。
+    逐筆 yield items；抓取失敗時在呼叫端（generator 所在 thread）重新拋出例外。
+    """
+    pages = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def producer():
+        cursor = None
+        try:
+            while not stop.is_set():
+                items, cursor = fetch_page(cursor)
+                _put(pages, stop, list(items or []))
+                if not cursor:
+                    break
+        except Exception as e:
+            print(f'[{label}] Page fetch failed (cursor={cursor}): {str(e)}')
+            _put(pages, stop, e)
+        finally:
+            _put(pages, stop, _DONE)
+
+    threading.Thread(target=producer, name=label.lower().replace(' ', '-') + '-pager', daemon=True).start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        # 呼叫端提早結束（break / 例外）時讓 producer 停止預取
+        stop.set()
+
+
+def _put(pages, stop, value):
+    while not stop.is_set():
+        try:
+            pages.put(value, timeout=0.5)
+            return
+        except queue.Full:
+            continue
@@ -0,0 +1,84 @@
+"""
+推測執行（Alex / Aria 共用）
+
+Day 7 turn 1 原本先等 has_sharing_content 的結果，確定要觸發衝突後才呼叫 generate_conflict_sentence，
+兩次 OpenAI 往返串在一起。推測執行在分類的同時先在背景生成衝突句：
+
+- 分類結果需要衝突句 → result() 取用（背景已跑了一段時間，等待時間變短）
+- 分類結果不需要 → discard()：尚未開始就取消；已開始的讓它跑完，記為浪費
+- fn 需回傳 (值, 花費)，花費（token 數）用來統計推測造成的浪費
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SpeculativeRunner:
+    def __init__(self, max_workers=4, label='SPECULATIVE'):
+        self.label = label
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='speculative')
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'started': 0,
+            'used': 0,             # 推測結果被採用
+            'discarded': 0,        # 分類決定不需要
+            'cancelled': 0,        # discard 時尚未開始執行，沒有花費
+            'failed': 0,
+            'used_tokens': 0,
+            'wasted_calls': 0,     # 已送出但結果被丟棄的呼叫
+            'wasted_tokens': 0,
+            'head_start_ms': 0,    # 取用時推測已經先跑的時間（累計）
+        }
+
+    def start(self, fn, *args):
+        self._incr('started')
+        return Speculation(self, self._pool.submit(fn, *args))
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._stats)
+        data['avg_head_start_ms'] = int(data['head_start_ms'] / data['used']) if data['used'] else None
+        return data
+
+    def _incr(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+
+class Speculation:
+    def __init__(self, runner, future):
+        self.runner = runner
+        self.future = future
+        self.started_at = time.time()
+
+    def result(self, timeout=None):
+        """採用推測結果；fn 的例外會原樣丟出"""
+        runner = self.runner
+        head_start_ms = int((time.time() - self.started_at) * 1000)
+        try:
+            value, cost = self.future.result(timeout=timeout)
+        except Exception:
+            runner._incr('failed')
+            raise
+        runner._incr('used')
+        runner._incr('head_start_ms', head_start_ms)
+        runner._incr('used_tokens', cost or 0)
+        return value
+
+    def discard(self):
+        """不需要推測結果：未開始就取消，已開始則在完成時記錄浪費的花費"""
+        runner = self.runner
+        runner._incr('discarded')
+        if self.future.cancel():
+            runner._incr('cancelled')
+            return
+        self.future.add_done_callback(self._record_waste)
+
+    def _record_waste(self, future):
+        runner = self.runner
+        runner._incr('wasted_calls')
+        try:
+            _, cost = future.result()
+            runner._incr('wasted_tokens', cost or 0)
+        except Exception:
+            pass
@@ -0,0 +1,147 @@
+"""
+SQLite 連線引擎（Alex / Aria 共用）
+
+原本每個 getter / setter 都 sqlite3.connect() 一次，每次 commit 都要 journal fsync。
+改為每個 thread 保留一條長連線：
+
+- journal_mode=WAL：讀寫不互鎖，commit 只需 append WAL
+- synchronous=NORMAL：WAL 模式下仍保證一致性，只在 checkpoint 時 fsync
+- cache_size / temp_store=MEMORY：常用頁面留在記憶體
+- cached_statements：同一條連線重用已編譯的 SQL（prepared statement）
+
+連線用法與 sqlite3 相同：`with engine.connection() as conn:` 結束時 commit，例外時 rollback；
+連線不會被關閉，同一 thread 下次呼叫會拿到同一條。
+"""
+import sqlite3
+import threading
+
+
+class SQLiteEngine:
+    def __init__(self, db_path, isolation_level='', cache_size_kb=8192, timeout=5):
+        self.db_path = db_path
+        self.isolation_level = isolation_level  # None = autocommit（自行 BEGIN / COMMIT）
+        self.cache_size_kb = cache_size_kb
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.timeout,
+                isolation_level=self.isolation_level,
+                cached_statements=256
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA cache_size=-{self.cache_size_kb}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """關閉目前 thread 的連線（測試 / benchmark 用）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_path, isolation_level=''):
+    """同一個 DB 檔 + isolation_level 共用同一個 engine"""
+    key = (db_path, isolation_level)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = SQLiteEngine(db_path, isolation_level=isolation_level)
+            _engines[key] = engine
+        return engine
+
+
+# ========== bot_state 單列快照 ==========
+
+# bot_state 除 user_id 以外的欄位與預設值
+BOT_STATE_DEFAULTS = {
+    'conversation_id': None,
+    'd7_turn': 0,
+    'd7_setup': 0,
+    'd7_fired': 0,
+    'last_interaction_date': None,
+    'cache_group': None,
+    'cache_code': None,
+    'cache_current_day': None,
+    'cache_first_interaction': None,
+    'cache_d7_triggered': 0,
+    'cache_day': None,
+}
+
+
+class UserState:
+    """
+    一個使用者的 bot_state 快照：事件開始時一次 SELECT 載入，
+    處理過程中直接讀寫屬性（例如 state.d7_turn = 2），結束時 flush() 以一次 UPSERT 寫回有變更的欄位。
+    """
+    __slots__ = ('user_id', '_dirty') + tuple(BOT_STATE_DEFAULTS)
+
+    def __init__(self, user_id, values=None):
+        object.__setattr__(self, 'user_id', user_id)
+        object.__setattr__(self, '_dirty', set())
+        values = values or {}
+        for column, default in BOT_STATE_DEFAULTS.items():
+            value = values.get(column)
+            object.__setattr__(self, column, default if value is None else value)
+
+    def __setattr__(self, name, value):
+        if name not in BOT_STATE_DEFAULTS:
+            raise AttributeError(f'UserState has no column {name}')
+        if getattr(self, name) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def load(cls, conn, user_id):
+        columns = ', '.join(BOT_STATE_DEFAULTS)
+        row = conn.execute(
+            f'SELECT {columns} FROM bot_state WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+        return cls(user_id, dict(zip(BOT_STATE_DEFAULTS, row)) if row else None)
+
+    def refresh(self, conn, *columns):
+        """重新讀取指定欄位（例如背景工作可能已更新 conversation_id）"""
+        row = conn.execute(
+            f'SELECT {", ".join(columns)} FROM bot_state WHERE user_id = ?',
+            (self.user_id,)
+        ).fetchone()
+        for column, value in zip(columns, row or [None] * len(columns)):
+            object.__setattr__(self, column, BOT_STATE_DEFAULTS[column] if value is None else value)
+            self._dirty.discard(column)
+
+    def mark_clean(self, *columns):
+        """欄位已由其他原子操作寫入 DB（例如 try_lock_d7_fired），flush 時不必再寫"""
+        for column in columns:
+            self._dirty.discard(column)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    def flush(self, conn):
+        """將有變更的欄位以一次 UPSERT 寫回；沒有變更時不做任何事"""
+        if not self._dirty:
+            return False
+        columns = sorted(self._dirty)
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f'{c} = excluded.{c}' for c in columns)
+        conn.execute(
+            f'INSERT INTO bot_state (user_id, {", ".join(columns)}) VALUES (?, {placeholders}) '
+            f'ON CONFLICT(user_id) DO UPDATE SET {updates}',
+            (self.user_id, *[getattr(self, c) for c in columns])
+        )
+        self._dirty.clear()
+        return True
@@ -0,0 +1,60 @@
+"""
+測試共用：以 importlib 載入 server.py / server-aria.py（各自一個暫存 STATE_DB_PATH），
+上游 HTTP（Dify / LINE / Sheets）由各測試以 monkeypatch 替換，不會真的連線。
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_ENV = {
+    'DIFY_KEY_A': 'key-a', 'DIFY_KEY_B': 'key-b', 'DIFY_KEY_C': 'key-c', 'DIFY_KEY_D': 'key-d',
+    'DIFY_KEY_E': 'key-e', 'DIFY_KEY_F': 'key-f', 'DIFY_KEY_G': 'key-g', 'DIFY_KEY_H': 'key-h',
+    'JOB_SECRET': 'test-secret',
+}
+
+
+def _load_server(name, filename, db_path):
+    saved = dict(os.environ)
+    os.environ.update(BOT_ENV)
+    os.environ['STATE_DB_PATH'] = str(db_path)
+    for key in ('OPENAI_API_KEY', 'SHEETS_API_URL', 'DIFY_MEMORY_TEMPLATE', 'WEBHOOK_ASYNC'):
+        os.environ.pop(key, None)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+@pytest.fixture(scope='session')
+def alex(tmp_path_factory):
+    return _load_server('test_bot_alex', 'server.py', tmp_path_factory.mktemp('alex') / 'state.db')
+
+
+@pytest.fixture(scope='session')
+def aria(tmp_path_factory):
+    return _load_server('test_bot_aria', 'server-aria.py', tmp_path_factory.mktemp('aria') / 'state.db')
+
+
+@pytest.fixture(params=['alex', 'aria'])
+def bot(request):
+    return request.getfixturevalue(request.param)
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None, text=''):
+        self.status_code = status_code
+        self._data = data if data is not None else {}
+        self.text = text
+
+    def json(self):
+        return self._data
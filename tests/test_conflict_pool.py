@@ -0,0 +1,49 @@
+"""
+conflict_pool：fill() 清掉舊候選與寫入新候選在同一個交易，中途失敗時舊候選保留。
+"""
+import pytest
+
+from conflict_pool import ConflictPool
+
+
+class Unbindable:
+    """strip() 回傳 SQLite 無法綁定的值，讓 INSERT 在寫入幾列之後失敗"""
+
+    def strip(self):
+        return ['not', 'a', 'string']
+
+
+def _pool(tmp_path, candidates):
+    return ConflictPool(str(tmp_path / 'state.db'), lambda group, per_emotion: candidates(), per_emotion=2)
+
+
+def test_fill_replaces_unused_candidates(tmp_path):
+    batches = iter([
+        {'Positive': ['舊的一句'], 'Negative': [], 'Neutral': []},
+        {'Positive': ['新的一句', '新的兩句'], 'Negative': ['負面'], 'Neutral': []},
+    ])
+    pool = _pool(tmp_path, lambda: next(batches))
+    assert pool.fill('U-pool', 'A') == 1
+    pool.max_age = -1  # 讓舊候選視為過期，強制重新生成
+    assert pool.fill('U-pool', 'A') == 3
+    pool.max_age = 3600
+
+    assert pool.take('U-pool', 'A', 'Positive') == '新的一句'
+    assert pool.take('U-pool', 'A', 'Negative') == '負面'
+
+
+def test_failed_fill_rolls_back_and_keeps_old_candidates(tmp_path):
+    batches = iter([
+        {'Positive': ['舊的一句'], 'Negative': [], 'Neutral': []},
+        {'Positive': ['新的一句'], 'Negative': [Unbindable()], 'Neutral': []},
+    ])
+    pool = _pool(tmp_path, lambda: next(batches))
+    pool.fill('U-pool', 'A')
+    pool.max_age = -1
+    with pytest.raises(Exception):
+        pool.fill('U-pool', 'A')
+    pool.max_age = 3600
+
+    assert not pool._conn().in_transaction
+    assert pool.take('U-pool', 'A', 'Positive') == '舊的一句'
+    assert pool.take('U-pool', 'A', 'Positive') is None
@@ -0,0 +1,31 @@
+"""
+analyze_d7_message：一次 JSON mode 呼叫取得 has_sharing / emotion / conflict_sentence，
+分類結果要可重現（temperature=0）。
+"""
+import json
+
+import pytest
+
+
+def test_analysis_uses_deterministic_json_call(bot, monkeypatch):
+    calls = []
+
+    def fake_chat(api_key, system_prompt, user_content, max_tokens, timeout, temperature=0, json_mode=False):
+        calls.append({'temperature': temperature, 'json_mode': json_mode})
+        return 200, json.dumps({'has_sharing': True, 'emotion': 'Negative', 'conflict_sentence': '「你又來了」'})
+
+    monkeypatch.setattr(bot, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(bot, '_gpt_chat', fake_chat)
+
+    analysis = bot.analyze_d7_message('A' if 'A' in bot.DIFY_KEYS else 'E', '今天被主管罵')
+
+    assert calls == [{'temperature': 0, 'json_mode': True}]
+    assert analysis == {'has_sharing': True, 'emotion': 'Negative', 'conflict_sentence': '你又來了'}
+
+
+def test_openai_key_is_resolved_at_import(bot, monkeypatch):
+    # server_multi 只在 import 期間套用 ALEX_ / ARIA_ 前綴，執行期的 os.environ 不能影響已載入的 Bot
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-process-wide')
+    monkeypatch.setattr(bot, '_gpt_chat', lambda *args, **kwargs: pytest.fail('should not call OpenAI'))
+    assert bot.OPENAI_API_KEY is None
+    assert bot.analyze_d7_message('A' if 'A' in bot.DIFY_KEYS else 'E', '今天被主管罵') is None
@@ -0,0 +1,147 @@
+"""
+Dify 記憶同步（_sync_dify_memory）：失敗要拋出例外交給 DurableQueue 重試，回覆路徑仍回傳 fallback 字串；
+寫入 Dify 的 query 格式固定為 DIFY_MEMORY_TEMPLATE 預設值；舊格式重試從第一則失敗的接續。
+正常對話等待記憶寫完時不超過 reply token 期限，寫入正在退避重試時不等。
+"""
+import time
+
+import pytest
+import requests
+
+from conftest import FakeResponse
+from work_queue import DurableQueue, QueueConsumer
+
+PAYLOAD = {'user_id': 'U-memory', 'user_message': '今天好累', 'script_reply': '嗯'}
+
+
+def _group(bot):
+    return 'A' if 'A' in bot.DIFY_KEYS else 'E'
+
+
+def _payload(bot):
+    return dict(PAYLOAD, group=_group(bot))
+
+
+def test_memory_sync_raises_on_http_error(bot, monkeypatch):
+    monkeypatch.setattr(bot.dify_http, 'post', lambda *a, **kw: FakeResponse(500, text='upstream error'))
+    with pytest.raises(RuntimeError):
+        bot._sync_dify_memory(_payload(bot))
+
+
+def test_memory_sync_raises_on_request_exception(bot, monkeypatch):
+    def timeout(*args, **kwargs):
+        raise requests.Timeout('read timeout')
+    monkeypatch.setattr(bot.dify_http, 'post', timeout)
+    with pytest.raises(requests.Timeout):
+        bot._sync_dify_memory(_payload(bot))
+
+
+def test_legacy_payload_raises_on_http_error(bot, monkeypatch):
+    monkeypatch.setattr(bot.dify_http, 'post', lambda *a, **kw: FakeResponse(500))
+    with pytest.raises(RuntimeError):
+        bot._sync_dify_memory({'group': _group(bot), 'user_id': 'U-memory', 'messages': ['a', 'b']})
+
+
+def test_reply_path_keeps_fallback_string(bot, monkeypatch):
+    monkeypatch.setattr(bot.dify_http, 'post', lambda *a, **kw: FakeResponse(500))
+    assert bot.call_dify(_group(bot), 'hi', 'U-reply') == '抱歉，系統暫時無法回應。'
+
+
+def test_failed_memory_write_is_released_for_retry(bot, monkeypatch, tmp_path):
+    calls = []
+
+    def failing_post(*args, **kwargs):
+        calls.append(kwargs['json'])
+        return FakeResponse(500)
+
+    monkeypatch.setattr(bot.dify_http, 'post', failing_post)
+    queue = DurableQueue(str(tmp_path / 'queue.db'), 'dify_memory_test')
+    queue.put(_payload(bot), shard_key='U-memory')
+    consumer = QueueConsumer(queue, lambda payload, enqueued_at: bot._sync_dify_memory(payload), workers=1, poll_interval=0.05)
+    consumer.start()
+    try:
+        deadline = time.time() + 5
+        row = None
+        while time.time() < deadline:
+            row = queue._conn().execute('SELECT attempts, done_at, last_error FROM work_queue').fetchone()
+            if row and row[2]:
+                break
+            time.sleep(0.05)
+    finally:
+        consumer.stop(2)
+
+    attempts, done_at, last_error = row
+    assert len(calls) == 1
+    assert done_at is None  # 未標記完成：backoff 後重試，超過 max_attempts 才進 dead letter
+    assert attempts == 1
+    assert '500' in last_error
+
+
+def test_memory_query_uses_exact_template(bot, monkeypatch):
+    sent = []
+
+    def ok_post(*args, **kwargs):
+        sent.append(kwargs['json'])
+        return FakeResponse(200, {'answer': '(discarded)'})
+
+    monkeypatch.setattr(bot.dify_http, 'post', ok_post)
+    bot._sync_dify_memory(_payload(bot))
+
+    assert len(sent) == 1
+    assert sent[0]['query'] == '今天好累\n\n[以下是我的回應]：嗯'
+    assert sent[0]['user'] == 'U-memory'
+
+
+def test_legacy_retry_resumes_from_first_failed_message(bot, monkeypatch, tmp_path):
+    sent = []
+    responses = [FakeResponse(200, {'answer': 'ok'}), FakeResponse(500), FakeResponse(200, {'answer': 'ok'})]
+
+    def post(*args, **kwargs):
+        sent.append(kwargs['json']['query'])
+        return responses.pop(0)
+
+    monkeypatch.setattr(bot.dify_http, 'post', post)
+    queue = DurableQueue(str(tmp_path / 'queue.db'), 'dify_memory_legacy')
+    queue.put({'group': _group(bot), 'user_id': 'U-legacy', 'messages': ['第一則', '第二則']}, shard_key='U-legacy')
+    handler = lambda payload, enqueued_at: bot._sync_dify_memory(payload)  # noqa: E731
+
+    for _ in range(2):
+        item_id, payload, enqueued_at, attempts = queue.claim(1)[0]
+        try:
+            handler(payload, enqueued_at)
+            queue.ack(item_id)
+        except RuntimeError as e:
+            queue.release(item_id, attempts, str(e), backoff=0, payload=payload)
+
+    assert sent == ['第一則', '第二則', '第二則']  # 重試不會重送已成功的第一則
+    assert queue.pending_count() == 0
+
+
+def _reply_with_pending_memory(bot, monkeypatch, user_id, retrying, event_age):
+    """正常對話路徑、該使用者有未完成的記憶寫入；回傳 wait_for_user 收到的 timeout 列表"""
+    bot.clear_user_state(user_id)
+    bot.cache_user_data(user_id, {'group': _group(bot), 'code': '44444', 'current_day': 2, 'd7_triggered': False})
+    waits = []
+    monkeypatch.setattr(bot.memory_sync, 'has_pending', lambda uid: True)
+    monkeypatch.setattr(bot.memory_sync, 'is_retrying', lambda uid: retrying)
+    monkeypatch.setattr(bot.memory_sync, 'wait_for_user', lambda uid, timeout=10: waits.append(timeout))
+    monkeypatch.setattr(bot, 'call_dify', lambda *args, **kwargs: 'Dify 的回覆')
+    monkeypatch.setattr(bot.reply_guard, 'reply_fn', lambda token, message: True)
+    monkeypatch.setattr(bot.log_shipper, 'append', lambda row: None)
+    monkeypatch.setattr(bot, 'update_last_interaction', lambda uid, state=None: None)
+
+    event = {'type': 'message', 'replyToken': 'token', 'timestamp': int((time.time() - event_age) * 1000),
+             'source': {'userId': user_id}, 'message': {'type': 'text', 'text': '今天上班好忙'}}
+    assert bot.handle_message_event(event)['status'] == 'success'
+    return waits
+
+
+def test_reply_path_skips_wait_when_memory_sync_is_retrying(bot, monkeypatch):
+    waits = _reply_with_pending_memory(bot, monkeypatch, f'U-memory-retrying-{bot.__name__}', retrying=True, event_age=0)
+    assert waits == []
+
+
+def test_reply_path_caps_wait_at_reply_deadline(bot, monkeypatch):
+    # webhook 事件已在 25 秒前發生：reply token 剩不到 MEMORY_SYNC_WAIT
+    waits = _reply_with_pending_memory(bot, monkeypatch, f'U-memory-wait-{bot.__name__}', retrying=False, event_age=25)
+    assert len(waits) == 1 and waits[0] < bot.MEMORY_SYNC_WAIT
@@ -0,0 +1,34 @@
+"""
+dify_stream：SSE 一律以 UTF-8 解碼（text/event-stream 沒帶 charset 時 requests 會預設 ISO-8859-1）。
+"""
+import json
+
+from dify_stream import read_chat_stream
+
+
+class FakeStream:
+    encoding = 'ISO-8859-1'  # requests 對沒有 charset 的 text/* 回應的預設值
+
+    def __init__(self, events):
+        self.lines = [f'data: {json.dumps(event, ensure_ascii=False)}'.encode('utf-8') for event in events]
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self.lines:
+            yield line.decode(self.encoding) if decode_unicode else line
+
+    def close(self):
+        self.closed = True
+
+
+def test_chinese_answer_is_decoded_as_utf8():
+    response = FakeStream([
+        {'event': 'message', 'answer': '今天辛苦了，', 'conversation_id': 'c-1', 'message_id': 'm-1'},
+        {'event': 'message', 'answer': '要早點休息喔', 'conversation_id': 'c-1', 'message_id': 'm-1'},
+        {'event': 'message_end', 'conversation_id': 'c-1'},
+    ])
+
+    result = read_chat_stream(response, started_at=0)
+
+    assert result == {'answer': '今天辛苦了，要早點休息喔', 'conversation_id': 'c-1', 'message_id': 'm-1'}
+    assert response.closed
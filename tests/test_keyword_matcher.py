@@ -0,0 +1,149 @@
+"""
+關鍵字 fallback 等價檢查：server 裡以 KeywordMatcher 實作的四個 fallback 函數
+（_detect_response_type_fallback / detect_emotion_fallback / is_greeting / has_emotional_content）
+必須與舊做法（依分類順序逐一 `any(word in message ...)`）回傳完全相同，
+detect_emotion_fallback 印出的判斷理由也要相同。
+
+語料：固定 seed 以所有關鍵字隨機組合（含重疊、互為子字串、大小寫、標點），另加邊界案例。
+計時比較在 benchmarks/bench_keyword_matcher.py。
+"""
+import contextlib
+import io
+import random
+import re
+
+import pytest
+
+from keyword_matcher import KeywordMatcher
+
+FUNCTIONS = ('_detect_response_type_fallback', 'detect_emotion_fallback', 'is_greeting', 'has_emotional_content')
+FILLER = ['我', '今天', '其實', '覺得', '他', '上班', '吃飯', '啦', '喔', '。', '，', '!', '~', ' ', 'OK', 'Hi', 'lol']
+EDGE_CASES = [
+    '', ' ', '...', '？？', '?', '嗯', '好', 'HI', 'Hello!', 'ＯＫ', 'ｈｉ', '！！！', '　',
+    # 互為子字串 / 重疊：「不好」與「不好意思」、「不是」與「不是不開心」、「開心」與「超開心」
+    '不好意思', '真的不好', '不是不開心啦', '開心不起來', '超開心', '還好不好',
+    '好吧好啊', '算了啦', '沒有壓力但很累', '不累', '晚安安', '你在嗎？',
+    # 全形字元與標點
+    '為什麼？', '憑什麼！', '好啊～', '不要，謝謝。', '今天好煩（崩潰）',
+]
+
+
+def _legacy(bot):
+    """舊做法：與改版前的函數相同，每次呼叫重建 list、依分類順序逐一 `any(word in message ...)`"""
+    def response_type(user_message):
+        keywords = {k: list(v) for k, v in bot._RESPONSE_TYPE_KEYWORDS.items()}
+        message = user_message.lower()
+        if any(word in message for word in keywords['question']):
+            return 'question'
+        if any(phrase in message for phrase in keywords['neutral_override']):
+            return 'neutral'
+        if any(word in message for word in keywords['refuse']):
+            return 'refuse'
+        if any(word in message for word in keywords['dismiss']):
+            return 'dismiss'
+        if any(word in message for word in keywords['cooperative']):
+            return 'cooperative'
+        return 'neutral'
+
+    def emotion(user_message):
+        keywords = {k: list(v) for k, v in bot._EMOTION_FALLBACK_KEYWORDS.items()}
+        if any(p in user_message for p in keywords['neutral_override']):
+            emotion, reason = 'Neutral', 'neutral override'
+        elif any(p in user_message for p in keywords['negative_pattern']):
+            emotion, reason = 'Negative', 'negative pattern'
+        elif any(w in user_message for w in keywords['negative_keyword']):
+            emotion, reason = 'Negative', 'negative keyword'
+        elif any(w in user_message for w in keywords['positive_keyword']):
+            emotion, reason = 'Positive', 'positive keyword'
+        else:
+            emotion, reason = 'Neutral', 'neutral'
+        print(f'Fallback: Emotion detected ({reason}): {emotion}')
+        return emotion
+
+    def greeting(user_message):
+        message = user_message.strip()
+        if re.fullmatch(r'[\W_]+', message):
+            return True
+        return any(word in message for word in list(bot._GREETING_KEYWORDS))
+
+    def emotional(user_message):
+        if len(user_message.strip()) > 8:
+            return True
+        return any(word in user_message for word in list(bot._EMOTIONAL_KEYWORDS))
+
+    return {
+        '_detect_response_type_fallback': response_type,
+        'detect_emotion_fallback': emotion,
+        'is_greeting': greeting,
+        'has_emotional_content': emotional,
+    }
+
+
+def _corpus(bot, n=3000, seed=7):
+    rng = random.Random(seed)
+    keywords = []
+    for table in (bot._RESPONSE_TYPE_KEYWORDS, bot._EMOTION_FALLBACK_KEYWORDS):
+        for words in table.values():
+            keywords.extend(words)
+    keywords.extend(bot._GREETING_KEYWORDS)
+    keywords.extend(bot._EMOTIONAL_KEYWORDS)
+    corpus = list(EDGE_CASES)
+    while len(corpus) < n:
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            word = rng.choice(keywords) if rng.random() < 0.5 else rng.choice(FILLER)
+            parts.append(word.upper() if rng.random() < 0.1 else word)
+        corpus.append(''.join(parts))
+    return corpus
+
+
+def _call_quiet(fn, message):
+    """回傳 (結果, 印出的內容去掉 [TAG] 前綴)"""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        result = fn(message)
+    return result, re.sub(r'^\[[\w ]+\] ', '', out.getvalue(), flags=re.M)
+
+
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_matches_legacy_any_logic(bot, name):
+    legacy = _legacy(bot)[name]
+    current = getattr(bot, name)
+    mismatches = [
+        (message, expected, actual)
+        for message in _corpus(bot)
+        for expected, actual in [(_call_quiet(legacy, message), _call_quiet(current, message))]
+        if expected != actual
+    ]
+    assert not mismatches, mismatches[:20]
+
+
+def test_first_respects_category_order():
+    matcher = KeywordMatcher({'high': ['不好意思'], 'low': ['不好']})
+    assert matcher.first('真的不好意思') == 'high'
+    assert matcher.first('真的不好') == 'low'
+    assert matcher.first('不好…不好意思', order=('low', 'high')) == 'low'
+    assert matcher.first('沒事') is None
+
+
+def test_scan_reports_overlapping_keywords():
+    matcher = KeywordMatcher({'a': ['ab', 'bc'], 'b': ['abc', 'c']})
+    hits = matcher.scan('abcd')
+    assert sorted(hits['a']) == ['ab', 'bc']
+    assert sorted(hits['b']) == ['abc', 'c']
+
+
+def test_empty_text_and_empty_keyword():
+    matcher = KeywordMatcher({'a': ['', 'x']})
+    assert matcher.scan('') == {}
+    assert matcher.first('') is None
+    assert not matcher.contains('')
+    assert not matcher.contains('yz')  # 空字串關鍵字被忽略，不會命中所有訊息
+
+
+def test_full_width_characters_are_distinct():
+    matcher = KeywordMatcher({'q': ['？'], 'ok': ['OK']})
+    assert matcher.first('真的？') == 'q'
+    assert matcher.first('真的?') is None
+    assert matcher.first('ＯＫ') is None
+    assert matcher.first('OK啦') == 'ok'
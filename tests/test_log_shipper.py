@@ -0,0 +1,62 @@
+"""
+log_shipper：預設沿用單筆 log_conversation 逐列送出；batch_payload 模式只在回應的 written 等於列數時才刪除 journal
+（未部署新 handler 的 Apps Script 也會回 200）。
+"""
+from conftest import FakeResponse
+from log_shipper import LogShipper
+
+URL = 'https://sheets.example/exec'
+
+
+class FakeHttp:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.payloads = []
+
+    def post(self, url, json=None, timeout=None):
+        self.payloads.append(json)
+        return self.responses.pop(0)
+
+
+def _shipper(tmp_path, http, **kwargs):
+    shipper = LogShipper(str(tmp_path / 'state.db'), http, lambda: URL, batch_size=10, **kwargs)
+    for i in range(3):
+        shipper.append({'message_type': 'user', 'message_content': f'訊息 {i}'})
+    return shipper
+
+
+def test_default_sends_legacy_single_rows_in_order(tmp_path):
+    http = FakeHttp([FakeResponse(200)] * 3)
+    shipper = _shipper(tmp_path, http)
+
+    assert shipper.flush_once(force=True) == 3
+    assert [p['message_content'] for p in http.payloads] == ['訊息 0', '訊息 1', '訊息 2']
+    assert all(p['log_conversation'] is True and 'log_conversation_batch' not in p for p in http.payloads)
+    assert shipper.pending_count() == 0
+
+
+def test_single_row_failure_keeps_remaining_rows(tmp_path):
+    http = FakeHttp([FakeResponse(200), FakeResponse(500)])
+    shipper = _shipper(tmp_path, http)
+
+    assert shipper.flush_once(force=True) == 1
+    assert shipper.pending_count() == 2
+    assert shipper.stats()['failed_batches'] == 1
+
+
+def test_batch_requires_written_count(tmp_path):
+    http = FakeHttp([FakeResponse(200, {'success': True})])  # 舊版 Apps Script：200 但沒有寫入
+    shipper = _shipper(tmp_path, http, batch_payload=True)
+
+    assert shipper.flush_once(force=True) == 0
+    assert http.payloads[0]['log_conversation_batch'] is True
+    assert shipper.pending_count() == 3
+
+
+def test_batch_deletes_rows_when_all_written(tmp_path):
+    http = FakeHttp([FakeResponse(200, {'written': 3})])
+    shipper = _shipper(tmp_path, http, batch_payload=True)
+
+    assert shipper.flush_once(force=True) == 3
+    assert len(http.payloads[0]['rows']) == 3
+    assert shipper.pending_count() == 0
@@ -0,0 +1,85 @@
+"""
+每日推播 multicast：每次請求帶同一個 X-Line-Retry-Key；
+只有 LINE 明確以 4xx 拒絕才改逐一 push，5xx / 逾時以同一個 key 重送，不會重複推播。
+"""
+import pytest
+import requests
+
+from conftest import FakeResponse
+
+TODAY = '2026-10-17'
+
+
+def _users(n):
+    return [{'user_id': f'U-nudge-{i}', 'code': f'{i:05d}', 'group': 'A', 'current_day': 2,
+             'last_interaction': '', 'last_nudge_date': ''} for i in range(n)]
+
+
+@pytest.fixture
+def line(bot, monkeypatch):
+    calls = {'multicast': [], 'push': [], 'after': []}
+    monkeypatch.setattr(bot.line_push_bucket, 'acquire', lambda: None)
+    monkeypatch.setattr(bot, '_multicast_retry_sleep', lambda seconds: None)
+    monkeypatch.setattr(bot, 'send_line_push', lambda user_id, message: calls['push'].append(user_id) or True)
+    monkeypatch.setattr(bot, '_after_nudge', lambda user, tw_today: calls['after'].append(user['user_id']))
+    return calls
+
+
+def _respond(bot, monkeypatch, calls, responses):
+    def post(url, headers=None, json=None, timeout=None):
+        calls['multicast'].append(headers['X-Line-Retry-Key'])
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    monkeypatch.setattr(bot.line_http, 'post', post)
+
+
+def test_success_sends_one_request_with_retry_key(bot, monkeypatch, line):
+    _respond(bot, monkeypatch, line, [FakeResponse(200)])
+    results = bot._nudge_users(_users(3), TODAY)
+
+    assert len(line['multicast']) == 1 and line['multicast'][0]
+    assert line['push'] == []
+    assert results['multicast_requests'] == 1
+    assert len(results['pushed']) == 3
+
+
+def test_timeout_retries_with_same_key_and_never_pushes(bot, monkeypatch, line):
+    _respond(bot, monkeypatch, line, [requests.Timeout('read timeout'), FakeResponse(409)])
+    results = bot._nudge_users(_users(3), TODAY)
+
+    assert len(line['multicast']) == 2
+    assert len(set(line['multicast'])) == 1  # 重送沿用同一個 retry key
+    assert line['push'] == []
+    assert len(results['pushed']) == 3  # 409 = LINE 已受理過這個 key
+
+
+def test_unknown_result_is_unconfirmed_without_fallback(bot, monkeypatch, line):
+    _respond(bot, monkeypatch, line, [requests.Timeout('read timeout')] * (bot.LINE_MULTICAST_RETRIES + 1))
+    results = bot._nudge_users(_users(2), TODAY)
+
+    assert len(line['multicast']) == bot.LINE_MULTICAST_RETRIES + 1
+    assert line['push'] == [] and line['after'] == []
+    assert results['unconfirmed'] == ['U-nudge-0', 'U-nudge-1']
+    assert results['pushed'] == []
+
+
+def test_server_error_retries_with_same_key_and_never_pushes(bot, monkeypatch, line):
+    _respond(bot, monkeypatch, line, [FakeResponse(500, text='server error'), FakeResponse(200)])
+    results = bot._nudge_users(_users(2), TODAY)
+
+    assert len(line['multicast']) == 2
+    assert len(set(line['multicast'])) == 1
+    assert line['push'] == []
+    assert results['pushed'] == ['U-nudge-0', 'U-nudge-1']
+
+
+def test_client_error_falls_back_to_push(bot, monkeypatch, line):
+    _respond(bot, monkeypatch, line, [FakeResponse(400, text='invalid user id')])
+    results = bot._nudge_users(_users(2), TODAY)
+
+    assert len(line['multicast']) == 1
+    assert line['push'] == ['U-nudge-0', 'U-nudge-1']
+    assert results['fallback_pushes'] == 2
+    assert results['pushed'] == ['U-nudge-0', 'U-nudge-1']
@@ -0,0 +1,156 @@
+"""
+handle_message_event 的回覆順序：LINE reply 必須在任何對話記錄（log_shipper.append）、
+last_interaction 更新與 Sheets 寫入（sheets_outbox / sheets_http.post）之前送出。
+
+涵蓋正常對話（Dify）、D7 腳本（turn 2）與驗證碼三條路徑，Alex / Aria 各跑一次。
+驗證路徑在回覆前必須先查 Sheets（?user_id= / ?code=，查詢結果決定回覆內容），這兩個讀取不列入檢查。
+"""
+import threading
+import time
+
+import pytest
+
+from conftest import FakeResponse
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, detail=None):
+        with self._lock:
+            self.events.append((kind, detail))
+
+    def kinds(self):
+        with self._lock:
+            return [kind for kind, _ in self.events]
+
+    def wait_for(self, kind, count, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.kinds().count(kind) >= count:
+                return
+            time.sleep(0.02)
+        raise AssertionError(f'expected {count} x {kind}, got {self.events}')
+
+
+@pytest.fixture
+def recorder(bot, monkeypatch):
+    rec = Recorder()
+
+    def reply(reply_token, message):
+        rec.add('reply', message)
+        return True
+
+    def push(user_id, message):
+        rec.add('push', message)
+        return True
+
+    def update_last_interaction(user_id, state=None):
+        rec.add('update_last_interaction', user_id)
+
+    def call_dify(group, message, user_id, state=None, raise_on_error=False):
+        rec.add('call_dify', message)
+        return 'Dify 的回覆'
+
+    def sheets_post(url, **kwargs):
+        rec.add('sheets_post', kwargs.get('json'))
+        return FakeResponse(200, {'success': True})
+
+    def sheets_get(url, **kwargs):
+        rec.add('sheets_read', url)
+        return FakeResponse(200, {'found': False})
+
+    monkeypatch.setattr(bot.reply_guard, 'reply_fn', reply)
+    monkeypatch.setattr(bot.reply_guard, 'push_fn', push)
+    monkeypatch.setattr(bot.log_shipper, 'append', lambda row: rec.add('log', row['message_type']))
+    monkeypatch.setattr(bot.sheets_outbox, 'put', lambda user_id, op, payload: rec.add('sheets_outbox', op))
+    monkeypatch.setattr(bot, 'update_last_interaction', update_last_interaction)
+    monkeypatch.setattr(bot, 'call_dify', call_dify)
+    monkeypatch.setattr(bot.sheets_http, 'post', sheets_post)
+    monkeypatch.setattr(bot.sheets_http, 'get', sheets_get)
+    monkeypatch.setattr(bot.memory_sync, 'submit', lambda user_id, payload: rec.add('memory_sync', user_id))
+    return rec
+
+
+def _groups(bot):
+    return ('A', 'B') if 'A' in bot.DIFY_KEYS else ('E', 'F')
+
+
+def _event(user_id, text):
+    return {
+        'type': 'message',
+        'replyToken': f'token-{user_id}',
+        'timestamp': int(time.time() * 1000),
+        'source': {'userId': user_id},
+        'message': {'type': 'text', 'text': text},
+    }
+
+
+def _verified_user(bot, user_id, group, current_day, d7_turn=0):
+    bot.clear_user_state(user_id)
+    bot.cache_user_data(user_id, {'group': group, 'code': '54321', 'current_day': current_day, 'd7_triggered': False})
+    if d7_turn:
+        with bot._state_conn() as conn:
+            conn.execute('UPDATE bot_state SET d7_turn = ? WHERE user_id = ?', (d7_turn, user_id))
+
+
+def _assert_reply_first(recorder, bookkeeping=('log', 'update_last_interaction', 'sheets_outbox', 'sheets_post')):
+    kinds = recorder.kinds()
+    assert 'reply' in kinds, recorder.events
+    first_reply = kinds.index('reply')
+    early = [kind for kind in kinds[:first_reply] if kind in bookkeeping]
+    assert not early, f'bookkeeping before reply: {recorder.events}'
+
+
+def test_normal_path_replies_before_logging(bot, recorder):
+    user_id = f'U-normal-{bot.__name__}'
+    _verified_user(bot, user_id, _groups(bot)[0], current_day=2)
+    recorder.events.clear()
+
+    result = bot.handle_message_event(_event(user_id, '今天上班好忙'))
+
+    assert result['status'] == 'success'
+    recorder.wait_for('log', 2)
+    assert recorder.kinds().index('call_dify') < recorder.kinds().index('reply')
+    assert ('reply', 'Dify 的回覆') in recorder.events
+    assert 'update_last_interaction' in recorder.kinds()
+    _assert_reply_first(recorder)
+
+
+def test_d7_script_path_replies_before_logging(bot, recorder):
+    user_id = f'U-d7-{bot.__name__}'
+    group = _groups(bot)[1]
+    _verified_user(bot, user_id, group, current_day=bot.CONFLICT_DAY, d7_turn=2)
+    recorder.events.clear()
+
+    bot.handle_message_event(_event(user_id, '你幹嘛這樣說'))
+
+    recorder.wait_for('log', 2)
+    replies = [detail for kind, detail in recorder.events if kind == 'reply']
+    script_group = getattr(bot, 'D7_GROUP_MAPPING', {}).get(group, group)  # Aria 的 E~H 組對應到 A~D 腳本
+    assert replies == [bot.D7_SCRIPTS[script_group]['2_question']]  # 無 OpenAI key → 關鍵字分類「幹嘛」= question
+    assert 'call_dify' not in recorder.kinds()  # 腳本回覆不等 Dify
+    assert 'memory_sync' in recorder.kinds()
+    _assert_reply_first(recorder, bookkeeping=('log', 'update_last_interaction', 'sheets_outbox', 'sheets_post', 'memory_sync'))
+
+
+def test_verification_path_replies_before_sheets_write(bot, recorder, monkeypatch):
+    user_id = f'U-verify-{bot.__name__}'
+    group = _groups(bot)[0]
+    bot.clear_user_state(user_id)
+
+    def lookup(code):
+        recorder.add('sheets_read', code)
+        return {'found': True, 'group': group, 'code': code}
+
+    monkeypatch.setattr(bot, 'query_google_sheets_by_code', lookup)
+    recorder.events.clear()
+
+    result = bot.handle_message_event(_event(user_id, '12345'))
+
+    assert result['status'] == 'verification success'
+    kinds = recorder.kinds()
+    assert 'sheets_outbox' in kinds  # verify 綁定寫入
+    _assert_reply_first(recorder)
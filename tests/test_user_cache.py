@@ -0,0 +1,73 @@
+"""
+user_data 快取：current_day 由 cache_first_interaction 本地計算（不隨午夜過期），
+trigger_d7 觸發後 cache_d7_triggered 要同步寫回（有 UserState 時寫 state，否則直接更新 SQLite）。
+"""
+from datetime import datetime, timedelta
+
+
+def _group(bot):
+    return 'A' if 'A' in bot.DIFY_KEYS else 'E'
+
+
+def _cache(bot, user_id, days_ago):
+    first = (datetime.now(bot.TW_TZ) - timedelta(days=days_ago)).strftime('%Y-%m-%d 09:00:00')
+    bot.clear_user_state(user_id)
+    bot.cache_user_data(user_id, {
+        'group': _group(bot), 'code': '11111', 'current_day': 1, 'first_interaction': first, 'd7_triggered': False,
+    })
+
+
+def _stub_trigger(bot, monkeypatch):
+    monkeypatch.setattr(bot, 'generate_conflict_sentence', lambda group, message: '衝突句')
+    monkeypatch.setattr(bot.sheets_outbox, 'put', lambda user_id, op, payload: None)
+
+
+def test_current_day_is_computed_from_first_interaction(bot):
+    user_id = f'U-cache-day-{bot.__name__}'
+    _cache(bot, user_id, days_ago=6)
+    cached = bot.get_cached_user_data(user_id)
+    assert cached['current_day'] == 7
+    assert cached['group'] == _group(bot)
+
+
+def test_trigger_d7_writes_through_to_user_state(bot, monkeypatch):
+    user_id = f'U-cache-state-{bot.__name__}'
+    _cache(bot, user_id, days_ago=6)
+    _stub_trigger(bot, monkeypatch)
+    state = bot.load_user_state(user_id)
+
+    bot.trigger_d7('今天好累', _group(bot), user_id, state=state)
+
+    assert state.cache_d7_triggered == 1
+    assert bot.get_cached_user_data(user_id, state)['d7_triggered'] is True
+
+
+def test_trigger_d7_without_state_updates_sqlite(bot, monkeypatch):
+    user_id = f'U-cache-db-{bot.__name__}'
+    _cache(bot, user_id, days_ago=6)
+    _stub_trigger(bot, monkeypatch)
+
+    bot.trigger_d7('今天好累', _group(bot), user_id)
+
+    assert bot.get_cached_user_data(user_id)['d7_triggered'] is True
+
+
+def test_unparseable_first_interaction_falls_back_to_current_day(bot):
+    user_id = f'U-cache-bad-{bot.__name__}'
+    bot.clear_user_state(user_id)
+    bot.cache_user_data(user_id, {
+        'group': _group(bot), 'code': '22222', 'current_day': 5,
+        'first_interaction': 'Mon Jan 05 2026 10:00:00 GMT+0800 (台北標準時間)', 'd7_triggered': False,
+    })
+    cached = bot.get_cached_user_data(user_id)
+    assert cached['current_day'] == 5
+    assert bot.current_day_from(cached['first_interaction'], bot.TW_TZ) == 5
+
+
+def test_unparseable_first_interaction_without_current_day_is_not_cached_forever(bot):
+    user_id = f'U-cache-bad-day-{bot.__name__}'
+    bot.clear_user_state(user_id)
+    bot.cache_user_data(user_id, {'group': _group(bot), 'code': '33333', 'first_interaction': 'not a date'})
+    with bot._state_conn() as conn:
+        row = conn.execute('SELECT cache_first_interaction FROM bot_state WHERE user_id = ?', (user_id,)).fetchone()
+    assert row[0] is None  # 沒有 first_interaction → 舊規則，只在當天有效
@@ -0,0 +1,225 @@
+"""
+SQLite 持久化工作佇列（Alex / Aria 共用）
+
+Webhook 收到事件後先寫入佇列並立即回 200，由背景 worker 取出處理，
+避免 Sheets / OpenAI / Dify 的延遲卡住 gunicorn worker、觸發 LINE 重送。
+
+- 至少一次（at-least-once）：處理完才 ack，worker 掛掉時 claim 逾時後會被重新取出
+- 同一 shard_key（LINE userId）嚴格依序：只會 claim 該 shard 最早一筆未完成的工作
+- dedup_key（LINE webhookEventId）去重：LINE 重送同一事件不會重複處理
+"""
+import json
+import threading
+import time
+import traceback
+
+from state_store import get_engine
+
+
+class DurableQueue:
+    """以 SQLite 表實作的工作佇列，多個 queue 可共用同一個 DB 檔"""
+
+    def __init__(self, db_path, name, visibility_timeout=120, max_attempts=5, retention=86400):
+        self.db_path = db_path
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._last_purge = 0.0
+        self._init_table()
+
+    def _conn(self):
+        # 每個 thread 一條 WAL 長連線；isolation_level=None：自行控制 BEGIN IMMEDIATE，claim 才是原子的
+        return get_engine(self.db_path, isolation_level=None).connection()
+
+    def _init_table(self):
+        conn = self._conn()
+        conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS work_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT NOT NULL,
+                dedup_key TEXT,
+                shard_key TEXT,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_until REAL NOT NULL DEFAULT 0,
+                done_at REAL,
+                last_error TEXT
+            )
+            '''
+        )
+        conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_work_queue_dedup '
+            'ON work_queue (queue, dedup_key)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_work_queue_pending '
+            'ON work_queue (queue, done_at, shard_key, id)'
+        )
+
+    def put(self, payload, dedup_key=None, shard_key=None):
+        """寫入一筆工作；dedup_key 重複時忽略並回傳 None"""
+        conn = self._conn()
+        cur = conn.execute(
+            'INSERT OR IGNORE INTO work_queue (queue, dedup_key, shard_key, payload, enqueued_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (self.name, dedup_key, shard_key or '', json.dumps(payload, ensure_ascii=False), time.time())
+        )
+        return cur.lastrowid if cur.rowcount else None
+
+    def claim(self, limit=1):
+        """
+        取出最多 limit 筆可處理的工作：每個 shard 只取最早一筆，
+        且該筆不能正被其他 worker 處理（claimed_until 未過期）。
+        回傳 [(id, payload, enqueued_at, attempts), ...]
+        """
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                '''
+                SELECT id, payload, enqueued_at, attempts FROM work_queue
+                WHERE id IN (
+                    SELECT MIN(id) FROM work_queue
+                    WHERE queue = ? AND done_at IS NULL
+                    GROUP BY shard_key
+                )
+                AND claimed_until < ?
+                ORDER BY id
+                LIMIT ?
+                ''',
+                (self.name, now, limit)
+            ).fetchall()
+            for row in rows:
+                conn.execute(
+                    'UPDATE work_queue SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?',
+                    (now + self.visibility_timeout, row[0])
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return [(row[0], json.loads(row[1]), row[2], row[3] + 1) for row in rows]
+
+    def ack(self, item_id):
+        conn = self._conn()
+        conn.execute('UPDATE work_queue SET done_at = ? WHERE id = ?', (time.time(), item_id))
+        self._maybe_purge()
+
+    def release(self, item_id, attempts, error, backoff=5, payload=None):
+        """
+        處理失敗：未超過 max_attempts 則延後重試，否則標記完成並保留錯誤（dead letter）。
+        payload 不是 None 時一併存回（handler 記錄的進度，重試從中斷處接續）
+        """
+        now = time.time()
+        conn = self._conn()
+        if payload is not None:
+            conn.execute('UPDATE work_queue SET payload = ? WHERE id = ?', (json.dumps(payload, ensure_ascii=False), item_id))
+        if attempts >= self.max_attempts:
+            conn.execute(
+                'UPDATE work_queue SET done_at = ?, last_error = ? WHERE id = ?',
+                (now, f'dead: {error}'[:500], item_id)
+            )
+        else:
+            conn.execute(
+                'UPDATE work_queue SET claimed_until = ?, last_error = ? WHERE id = ?',
+                (now + backoff * attempts, str(error)[:500], item_id)
+            )
+
+    def has_failed(self, shard_key):
+        """該 shard 是否有失敗過、正在退避等待重試的工作"""
+        row = self._conn().execute(
+            'SELECT 1 FROM work_queue WHERE queue = ? AND done_at IS NULL AND shard_key = ? AND last_error IS NOT NULL LIMIT 1',
+            (self.name, shard_key)
+        ).fetchone()
+        return row is not None
+
+    def pending_count(self, shard_key=None):
+        conn = self._conn()
+        if shard_key is None:
+            row = conn.execute(
+                'SELECT COUNT(*) FROM work_queue WHERE queue = ? AND done_at IS NULL',
+                (self.name,)
+            ).fetchone()
+        else:
+            row = conn.execute(
+                'SELECT COUNT(*) FROM work_queue WHERE queue = ? AND done_at IS NULL AND shard_key = ?',
+                (self.name, shard_key)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def _maybe_purge(self):
+        # 已完成的紀錄保留 retention 秒（供 dedup），之後清除
+        now = time.time()
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+        conn = self._conn()
+        conn.execute(
+            'DELETE FROM work_queue WHERE queue = ? AND done_at IS NOT NULL AND done_at < ?',
+            (self.name, now - self.retention)
+        )
+
+
+class QueueConsumer:
+    """背景 worker pool：持續從 DurableQueue 取出工作交給 handler(payload, enqueued_at)"""
+
+    def __init__(self, queue, handler, workers=4, poll_interval=1.0, label='QUEUE', on_settled=None):
+        self.queue = queue
+        self.handler = handler
+        self.on_settled = on_settled  # ack / release 之後呼叫，供等待者得知佇列狀態已變化
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.label = label
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'{self.label.lower()}-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f'[{self.label}] Started {self.workers} workers on queue "{self.queue.name}"')
+
+    def notify(self):
+        """有新工作時喚醒閒置的 worker"""
+        self._wakeup.set()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time.time()))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                items = self.queue.claim(1)
+            except Exception as e:
+                print(f'[{self.label}] Claim error: {str(e)}')
+                items = []
+
+            if not items:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            item_id, payload, enqueued_at, attempts = items[0]
+            try:
+                self.handler(payload, enqueued_at)
+                self.queue.ack(item_id)
+            except Exception as e:
+                print(f'[{self.label}] Job {item_id} failed (attempt {attempts}): {str(e)}')
+                traceback.print_exc()
+                # handler 可在 payload 裡記錄進度，失敗時一併存回
+                self.queue.release(item_id, attempts, str(e), payload=payload)
+            if self.on_settled:
+                self.on_settled()
+            # 同 shard 的下一筆可能已在排隊，讓其他 worker 也有機會接手
+            self._wakeup.set()